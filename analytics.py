@@ -0,0 +1,258 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from geometry import row_geometry
+
+
+class AnalyticsCache:
+    """
+    LRU cache of each image's label analytics.
+
+    Entries are dropped when a label on the image is written, and are also stored with a
+    fingerprint of the image's labels, so writes made by another process are never missed.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # image_id -> (fingerprint, analytics)
+        self._lock = threading.Lock()
+
+    def get(self, image_id, fingerprint):
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(image_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, image_id, fingerprint, analytics):
+        with self._lock:
+            self._entries[image_id] = (fingerprint, analytics)
+            self._entries.move_to_end(image_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, image_ids=None):
+        # forget some images, or every image
+        with self._lock:
+            if image_ids is None:
+                self._entries.clear()
+            for image_id in image_ids or ():
+                self._entries.pop(image_id, None)
+
+
+def labels_fingerprint(cur, image_id):
+    # changes whenever a label on the image is added, deleted or updated, as each of those bumps a version
+    row = cur.execute("""
+        SELECT count(*), total(version), total(label_id * version)
+        FROM Labels
+        WHERE image_id=:image_id AND NOT deleted
+        """, {'image_id': image_id}).fetchone()
+    return tuple(row)
+
+
+def load_image_labels(cur, image_id):
+    """
+    The image's labels as parallel numpy arrays, ready for shapely's vectorized functions.
+
+    Labels whose geometry can't be parsed are left out and their ids returned in `skipped`,
+    and invalid geometries such as self intersecting polygons are made valid.
+    """
+    rows = cur.execute("""
+        SELECT label_id, labelled_by, class_id, geometry, geometry_wkb, version
+        FROM Labels
+        WHERE image_id=:image_id AND NOT deleted
+        ORDER BY label_id
+        """, {'image_id': image_id}).fetchall()
+
+    kept = []
+    geoms = []
+    skipped = []
+    for row in rows:
+        try:
+            geoms.append(row_geometry(row))
+            kept.append(row)
+        except ValueError:
+            skipped.append(row['label_id'])
+
+    geoms = np.array(geoms, dtype=object)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+    return {
+        'label_ids': np.array([row['label_id'] for row in kept], dtype=np.int64),
+        'users': np.array([row['labelled_by'] for row in kept], dtype=object),
+        'class_ids': np.array([row['class_id'] for row in kept], dtype=np.int64),
+        'geoms': geoms,
+        'skipped': skipped,
+    }
+
+
+def _group_unions(geoms, keys):
+    """
+    The union of the geometries sharing each key, in the order of np.unique's keys. The
+    geometries are sorted by key and split into contiguous groups, so each is only visited
+    once, though the unions themselves are still one GEOS call per group.
+    """
+    order = np.argsort(keys, kind='stable')
+    unique, starts = np.unique(keys[order], return_index=True)
+    unions = np.empty(len(unique), dtype=object)
+    unions[:] = [shapely.union_all(group) for group in np.split(geoms[order], starts[1:])] if len(unique) else []
+    return unique, unions
+
+
+def _iou(intersection_area, union_area):
+    return np.divide(intersection_area, union_area, out=np.zeros_like(union_area), where=union_area > 0)
+
+
+def analyse_labels(labels):
+    """
+    Areas, overlaps and agreement for one image's labels, as loaded by load_image_labels.
+
+    - labels: the area of each label
+    - classes: per class, the summed area of its labels, the area they cover once overlaps are
+      merged, and the union of every annotator's labels and the intersection of each annotator's
+      union, i.e. the region they all agree on. With fewer than two annotators on the class
+      there's no agreement to measure, so the intersection is None
+    - pairs: every pair of overlapping labels drawn by different users, with their IoU
+    - annotators: per class, the IoU of each pair of users' unions, counting a user with no
+      labels of that class as an empty geometry
+    """
+    label_ids = labels['label_ids']
+    users = labels['users']
+    class_ids = labels['class_ids']
+    geoms = labels['geoms']
+    areas = shapely.area(geoms)
+
+    # the tree finds the overlapping pairs, so intersections are only computed where they're non empty
+    left, right = shapely.STRtree(geoms).query(geoms, predicate='intersects')
+    keep = (left < right) & (users[left] != users[right])
+    left, right = left[keep], right[keep]
+    intersection_areas = shapely.area(shapely.intersection(geoms[left], geoms[right]))
+    union_areas = areas[left] + areas[right] - intersection_areas
+    ious = _iou(intersection_areas, union_areas)
+    pairs = [{
+        'label_a': int(a), 'label_b': int(b), 'user_a': user_a, 'user_b': user_b,
+        'class_a': int(class_a), 'class_b': int(class_b), 'intersection_area': float(inter),
+        'union_area': float(union), 'iou': float(iou)}
+        for a, b, user_a, user_b, class_a, class_b, inter, union, iou in zip(
+            label_ids[left], label_ids[right], users[left], users[right], class_ids[left], class_ids[right],
+            intersection_areas, union_areas, ious)]
+
+    classes = []
+    annotators = []
+    if len(geoms):
+        # each user's union for each class, as a class x user grid, empty for users who didn't label the class
+        all_users, user_index = np.unique(users, return_inverse=True)
+        class_keys, class_index = np.unique(class_ids, return_inverse=True)
+        keys, user_unions = _group_unions(geoms, class_index * len(all_users) + user_index)
+        unions = np.full((len(class_keys), len(all_users)), shapely.Polygon(), dtype=object)
+        unions[keys // len(all_users), keys % len(all_users)] = user_unions
+        class_unions = shapely.union_all(unions, axis=1)
+        agreed = shapely.intersection_all(unions, axis=1)
+        agreed[np.bincount(keys // len(all_users), minlength=len(class_keys)) < 2] = None
+        label_counts = np.bincount(class_index)
+        total_areas = np.bincount(class_index, weights=areas)
+
+        for i, class_id in enumerate(class_keys):
+            classes.append({
+                'class_id': int(class_id),
+                'label_count': int(label_counts[i]),
+                'total_area': float(total_areas[i]),
+                'union_area': float(shapely.area(class_unions[i])),
+                'intersection_area': None if agreed[i] is None else float(shapely.area(agreed[i])),
+                'union': class_unions[i],
+                'intersection': agreed[i],
+            })
+
+        # every pair of users in every class at once, by broadcasting their unions against each other
+        a, b = np.triu_indices(len(all_users), k=1)
+        intersection_areas = shapely.area(shapely.intersection(unions[:, a], unions[:, b]))
+        union_areas = shapely.area(shapely.union(unions[:, a], unions[:, b]))
+        ious = _iou(intersection_areas, union_areas)
+        # skip the pairs where neither of them labelled the class
+        for i, pair in zip(*np.nonzero(union_areas)):
+            annotators.append({
+                'class_id': int(class_keys[i]), 'user_a': all_users[a[pair]], 'user_b': all_users[b[pair]],
+                'intersection_area': float(intersection_areas[i, pair]), 'union_area': float(union_areas[i, pair]),
+                'iou': float(ious[i, pair])})
+
+    return {
+        'labels': [{'label_id': int(label_id), 'labelled_by': user, 'class_id': int(class_id), 'area': float(area)}
+            for label_id, user, class_id, area in zip(label_ids, users, class_ids, areas)],
+        'classes': classes,
+        'pairs': pairs,
+        'annotators': annotators,
+        'skipped': labels['skipped'],
+    }
+
+
+def image_analytics(cur, image_id, cache=None):
+    # analyse_labels for an image, reusing the cached result while its labels haven't changed
+    fingerprint = labels_fingerprint(cur, image_id)
+    if cache is not None:
+        analytics = cache.get(image_id, fingerprint)
+        if analytics is not None:
+            return analytics
+
+    analytics = analyse_labels(load_image_labels(cur, image_id))
+    if cache is not None:
+        cache.put(image_id, fingerprint, analytics)
+    return analytics
+
+
+def dataset_analytics(cur, cache=None, class_id=None):
+    """
+    Areas and annotator agreement summed over every image with labels.
+
+    An annotator pair's iou is their total intersection over their total union, so bigger
+    regions count for more, and mean_iou is the plain average over the images.
+    """
+    image_ids = [row[0] for row in cur.execute("""
+        SELECT DISTINCT image_id
+        FROM Labels
+        JOIN Images USING(image_id)
+        WHERE NOT labels.deleted AND NOT images.deleted
+        ORDER BY image_id
+        """).fetchall()]
+
+    classes = {}
+    annotators = {}
+    for image_id in image_ids:
+        analytics = image_analytics(cur, image_id, cache)
+        for summary in analytics['classes']:
+            if class_id is not None and summary['class_id'] != class_id:
+                continue
+            total = classes.setdefault(summary['class_id'], {
+                'class_id': summary['class_id'], 'images': 0, 'label_count': 0, 'total_area': 0.0, 'union_area': 0.0})
+            total['images'] += 1
+            for key in ('label_count', 'total_area', 'union_area'):
+                total[key] += summary[key]
+        for pair in analytics['annotators']:
+            if class_id is not None and pair['class_id'] != class_id:
+                continue
+            key = (pair['class_id'], pair['user_a'], pair['user_b'])
+            total = annotators.setdefault(key, {
+                'class_id': pair['class_id'], 'user_a': pair['user_a'], 'user_b': pair['user_b'],
+                'images': 0, 'intersection_area': 0.0, 'union_area': 0.0, 'iou_sum': 0.0})
+            total['images'] += 1
+            total['intersection_area'] += pair['intersection_area']
+            total['union_area'] += pair['union_area']
+            total['iou_sum'] += pair['iou']
+
+    for total in annotators.values():
+        iou_sum = total.pop('iou_sum')
+        total['iou'] = total['intersection_area'] / total['union_area'] if total['union_area'] else 0.0
+        total['mean_iou'] = iou_sum / total['images']
+    return {
+        'images': len(image_ids),
+        'classes': [classes[key] for key in sorted(classes)],
+        'annotators': [annotators[key] for key in sorted(annotators)],
+    }
@@ -1,14 +1,31 @@
+import atexit
 import json
 import os
+import time
 from pathlib import Path
 
-from flask import Flask, render_template, request, g
+from flask import Flask, Response, render_template, request, g, send_file
 from flask_httpauth import HTTPBasicAuth
-import shapely.wkt
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from identify_pii import check_for_pii
+from analytics import AnalyticsCache, dataset_analytics, image_analytics
+from geometry import GEOMETRY_FORMATS, format_geometry, geometry_cache, label_row_to_dict, parse_wkt, to_wkb
+from identify_pii import check_for_pii, lookup_cached_pii, pii_cache
+from audit_log import LOG_METHODS, LOG_OBJECTS, LOG_WRITE_MODES, MAX_LOGS_PAGE, BufferedLogWriter, insert_logs, log_row, parse_cursor, parse_time, query_logs
+from auth_cache import CredentialCache
+from export_dataset import begin_export, export_records
+from db_pool import ConnectionPool
+from image_db.create_db import migrate
+from label_batch import apply_label_batch, label_image_ids, record_revisions
+from label_revisions import label_as_of, label_history, revert_label, revision_to_dict
+from metrics import CacheMetrics, SlowRequestProfiler, TimedConnection, password_seconds, registry, request_seconds
+from pii_engine import PiiEngine
+from pii_jobs import PiiJobQueue
+from spatial_index import index_labels, parse_bbox, query_intersecting, unindex_labels
+from response_cache import ResponseCache, make_etag
+from register_images import IMAGES_DIR, list_image_paths, register_images, resolve_image_path
+from thumbnails import ThumbnailCache, ThumbnailError
 
 
 STATUS_OK = 200
@@ -16,9 +33,58 @@ STATUS_BAD_REQUEST = 400
 STATUS_NOT_FOUND = 404
 STATUS_INTERNAL_ERROR = 500
 
+LABELS_FETCH_SIZE = 500
+
+
+PII_PENDING = 'pending'
+
 
 app = Flask(__name__)
+app.config.setdefault('PII_WORKERS', 2)
+app.config.setdefault('PII_PROCESSES', 0)  # 0 scans in the worker threads, otherwise the size of the OCR process pool
+app.config.setdefault('PII_TIMEOUT', 60)
+app.config.setdefault('DATABASE', str(Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')))
+app.config.setdefault('DB_POOL_SIZE', 8)
+app.config.setdefault('DB_POOL_TIMEOUT', 30)  # seconds to wait for a free connection
+app.config.setdefault('DB_BUSY_TIMEOUT', 30)  # seconds to wait for another writer's lock
+app.config.setdefault('DB_CACHED_STATEMENTS', 256)
+app.config.setdefault('LOG_WRITE_MODE', 'sync')  # sync writes logs in the change's transaction, buffered batches them on a thread
+app.config.setdefault('LOG_FLUSH_INTERVAL', 0.5)  # most seconds a buffered log waits before it's written
+app.config.setdefault('LOG_BATCH_SIZE', 500)
+app.config.setdefault('LOG_MAX_PENDING', 10000)  # buffered logs held before requests wait for the writer
+app.config.setdefault('AUTH_CACHE_SIZE', 1024)
+app.config.setdefault('AUTH_CACHE_TTL', 300)  # seconds a verified password is trusted for, 0 to always check the hash
+app.config.setdefault('ANALYTICS_CACHE_SIZE', 1024)  # images whose label analytics are kept
+app.config.setdefault('RESPONSE_CACHE_SIZE', 4096)  # GET /image and /label responses kept
+app.config.setdefault('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024)
+app.config.setdefault('RESPONSE_CACHE_TTL', 60)  # seconds a response is kept for, 0 to turn the cache off
+app.config.setdefault('IMAGE_MAX_AGE', 3600)  # seconds clients may cache image content and thumbnails for
+app.config.setdefault('THUMBNAIL_DIR', str(Path(__file__).absolute().parent.joinpath('image_db', 'thumbnails')))
+app.config.setdefault('THUMBNAIL_CACHE_BYTES', 256 * 1024 * 1024)
+app.config.setdefault('THUMBNAIL_SIZE', 256)  # default size, in pixels
+app.config.setdefault('THUMBNAIL_MAX_SIZE', 1024)
+app.config.setdefault('METRICS_TIME_SQL', True)  # time every statement on the request connections, for /metrics
+app.config.setdefault('PROFILE_SLOW_REQUESTS', 0)  # seconds, requests slower than this have their cProfile kept. 0 is off
+app.config.setdefault('PROFILE_DIR', str(Path(__file__).absolute().parent.joinpath('image_db', 'profiles')))
 auth = HTTPBasicAuth()
+analytics_cache = None
+credential_cache = None
+log_writer = None
+response_cache = None
+thumbnail_cache = None
+pii_queue = None
+db_pool = None
+slow_request_profiler = None
+
+# hit rates of the caches in use, read when /metrics is scraped
+registry.register(CacheMetrics({
+    'analytics': lambda: analytics_cache,
+    'credential': lambda: credential_cache,
+    'geometry': lambda: geometry_cache,
+    'pii': lambda: pii_cache,
+    'response': lambda: response_cache,
+    'thumbnail': lambda: thumbnail_cache,
+    }))
 
 
 
@@ -29,6 +95,13 @@ def image(image_id=None):
     cur, conn = get_db()
     
     if request.method == "GET":
+        scanned_only = request.args.get('scanned_only', '0') == '1'
+        cache = get_response_cache(cur)
+        cached = cache.get('image', image_id, scanned_only) if cache is not None else None
+        if cached is not None:
+            return etag_response(*cached)
+        generation = cache.generation if cache is not None else None
+
         get_image_query = """SELECT image_id, image_path, contains_pii 
                         FROM Images 
                         WHERE image_id=:image_id
@@ -39,8 +112,15 @@ def image(image_id=None):
         if row is None:
             return json.dumps({'message': 'Image not found'}), STATUS_NOT_FOUND
 
-        # return the image data and success
-        return json.dumps(dict(row)), STATUS_OK
+        # images still waiting on their pii scan can be hidden with ?scanned_only=1
+        if row['contains_pii'] is None and scanned_only:
+            return json.dumps({'message': 'Image has not been scanned for pii yet'}), STATUS_NOT_FOUND
+
+        # return the image data and success. Images still pending aren't cached, as their scan will change them
+        body = json.dumps(image_row_to_dict(row))
+        if cache is not None and row['contains_pii'] is not None:
+            return etag_response(body, cache.put('image', image_id, body, scanned_only, generation))
+        return etag_response(body, make_etag(body))
     
 
     elif request.method == "DELETE":
@@ -58,46 +138,126 @@ def image(image_id=None):
         # log the deletion
         log_success = add_log('Image', 'DELETE', image_id, None)
         conn.commit()
+        invalidate_responses('image', [image_id])
         return json.dumps({'message': 'Image deleted'}), STATUS_OK
 
 
     elif request.method == 'POST':
-        print(request.values)
-
         # To insert a new image into the db, you should copy the image into the 'static/images' directory
         # and use this API to insert it into the db
         image_path = request.values.to_dict()['image_path']
 
-        # check its in static/images
+        # check its an existing file in static/images
         images_dir = Path(__file__).absolute().parent.joinpath('static', 'images')
-        provided_path = Path(images_dir).joinpath(image_path)
-        if not images_dir in provided_path.parents:
-            return json.dumps({'message': 'Image should be in a direcotry within static/images'}), STATUS_BAD_REQUEST
+        provided_path, message = resolve_image_path(image_path, images_dir)
+        if provided_path is None:
+            return json.dumps({'message': message}), STATUS_BAD_REQUEST
 
-        # check this file exists
-        if not provided_path.absolute().exists():
-            return json.dumps({'message': 'Image does not exist at specified path'}), STATUS_BAD_REQUEST
+        # if these exact image bytes have been scanned before, reuse the result
+        contains_pii = lookup_cached_pii(provided_path)
 
-        # check whether it contains pii
-        contains_pii = check_for_pii(provided_path)
-
-        # insert row
+        # insert row. Otherwise contains_pii stays NULL (pending) until the background scan finishes
         rel_image_path = str(provided_path.relative_to(images_dir))
         insert_image_query = """
             INSERT INTO Images (image_path, deleted, contains_pii) 
-            VALUES (':image_path', 0, :contains_pii)
+            VALUES (:image_path, 0, :contains_pii)
             """
-        r = cur.execute(insert_image_query, {'image_path': rel_image_path, 'contains_pii': contains_pii})
+        r = cur.execute(insert_image_query, {
+            'image_path': rel_image_path,
+            'contains_pii': None if contains_pii is None else int(contains_pii)
+            })
 
         # check it worked
         if r.rowcount != 1:
             return json.dumps({'message': 'Problem inserting new image'}), STATUS_INTERNAL_ERROR
         image_id = cur.execute(f"SELECT last_insert_rowid() FROM Images").fetchone()[0]
 
-        # log the update
+        # queue the pii scan if it wasn't cached, and log the update
+        if contains_pii is None:
+            queue = get_pii_queue()
+            queue.enqueue(cur, int(image_id), rel_image_path)
         add_log('Image', 'INSERTION', int(image_id), None)
         conn.commit()
-        return json.dumps({'image_id': image_id}), STATUS_OK
+        invalidate_responses('image', [image_id])
+        if contains_pii is None:
+            queue.notify()
+            return json.dumps({'image_id': image_id, 'contains_pii': PII_PENDING}), STATUS_OK
+        return json.dumps({'image_id': image_id, 'contains_pii': int(contains_pii)}), STATUS_OK
+
+
+@app.route('/image/<int:image_id>/content', methods=["GET"])
+@app.route('/image/<int:image_id>/thumbnail', methods=["GET"])
+@auth.login_required
+def image_content(image_id):
+    cur, conn = get_db()
+
+    row = cur.execute("SELECT image_path FROM Images WHERE image_id=:image_id AND NOT deleted", {'image_id': image_id}).fetchone()
+    if row is None:
+        return json.dumps({'message': 'Image not found'}), STATUS_NOT_FOUND
+    # check the stored path again, so a row written by anything else can't point outside static/images
+    image_path, message = resolve_image_path(row['image_path'], IMAGES_DIR)
+    if image_path is None:
+        return json.dumps({'message': message}), STATUS_NOT_FOUND
+
+    if request.path.endswith('/thumbnail'):
+        try:
+            size = int(request.args.get('size', app.config['THUMBNAIL_SIZE']))
+        except ValueError:
+            size = 0
+        if not 1 <= size <= app.config['THUMBNAIL_MAX_SIZE']:
+            return json.dumps({'message': f'size should be an integer from 1 to {app.config["THUMBNAIL_MAX_SIZE"]}'}), STATUS_BAD_REQUEST
+        try:
+            image_path = get_thumbnail_cache().get(image_path, size)
+        except ThumbnailError as e:
+            return json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+
+    # conditional handles Range, If-None-Match and If-Modified-Since. The file is streamed in blocks
+    response = send_file(image_path, conditional=True, etag=True, max_age=app.config['IMAGE_MAX_AGE'])
+
+    # only the user who authenticated may reuse it, shared caches may not
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+@app.route('/images/bulk', methods=["POST"])
+@auth.login_required
+def images_bulk():
+    cur, conn = get_db()
+    data = request.get_json(silent=True) or request.values.to_dict()
+
+    # register a list of paths, and/or every image in a directory, within static/images
+    image_paths = data.get('image_paths', [])
+    if not isinstance(image_paths, list) or not all(isinstance(path, str) for path in image_paths):
+        return json.dumps({'message': 'image_paths should be a list of paths'}), STATUS_BAD_REQUEST
+    if 'directory' in data:
+        try:
+            image_paths = image_paths + list_image_paths(data['directory'], pattern=data.get('pattern', '*.jpeg'))
+        except ValueError as e:
+            return json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+    if not image_paths:
+        return json.dumps({'message': 'Neither image_paths or directory was provided'}), STATUS_BAD_REQUEST
+
+    # by default scans are left to the background workers, scan=inline does them in this request
+    queue = None if data.get('scan') == 'inline' else get_pii_queue()
+    results = register_images(conn, image_paths, g.user, queue=queue, write_logs=write_logs)
+    invalidate_responses('image', [result['image_id'] for result in results if result['status'] == 'inserted'])
+    inserted = sum(result['status'] == 'inserted' for result in results)
+    return json.dumps({'inserted': inserted, 'failed': len(results) - inserted, 'results': results}), STATUS_OK
+
+
+@app.route('/image/<int:image_id>/pii', methods=["GET"])
+@auth.login_required
+def image_pii_status(image_id):
+    cur, conn = get_db()
+
+    job = get_pii_queue().job_status(cur, image_id)
+    if job is None:
+        return json.dumps({'message': 'No pii scan found for this image'}), STATUS_NOT_FOUND
+
+    if job['contains_pii'] is None:
+        job['contains_pii'] = PII_PENDING
+    return json.dumps(job), STATUS_OK
 
 
 @app.route('/label/<int:label_id>', methods=['GET', 'DELETE', 'PUT'])
@@ -107,8 +267,21 @@ def label(label_id=None):
     cur, conn = get_db()
 
     if request.method == "GET":
+        fmt = request.args.get('format', 'wkt')
+        if fmt not in GEOMETRY_FORMATS:
+            return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+        if 'as_of' in request.args:
+            return label_at_time(label_id, request.args['as_of'], fmt)
+
+        cache = get_response_cache(cur)
+        cached = cache.get('label', label_id, fmt) if cache is not None else None
+        if cached is not None:
+            return etag_response(*cached)
+        generation = cache.generation if cache is not None else None
+
         get_label_query = """
-            SELECT image_id, label_id, image_path, username, first_name, last_name, class_id, geometry
+            SELECT image_id, label_id, image_path, username, first_name, last_name, class_id, geometry,
+                geometry_wkb, version
             FROM Labels 
             JOIN Images USING(image_id) 
             JOIN Users ON labels.labelled_by = users.username 
@@ -120,13 +293,14 @@ def label(label_id=None):
         if row is None:
             return json.dumps({'message': 'Label not found'}), STATUS_NOT_FOUND
 
-        return json.dumps(dict(row))
+        body = json.dumps(label_row_to_dict(row, fmt))
+        return etag_response(body, cache.put('label', label_id, body, fmt, generation) if cache is not None else make_etag(body))
 
 
     elif request.method=='DELETE':
         delete_label_query = """
             UPDATE Labels 
-            SET deleted=1 
+            SET deleted=1, version=version+1
             WHERE label_id=:label_id
             """
         r = cur.execute(delete_label_query, {'label_id': label_id})
@@ -135,9 +309,13 @@ def label(label_id=None):
         if r.rowcount != 1:
             return json.dumps({'message': "Nothing to delete"}), STATUS_NOT_FOUND
 
-        # log and return success
+        # take it out of the spatial index, log and return success
+        unindex_labels(cur, [label_id])
+        record_revisions(cur, [label_id], g.user)
         add_log('Label', 'DELETE', None, int(label_id))
         conn.commit()
+        invalidate_responses('label', [label_id])
+        get_analytics_cache().invalidate(label_image_ids(cur, [label_id]))
         return json.dumps({'message': 'Label deleted'}), STATUS_OK
 
 
@@ -146,20 +324,21 @@ def label(label_id=None):
 
         # ensure geometry is wkt
         try:
-            shapely.wkt.loads(data['geometry'])
-        except shapely.errors.WKTReadingError:
-            return  json.dumps({'message': "Geometry is not a valid wkt"}), STATUS_BAD_REQUEST
+            geom = parse_wkt(data.get('geometry'))
+        except ValueError as e:
+            return  json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
 
         # insert new label
         insert_label_query = """
-            INSERT INTO Labels (image_id, labelled_by, class_id, geometry, deleted) 
-            VALUES (:image_id, :usr, :class_id, :geom, 0)
+            INSERT INTO Labels (image_id, labelled_by, class_id, geometry, geometry_wkb, deleted) 
+            VALUES (:image_id, :usr, :class_id, :geom, :geom_wkb, 0)
             """
         query_data = {
             'image_id': int(data['image_id']), 
             'usr': g.user,
             'class_id': int(data['class_id']),
-            'geom': data['geometry']
+            'geom': data['geometry'],
+            'geom_wkb': to_wkb(geom)
             }
         r = cur.execute(insert_label_query, query_data)
         
@@ -168,9 +347,13 @@ def label(label_id=None):
             return "Problem inserting new label", STATUS_INTERNAL_ERROR
         label_id = cur.execute(f"SELECT last_insert_rowid() FROM Labels").fetchone()[0]
         
-        # log and return success
+        # add it to the spatial index, log and return success
+        index_labels(cur, [(label_id, geom)])
+        record_revisions(cur, [label_id], g.user)
         add_log('Label', 'INSERTION', None, int(label_id))
         conn.commit()
+        invalidate_responses('label', [label_id])
+        get_analytics_cache().invalidate([query_data['image_id']])
         return json.dumps({'label_id': label_id}), STATUS_OK
 
     elif request.method=='PUT':
@@ -180,64 +363,561 @@ def label(label_id=None):
         if ('class_id' not in data) and ('geometry' not in data):
             return json.dumps({'message': 'Neither class_id or geometry was provided'}), STATUS_BAD_REQUEST
 
+        # ensure a new geometry is wkt
+        if 'geometry' in data:
+            try:
+                geom = parse_wkt(data['geometry'])
+            except ValueError as e:
+                return  json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+
         # change class_id and/or geometry if its specified
         # This is not vulnerable to injection attacks, because input is still paramaterised.
+        set_columns = [f'{column}=:{column}' for column in ('class_id', 'geometry') if column in data]
+        if 'geometry' in data:
+            set_columns.append('geometry_wkb=:geometry_wkb')
         update_label_query = f"""
             UPDATE Labels
-            SET 
-            {'class_id=:class_id' if 'class_id' in data.keys() else ''}
-            {'geometry=:geometry' if 'geometry' in data.keys() else ''}
+            SET {', '.join(set_columns)}, version=version+1
             WHERE label_id=:label_id
             """
-        r = cur.execute(update_label_query, {'label_id': label_id, **data})
+        r = cur.execute(update_label_query, {'label_id': label_id, **data,
+            'geometry_wkb': to_wkb(geom) if 'geometry' in data else None})
         
         # ensure something was updated
         if r.rowcount != 1:
             return  json.dumps({'message': "Nothing to update"}), STATUS_NOT_FOUND
 
-        # log and return success
+        # move it in the spatial index, log and return success
+        if 'geometry' in data:
+            index_labels(cur, [(label_id, geom)])
+        record_revisions(cur, [label_id], g.user)
         add_log('Label', 'UPDATE', None, int(label_id))
         conn.commit()
+        invalidate_responses('label', [label_id])
+        get_analytics_cache().invalidate(label_image_ids(cur, [label_id]))
         return  json.dumps({'message': "Label updated"}), STATUS_OK
 
 
-def add_log(obj, method, image_id, label_id):
+def label_at_time(label_id, as_of, fmt):
+    # the label as it was at a past time, with the image and annotator as they are now
+    cur, conn = get_db()
+    try:
+        epoch = parse_time(as_of)
+    except ValueError:
+        return json.dumps({'message': 'as_of should be epoch seconds or an ISO 8601 time'}), STATUS_BAD_REQUEST
+
+    revision = label_as_of(cur, label_id, epoch)
+    if revision is None or revision['deleted']:
+        return json.dumps({'message': 'Label not found at that time'}), STATUS_NOT_FOUND
+    row = cur.execute("""
+        SELECT image_id, image_path, username, first_name, last_name
+        FROM Labels
+        JOIN Images USING(image_id)
+        JOIN Users ON labels.labelled_by = users.username
+        WHERE label_id=:label_id
+        """, {'label_id': label_id}).fetchone()
+    data = dict(row)
+    # like a normal GET, without the label's version
+    data.update(label_id=label_id, class_id=revision['class_id'], geometry=revision_to_dict(revision, fmt)['geometry'])
+    return json.dumps(data), STATUS_OK
+
+
+@app.route('/label/<int:label_id>/history', methods=["GET"])
+@auth.login_required
+def label_history_view(label_id):
+    cur, conn = get_db()
+
+    fmt = request.args.get('format', 'wkt')
+    if fmt not in GEOMETRY_FORMATS:
+        return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+
+    revisions = label_history(cur, label_id)
+    if not revisions:
+        return json.dumps({'message': 'Label not found'}), STATUS_NOT_FOUND
+    return json.dumps({'label_id': label_id, 'revisions': [revision_to_dict(row, fmt) for row in revisions]}), STATUS_OK
+
+
+@app.route('/label/<int:label_id>/revert', methods=["POST"])
+@auth.login_required
+def label_revert(label_id):
+    cur, conn = get_db()
+
+    data = request.get_json(silent=True) or request.values.to_dict()
+    try:
+        version = int(data['version'])
+    except (KeyError, TypeError, ValueError):
+        return json.dumps({'message': 'version should be an integer'}), STATUS_BAD_REQUEST
+
+    try:
+        new_version = revert_label(cur, label_id, version, g.user, write_logs=write_logs)
+    except LookupError as e:
+        return json.dumps({'message': str(e)}), STATUS_NOT_FOUND
+    except ValueError as e:
+        return json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+    conn.commit()
+    invalidate_responses('label', [label_id])
+    get_analytics_cache().invalidate(label_image_ids(cur, [label_id]))
+    return json.dumps({'message': 'Label reverted', 'version': new_version}), STATUS_OK
+
+
+@app.route('/labels', methods=["GET"])
+@app.route('/image/<int:image_id>/labels', methods=["GET"])
+@auth.login_required
+def labels(image_id=None):
     cur, conn = get_db()
 
-    insert_log_query = """
-        INSERT INTO Logs (object, updated_by, method, image_id, label_id, modified_at) 
-        VALUES (:obj, :usr, :method, :im_id, :lab_id, datetime('now', 'localtime'))
+    if image_id is not None:
+        row = cur.execute("SELECT 1 FROM Images WHERE image_id=:image_id AND NOT deleted", {'image_id': image_id}).fetchone()
+        if row is None:
+            return json.dumps({'message': 'Image not found'}), STATUS_NOT_FOUND
+
+    # build up the filters. Results are in label_id order, and `after` is the last label_id already seen
+    args = request.args
+    try:
+        params = {
+            'image_id': image_id if image_id is not None else (int(args['image_id']) if 'image_id' in args else None),
+            'class_id': int(args['class_id']) if 'class_id' in args else None,
+            'labelled_by': args.get('labelled_by'),
+            'after': int(args.get('after', 0)),
+            'limit': int(args.get('limit', -1)),
+            }
+    except ValueError:
+        return json.dumps({'message': 'image_id, class_id, after and limit should be integers'}), STATUS_BAD_REQUEST
+    deleted = args.get('deleted', '0')
+    if deleted not in ('0', '1', 'all'):
+        return json.dumps({'message': 'deleted should be 0, 1 or all'}), STATUS_BAD_REQUEST
+    fmt = args.get('format', 'wkt')
+    if fmt not in GEOMETRY_FORMATS:
+        return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+
+    conditions = ['label_id > :after']
+    for column in ('image_id', 'class_id', 'labelled_by'):
+        if params[column] is not None:
+            conditions.append(f'labels.{column}=:{column}')
+    if deleted != 'all':
+        conditions.append('labels.deleted' if deleted == '1' else 'NOT labels.deleted')
+
+    # This is not vulnerable to injection attacks, because input is still paramaterised.
+    get_labels_query = f"""
+        SELECT image_id, label_id, image_path, username, first_name, last_name, class_id, geometry, labels.deleted,
+            geometry_wkb, version
+        FROM Labels 
+        JOIN Images USING(image_id) 
+        JOIN Users ON labels.labelled_by = users.username 
+        WHERE {' AND '.join(conditions)}
+        ORDER BY label_id
+        LIMIT :limit
         """
-    log_data = {
-        'obj': obj,
-        'usr': g.user, 
-        'method': method, 
-        'im_id': image_id, 
-        'lab_id': label_id
-        }
-    r = cur.execute(insert_log_query, log_data)
-    
+
+    label_cur = cur.execute(get_labels_query, params)
+
+    def generate_labels():
+        # stream one json object per line, rather than building the whole response in memory
+        while True:
+            rows = label_cur.fetchmany(LABELS_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield json.dumps(label_row_to_dict(row, fmt)) + '\n'
+
+    # the response outlives the request, so it takes over the connection
+    response = Response(generate_labels(), status=STATUS_OK, mimetype='application/x-ndjson')
+    detach_db(response)
+    return response
+
+
+@app.route('/export', methods=["GET"])
+@auth.login_required
+def export():
+    cur, conn = get_db()
+
+    try:
+        since_log_id = int(request.args['since_log_id']) if 'since_log_id' in request.args else None
+    except ValueError:
+        return json.dumps({'message': 'since_log_id should be an integer'}), STATUS_BAD_REQUEST
+    fmt = request.args.get('format', 'wkt')
+    if fmt not in GEOMETRY_FORMATS:
+        return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+
+    # the whole export reads one snapshot, and the connection stays with the response until it's done
+    log_id = begin_export(conn)
+
+    def generate_records():
+        for record in export_records(conn, since_log_id, fmt=fmt):
+            yield json.dumps(record) + '\n'
+
+    # the log_id to pass as since_log_id next time is in a header, as the body is only records
+    response = Response(generate_records(), status=STATUS_OK, mimetype='application/x-ndjson')
+    response.headers['X-Export-Log-Id'] = str(log_id)
+    # releasing the connection rolls back the snapshot, even if the body was never read, so it doesn't hold back wal checkpoints
+    detach_db(response)
+    return response
+
+
+@app.route('/logs', methods=["GET"])
+@auth.login_required
+def logs():
+    cur, conn = get_db()
+
+    args = request.args
+    try:
+        params = {
+            'image_id': int(args['image_id']) if 'image_id' in args else None,
+            'label_id': int(args['label_id']) if 'label_id' in args else None,
+            'limit': int(args.get('limit', 100)),
+            }
+    except ValueError:
+        return json.dumps({'message': 'image_id, label_id and limit should be integers'}), STATUS_BAD_REQUEST
+    if not 1 <= params['limit'] <= MAX_LOGS_PAGE:
+        return json.dumps({'message': f'limit should be from 1 to {MAX_LOGS_PAGE}'}), STATUS_BAD_REQUEST
+    try:
+        # times are either epoch seconds or ISO 8601, which is UTC unless it has an offset
+        for name in ('since', 'until'):
+            params[name] = parse_time(args[name]) if name in args else None
+    except ValueError:
+        return json.dumps({'message': 'since and until should be epoch seconds or ISO 8601 times'}), STATUS_BAD_REQUEST
+    try:
+        params['cursor'] = parse_cursor(args['cursor']) if 'cursor' in args else None
+    except ValueError as e:
+        return json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+    if args.get('object', LOG_OBJECTS[0]) not in LOG_OBJECTS:
+        return json.dumps({'message': f'object should be one of {", ".join(LOG_OBJECTS)}'}), STATUS_BAD_REQUEST
+    if args.get('method', LOG_METHODS[0]) not in LOG_METHODS:
+        return json.dumps({'message': f'method should be one of {", ".join(LOG_METHODS)}'}), STATUS_BAD_REQUEST
+    if args.get('order', 'asc') not in ('asc', 'desc'):
+        return json.dumps({'message': 'order should be asc or desc'}), STATUS_BAD_REQUEST
+
+    results, next_cursor = query_logs(cur, updated_by=args.get('username'), obj=args.get('object'),
+        method=args.get('method'), descending=args.get('order') == 'desc', **params)
+    return json.dumps({'logs': results, 'next_cursor': next_cursor}), STATUS_OK
+
+
+@app.route('/image/<int:image_id>/labels/intersecting', methods=["GET"])
+@auth.login_required
+def labels_intersecting(image_id):
+    cur, conn = get_db()
+
+    row = cur.execute("SELECT 1 FROM Images WHERE image_id=:image_id AND NOT deleted", {'image_id': image_id}).fetchone()
+    if row is None:
+        return json.dumps({'message': 'Image not found'}), STATUS_NOT_FOUND
+
+    # the region is either a bbox or any wkt geometry
+    try:
+        if 'bbox' in request.args:
+            region = parse_bbox(request.args['bbox'])
+        elif 'geometry' in request.args:
+            region = parse_wkt(request.args['geometry'])
+        else:
+            return json.dumps({'message': 'Neither bbox or geometry was provided'}), STATUS_BAD_REQUEST
+        class_id = int(request.args['class_id']) if 'class_id' in request.args else None
+    except ValueError as e:
+        return json.dumps({'message': str(e)}), STATUS_BAD_REQUEST
+    if region.is_empty:
+        return json.dumps({'message': 'Region is empty'}), STATUS_BAD_REQUEST
+    fmt = request.args.get('format', 'wkt')
+    if fmt not in GEOMETRY_FORMATS:
+        return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+
+    matches = query_intersecting(cur, image_id, region, class_id=class_id)
+    return Response(''.join(json.dumps(label_row_to_dict(row, fmt)) + '\n' for row in matches),
+        status=STATUS_OK, mimetype='application/x-ndjson')
+
+
+@app.route('/labels/batch', methods=["POST"])
+@auth.login_required
+def labels_batch():
+    cur, conn = get_db()
+
+    # accepts either a list of operations, or {"operations": [...], "mode": ...}
+    data = request.get_json(silent=True)
+    mode = request.args.get('mode', 'atomic')
+    if isinstance(data, dict):
+        mode = data.get('mode', mode)
+        data = data.get('operations')
+    if not isinstance(data, list):
+        return json.dumps({'message': 'Expected a json list of label operations'}), STATUS_BAD_REQUEST
+    if mode not in ('atomic', 'best_effort'):
+        return json.dumps({'message': 'mode should be atomic or best_effort'}), STATUS_BAD_REQUEST
+
+    results, applied = apply_label_batch(conn, data, g.user, atomic=(mode == 'atomic'), write_logs=write_logs)
+    if not applied:
+        return json.dumps({'message': 'Batch contains invalid operations, nothing was applied', 'results': results}), STATUS_BAD_REQUEST
+    label_ids = [result['label_id'] for result in results if result['status'] == 'ok']
+    invalidate_responses('label', label_ids)
+    get_analytics_cache().invalidate(label_image_ids(cur, label_ids))
+    return json.dumps({'results': results}), STATUS_OK
+
+
+@app.route('/image/<int:image_id>/analytics', methods=["GET"])
+@app.route('/image/<int:image_id>/analytics/geometry', methods=["GET"])
+@auth.login_required
+def image_analytics_view(image_id):
+    cur, conn = get_db()
+
+    row = cur.execute("SELECT 1 FROM Images WHERE image_id=:image_id AND NOT deleted", {'image_id': image_id}).fetchone()
+    if row is None:
+        return json.dumps({'message': 'Image not found'}), STATUS_NOT_FOUND
+    try:
+        class_id = int(request.args['class_id']) if 'class_id' in request.args else None
+    except ValueError:
+        return json.dumps({'message': 'class_id should be an integer'}), STATUS_BAD_REQUEST
+    fmt = request.args.get('format', 'wkt')
+    if fmt not in GEOMETRY_FORMATS:
+        return json.dumps({'message': f'format should be one of {", ".join(GEOMETRY_FORMATS)}'}), STATUS_BAD_REQUEST
+
+    analytics = image_analytics(cur, image_id, get_analytics_cache())
+    classes = [summary for summary in analytics['classes'] if class_id in (None, summary['class_id'])]
+
+    if request.path.endswith('/geometry'):
+        # the union of every label of each class, and the region every annotator agrees on
+        return json.dumps({'image_id': image_id, 'classes': [{
+            'class_id': summary['class_id'],
+            'union': format_geometry(summary['union'], fmt),
+            'union_area': summary['union_area'],
+            'intersection': format_geometry(summary['intersection'], fmt),
+            'intersection_area': summary['intersection_area'],
+            } for summary in classes]}), STATUS_OK
+
+    return json.dumps({
+        'image_id': image_id,
+        'labels': [label for label in analytics['labels'] if class_id in (None, label['class_id'])],
+        'classes': [{key: value for key, value in summary.items() if key not in ('union', 'intersection')}
+            for summary in classes],
+        'pairs': [pair for pair in analytics['pairs'] if class_id in (None, pair['class_a'], pair['class_b'])],
+        'annotators': [pair for pair in analytics['annotators'] if class_id in (None, pair['class_id'])],
+        'skipped': analytics['skipped'],
+        }), STATUS_OK
+
+
+@app.route('/analytics', methods=["GET"])
+@auth.login_required
+def dataset_analytics_view():
+    cur, conn = get_db()
+
+    try:
+        class_id = int(request.args['class_id']) if 'class_id' in request.args else None
+    except ValueError:
+        return json.dumps({'message': 'class_id should be an integer'}), STATUS_BAD_REQUEST
+
+    # each image's analytics come from the cache unless its labels have changed
+    return json.dumps(dataset_analytics(cur, get_analytics_cache(), class_id=class_id)), STATUS_OK
+
+
+@app.route('/metrics', methods=["GET"])
+@auth.login_required
+def metrics():
+    # Prometheus text format. Every process counts its own requests, so scrape each one
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def image_row_to_dict(row):
+    # contains_pii is NULL while the background scan is outstanding
+    data = dict(row)
+    if data['contains_pii'] is None:
+        data['contains_pii'] = PII_PENDING
+    return data
+
+
+def etag_response(body, etag):
+    # clients may keep the response, but must check it's still current. A matching If-None-Match gets a 304
+    response = app.make_response((body, STATUS_OK))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def add_log(obj, method, image_id, label_id):
+    cur, conn = get_db()
+    write_logs(cur, [log_row(obj, g.user, method, image_id, label_id)])
+
+
+def write_logs(cur, rows):
+    # every log a request writes goes through here, so LOG_WRITE_MODE applies to all of them
+    if app.config['LOG_WRITE_MODE'] == 'buffered':
+        # handed to the log writer once the request has finished without an error, see cleanup
+        g.setdefault('pending_logs', []).extend(rows)
+        return
+
+    insert_logs(cur, rows)
+
     # ensure it logged properly. Otherwise raise error, will which return 500
-    if r.rowcount != 1:
+    if cur.rowcount != len(rows):
         raise ValueError('Logging was unsucessful')
 
 
+def get_log_writer():
+    global log_writer
+    if log_writer is None:
+        if app.config['LOG_WRITE_MODE'] not in LOG_WRITE_MODES:
+            raise ValueError(f'LOG_WRITE_MODE should be one of {", ".join(LOG_WRITE_MODES)}')
+        log_writer = BufferedLogWriter(app.config['DATABASE'], flush_interval=app.config['LOG_FLUSH_INTERVAL'],
+            batch_size=app.config['LOG_BATCH_SIZE'], max_pending=app.config['LOG_MAX_PENDING'])
+        # write whatever is still buffered when the server stops
+        atexit.register(log_writer.close)
+    return log_writer
+
+
+def get_pii_queue():
+    global pii_queue
+    if pii_queue is None:
+        # only create the queue once per process, its worker threads are shared by every request
+        num_workers = app.config['PII_WORKERS']
+        scanner = check_for_pii
+        if app.config['PII_PROCESSES']:
+            # hand the OCR to a process pool, with one feeding thread per process so every core is busy
+            num_workers = app.config['PII_PROCESSES']
+            scanner = PiiEngine(num_workers=num_workers, timeout=app.config['PII_TIMEOUT']).check
+        pii_queue = PiiJobQueue(
+            db_path=app.config['DATABASE'],
+            images_dir=Path(__file__).absolute().parent.joinpath('static', 'images'),
+            num_workers=num_workers,
+            scanner=scanner,
+            # the verdicts are written outside any request, straight to the log writer when logs are buffered
+            log_writer=get_log_writer() if app.config['LOG_WRITE_MODE'] == 'buffered' else None)
+        # start straight away, so jobs left pending or running by the previous process are picked up
+        pii_queue.start()
+    return pii_queue
+
+
+def get_analytics_cache():
+    global analytics_cache
+    if analytics_cache is None:
+        analytics_cache = AnalyticsCache(max_entries=app.config['ANALYTICS_CACHE_SIZE'])
+    return analytics_cache
+
+
+def get_thumbnail_cache():
+    global thumbnail_cache
+    if thumbnail_cache is None:
+        thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_DIR'], max_bytes=app.config['THUMBNAIL_CACHE_BYTES'])
+    return thumbnail_cache
+
+
+def get_response_cache(cur=None):
+    # pass a cursor to first drop anything written since the cache last checked
+    global response_cache
+    if response_cache is None and app.config['RESPONSE_CACHE_TTL'] > 0:
+        response_cache = ResponseCache(max_entries=app.config['RESPONSE_CACHE_SIZE'],
+            max_bytes=app.config['RESPONSE_CACHE_BYTES'], ttl=app.config['RESPONSE_CACHE_TTL'])
+    if response_cache is not None and cur is not None:
+        response_cache.sync(cur)
+    return response_cache
+
+
+def invalidate_responses(kind, keys):
+    # call once the write is committed, so later requests read the new row
+    cache = get_response_cache()
+    if cache is not None:
+        cache.invalidate(kind, keys)
+
+
+def get_credential_cache():
+    global credential_cache
+    if credential_cache is None and app.config['AUTH_CACHE_TTL'] > 0:
+        credential_cache = CredentialCache(max_entries=app.config['AUTH_CACHE_SIZE'], ttl=app.config['AUTH_CACHE_TTL'])
+    return credential_cache
+
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        # every new connection checks the db is on the latest schema, which is a no-op once it is
+        db_pool = ConnectionPool(
+            app.config['DATABASE'],
+            size=app.config['DB_POOL_SIZE'],
+            timeout=app.config['DB_POOL_TIMEOUT'],
+            busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+            cached_statements=app.config['DB_CACHED_STATEMENTS'],
+            on_connect=migrate,
+            factory=TimedConnection if app.config['METRICS_TIME_SQL'] else sqlite3.Connection)
+    return db_pool
+
+
 def get_db():
-    db_path = str(Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite'))
     if not hasattr(g, 'conn'):
-        # only open new connection if it doesn't already exist. Otherwise return existing
-        g.conn = sqlite3.connect(db_path)
-        g.conn.row_factory = sqlite3.Row
+        # only check out a connection if this request doesn't already have one. Otherwise return existing
+        g.conn = get_db_pool().acquire()
         g.cur = g.conn.cursor()
     return g.cur, g.conn
 
 
+def detach_db(response):
+    """
+    Hand the request's connection to a streamed response, which releases it once the server
+    closes the response. That happens even for a HEAD request or a body that's dropped unread,
+    where the response's generator never runs, so it can't be left to a finally block there.
+    """
+    g.pop('cur', None)
+    conn = g.pop('conn', None)
+    if conn is not None:
+        response.call_on_close(lambda: release_db(conn))
+    return conn
+
+
+def release_db(conn):
+    get_db_pool().release(conn)
+
+
+def get_slow_request_profiler():
+    global slow_request_profiler
+    if slow_request_profiler is None and app.config['PROFILE_SLOW_REQUESTS'] > 0:
+        slow_request_profiler = SlowRequestProfiler(app.config['PROFILE_SLOW_REQUESTS'], app.config['PROFILE_DIR'])
+    return slow_request_profiler
+
+
+@app.before_request
+def start_pii_queue():
+    # resume any outstanding scans with the first request, rather than waiting for a new image
+    get_pii_queue()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    profiler = get_slow_request_profiler()
+    if profiler is not None:
+        g.profiler = profiler.start()
+
+
+@app.after_request
+def observe_request(response):
+    # streamed bodies are still to be sent, so they're timed up to their first byte
+    finish_request_timer(str(response.status_code))
+    return response
+
+
+def finish_request_timer(status):
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_seconds.observe(elapsed, route, request.method, status)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        get_slow_request_profiler().stop(profiler, elapsed, f'{request.method} {route}')
+
+
+@app.teardown_request
+def observe_failed_request(error):
+    # requests whose exception was propagated never reached observe_request
+    if error is not None:
+        finish_request_timer('500')
+
+
 @app.teardown_appcontext
 def cleanup(error):
-    # close db connection and clear g variables
+    # the request's changes are committed by now, unless it failed
+    pending_logs = g.pop('pending_logs', None)
+    if pending_logs and error is None:
+        get_log_writer().write(pending_logs)
+
+    # return db connection to the pool and clear g variables
     if hasattr(g, 'conn'):
-        g.conn.close()
+        release_db(g.conn)
     g.pop('conn', None)
+    g.pop('cur', None)
     g.pop('user', None)
 
 
@@ -245,7 +925,7 @@ def cleanup(error):
 @auth.verify_password
 def verify_password(username, password):
     # don't allow anonymous users
-    if username is '':
+    if not username:
         return False
 
     # get pwd hash from db
@@ -260,8 +940,18 @@ def verify_password(username, password):
         return False
     pwd_hash = result[0]
 
+    # skip the slow hash check if this password was verified recently. A changed pwd_hash won't match
+    cache = get_credential_cache()
+    if cache is not None and cache.check(username, password, pwd_hash):
+        g.user = username
+        return True
+
     # validate it against hash
-    if check_password_hash(pwd_hash, password):
+    with password_seconds.time():
+        valid = check_password_hash(pwd_hash, password)
+    if valid:
+        if cache is not None:
+            cache.add(username, password, pwd_hash)
         g.user = username
         return True
     return False
@@ -0,0 +1,14 @@
+from a2wsgi import WSGIMiddleware
+
+from app import app as flask_app
+
+
+flask_app.config.setdefault('ASGI_THREADS', 32)  # requests handled at once, the rest wait on the event loop
+
+# a compatibility shim, not a faster way to run the app. Each request still runs the synchronous Flask handler on a thread
+app = WSGIMiddleware(flask_app, workers=flask_app.config['ASGI_THREADS'])
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=8000, log_level='warning')
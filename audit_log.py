@@ -0,0 +1,202 @@
+import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from db_pool import connect
+
+
+LOG_WRITE_MODES = ('sync', 'buffered')
+LOG_OBJECTS = ('Image', 'Label')
+LOG_METHODS = ('INSERTION', 'UPDATE', 'DELETE')
+MAX_LOGS_PAGE = 1000
+
+logger = logging.getLogger(__name__)
+
+# modified_at stays local time text, for anything which already reads it. modified_at_epoch is
+# seconds since the epoch in UTC, which is what the logs are queried by
+INSERT_LOGS_QUERY = """
+    INSERT INTO Logs (object, updated_by, method, image_id, label_id, modified_at, modified_at_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+
+
+def log_row(obj, username, method, image_id, label_id, now=None):
+    # a row for INSERT_LOGS_QUERY, timestamped when the change was made rather than when it's written
+    now = time.time() if now is None else now
+    modified_at = datetime.datetime.fromtimestamp(int(now)).strftime('%Y-%m-%d %H:%M:%S')
+    return (obj, username, method, image_id, label_id, modified_at, int(now))
+
+
+def insert_logs(cur, rows):
+    cur.executemany(INSERT_LOGS_QUERY, rows)
+
+
+def parse_time(value):
+    """
+    A query time as UTC epoch seconds, from either epoch seconds or an ISO 8601 time. ISO times
+    without a timezone are taken to be UTC. Raises ValueError for anything else.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return int(when.timestamp())
+
+
+def parse_cursor(cursor):
+    # the cursor is the (modified_at_epoch, log_id) of the last log already seen
+    try:
+        epoch, log_id = cursor.split(':')
+        return int(epoch), int(log_id)
+    except (AttributeError, ValueError):
+        raise ValueError('cursor should be one returned by a previous request')
+
+
+def query_logs(cur, updated_by=None, obj=None, method=None, image_id=None, label_id=None, since=None,
+        until=None, cursor=None, limit=100, descending=False):
+    """
+    A page of logs, in order of (modified_at_epoch, log_id), and the cursor for the next page,
+    which is None once there are no more. `since` is inclusive and `until` exclusive, both in
+    UTC epoch seconds. Paging continues from the cursor's key, so pages stay fast however deep
+    they go, and logs written meanwhile don't shift later pages.
+    """
+    conditions = ['modified_at_epoch IS NOT NULL']
+    params = {'limit': limit}
+    for column, value in (('updated_by', updated_by), ('object', obj), ('method', method),
+            ('image_id', image_id), ('label_id', label_id)):
+        if value is not None:
+            conditions.append(f'{column}=:{column}')
+            params[column] = value
+    if since is not None:
+        conditions.append('modified_at_epoch >= :since')
+        params['since'] = since
+    if until is not None:
+        conditions.append('modified_at_epoch < :until')
+        params['until'] = until
+    if cursor is not None:
+        conditions.append(f'(modified_at_epoch, log_id) {"<" if descending else ">"} (:cursor_epoch, :cursor_log_id)')
+        params['cursor_epoch'], params['cursor_log_id'] = cursor
+    order = 'DESC' if descending else 'ASC'
+
+    # This is not vulnerable to injection attacks, because input is still paramaterised.
+    rows = cur.execute(f"""
+        SELECT log_id, object, updated_by, method, image_id, label_id, modified_at_epoch
+        FROM Logs
+        WHERE {' AND '.join(conditions)}
+        ORDER BY modified_at_epoch {order}, log_id {order}
+        LIMIT :limit
+        """, params).fetchall()
+
+    logs = []
+    for row in rows:
+        log = dict(row)
+        log['modified_at'] = datetime.datetime.fromtimestamp(row['modified_at_epoch'], datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        logs.append(log)
+    next_cursor = f"{rows[-1]['modified_at_epoch']}:{rows[-1]['log_id']}" if len(rows) == limit else None
+    return logs, next_cursor
+
+
+class BufferedLogWriter:
+    """
+    Writes log rows on a background thread, in batches, so requests don't wait on them.
+
+    Rows are flushed once `batch_size` have built up, or `flush_interval` seconds after the
+    first of a batch was written, in one transaction per batch. A batch which can't be written
+    is retried up to `max_retries` times, then dropped with an error logged. This trades
+    durability for speed: a log is only committed after the change it records, and any rows
+    still buffered when the process dies are lost. `max_pending` bounds the buffer, and
+    writers wait up to `put_timeout` seconds for room before their rows are dropped too.
+    `flush` waits until everything written so far is committed or dropped.
+    """
+    def __init__(self, db_path, flush_interval=0.5, batch_size=500, max_pending=10000, retry_interval=1.0,
+            max_retries=5, put_timeout=5.0):
+        self.db_path = str(db_path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.put_timeout = put_timeout
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, rows):
+        if self._closed:
+            raise RuntimeError('Log writer is closed')
+        for i, row in enumerate(rows):
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+            except queue.Full:
+                # the writer has fallen too far behind, don't hold the request up any longer
+                self.dropped += len(rows) - i
+                logger.error('Log writer is full, dropped %d logs', len(rows) - i)
+                return
+
+    def flush(self, timeout=None):
+        # returns False if rows were still outstanding after timeout seconds
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def close(self, timeout=10.0):
+        # write everything still buffered, then stop the thread
+        if not self._closed:
+            self._closed = True
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                logger.error('Log writer did not stop, %d logs are still buffered', self._queue.qsize())
+                return
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error('Log writer did not stop, %d logs are still buffered', self._queue.qsize())
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, conn, rows):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with conn:
+                    insert_logs(conn.cursor(), rows)
+                self.batches += 1
+                return
+            except sqlite3.Error:
+                self.failures += 1
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_interval)
+        # give up rather than block every writer behind this batch
+        self.dropped += len(rows)
+        logger.error('Could not write %d logs after %d attempts, dropping them', len(rows), self.max_retries + 1)
+
+    def _run(self):
+        conn = connect(self.db_path)
+        try:
+            while True:
+                batch = self._next_batch()
+                rows = [row for row in batch if row is not None]
+                if rows:
+                    self._write_batch(conn, rows)
+                for _ in batch:
+                    self._queue.task_done()
+                if len(rows) < len(batch):
+                    return
+        finally:
+            conn.close()
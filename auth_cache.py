@@ -0,0 +1,59 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CredentialCache:
+    """
+    Remembers which username/password pairs have recently been verified, so the slow password
+    hash only has to be checked once per `ttl` seconds.
+
+    Passwords are never stored, only an HMAC of them under a key that only lives in this
+    process. Entries are also tied to the pwd_hash they were checked against, so changing a
+    user's password makes their old entries miss straight away.
+    """
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()  # username -> (digest, pwd_hash, expiry)
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, f'{username}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def check(self, username, password, pwd_hash):
+        # True if this exact password was verified against this pwd_hash recently
+        digest = self._digest(username, password)
+        with self._lock:
+            entry = self._entries.get(username)
+            if (entry is not None and entry[1] == pwd_hash and entry[2] > time.monotonic()
+                    and hmac.compare_digest(entry[0], digest)):
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, username, password, pwd_hash):
+        # only call this once the password has been verified
+        entry = (self._digest(username, password), pwd_hash, time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[username] = entry
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username=None):
+        # forget one user, or everyone
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
@@ -0,0 +1,196 @@
+"""
+Benchmark every /image and /label verb, and the per-image cost of check_for_pii.
+
+Builds a synthetic db with create_db.create_synthetic_db, unless one is given with --db, and
+sends requests to the app in this process through Flask's test client, so the numbers are the
+app's own cost without the network or a server in front of it (load_test.py covers those).
+Reads are spread over random ids, so most miss the response cache. Each endpoint gets
+`--requests` requests, one at a time, and reports its throughput and latency percentiles.
+
+check_for_pii is timed on each image in static/images, without the result cache, and again
+once its verdict is cached. Without tesseract the scan gives up before OCR, which is noted in
+the results.
+
+    python benchmarks/bench_api.py --images 10000 --labels 100000 --json > run.json
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from app import app
+from identify_pii import check_for_pii
+from image_db.create_db import create_synthetic_db, find_images, random_multipolygons
+from pii_cache import PiiCache
+
+
+ROOT = Path(__file__).absolute().parent.parent
+IMAGES_DIR = ROOT.joinpath('static', 'images')
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(name, latencies, errors):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        'name': name,
+        'requests': len(latencies),
+        'requests/sec': len(latencies) / total if total else None,
+        'p50 (ms)': statistics.median(latencies) * 1000 if latencies else None,
+        'p95 (ms)': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99 (ms)': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'errors': errors,
+    }
+
+
+def time_requests(client, name, requests, headers):
+    # requests is a list of (method, path, form data). Returns the summary and the json bodies
+    latencies = []
+    errors = {}
+    bodies = []
+    for method, path, data in requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data, headers=headers)
+        body = response.get_data()
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+        bodies.append(body)
+    return summarize(name, latencies, errors), bodies
+
+
+def bench_api(db_path, n, rng, username, password):
+    # the db is opened on the first request, so it can still be swapped
+    app.config['DATABASE'] = str(db_path)
+    client = app.test_client()
+    headers = {'Authorization': 'Basic ' + base64.b64encode(f'{username}:{password}'.encode()).decode()}
+
+    conn = sqlite3.connect(db_path)
+    image_ids = [row[0] for row in conn.execute('SELECT image_id FROM Images WHERE NOT deleted')]
+    label_ids = [row[0] for row in conn.execute('SELECT label_id FROM Labels WHERE NOT deleted')]
+    class_ids = [row[0] for row in conn.execute('SELECT class_id FROM Classes')]
+    conn.close()
+    image_paths = [str(path) for path in find_images(IMAGES_DIR)]
+
+    # warm the db pool and credential cache
+    client.get(f'/image/{image_ids[0]}', headers=headers)
+
+    # geometries for the labels posted and put
+    geometries = iter(shapely.to_wkt(random_multipolygons(np.random.default_rng(rng.getrandbits(64)), 2 * n), rounding_precision=1).tolist())
+    results = []
+
+    def run(name, requests):
+        return time_requests(client, name, requests, headers)
+
+    result, _ = run('GET /image/<id>', [('GET', f'/image/{rng.choice(image_ids)}', None) for _ in range(n)])
+    results.append(result)
+    result, _ = run('GET /label/<id>', [('GET', f'/label/{rng.choice(label_ids)}', None) for _ in range(n)])
+    results.append(result)
+
+    # new rows are written, then deleted, so the dataset ends up as it started
+    result, bodies = run('POST /image', [('POST', '/image', {'image_path': rng.choice(image_paths)}) for _ in range(n)])
+    results.append(result)
+    new_image_ids = [json.loads(body)['image_id'] for body in bodies if b'image_id' in body]
+    result, bodies = run('POST /label', [('POST', '/label', {
+        'image_id': rng.choice(image_ids), 'class_id': rng.choice(class_ids), 'geometry': next(geometries)})
+        for _ in range(n)])
+    results.append(result)
+    new_label_ids = [json.loads(body)['label_id'] for body in bodies if b'label_id' in body]
+
+    result, _ = run('PUT /label/<id>', [('PUT', f'/label/{rng.choice(label_ids)}', rng.choice([
+        {'class_id': rng.choice(class_ids)}, {'geometry': next(geometries)}])) for _ in range(n)])
+    results.append(result)
+    result, _ = run('DELETE /label/<id>', [('DELETE', f'/label/{label_id}', None) for label_id in new_label_ids])
+    results.append(result)
+    result, _ = run('DELETE /image/<id>', [('DELETE', f'/image/{image_id}', None) for image_id in new_image_ids])
+    results.append(result)
+    return results
+
+
+def bench_pii(repeats, cache_dir):
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        tesseract = True
+    except Exception:
+        tesseract = False
+
+    cache = PiiCache(Path(cache_dir).joinpath('pii_cache.sqlite'))
+    results = []
+    for image_path in find_images(IMAGES_DIR):
+        path = IMAGES_DIR.joinpath(image_path)
+        uncached = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            check_for_pii(path, cache=None)
+            uncached.append(time.perf_counter() - start)
+        check_for_pii(path, cache=cache)
+        cached = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            check_for_pii(path, cache=cache)
+            cached.append(time.perf_counter() - start)
+        results.append({
+            'image': str(image_path),
+            'uncached p50 (ms)': statistics.median(uncached) * 1000,
+            'uncached max (ms)': max(uncached) * 1000,
+            'cached p50 (ms)': statistics.median(cached) * 1000,
+        })
+    return {'tesseract': tesseract, 'images': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=1000, help='synthetic images to generate')
+    parser.add_argument('--labels', type=int, default=10000, help='synthetic labels to generate')
+    parser.add_argument('--db', help='benchmark an existing db instead of generating one. It is written to')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--pii-repeats', type=int, default=3, help='times check_for_pii is run on each image')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--username', default='rock_god_9000')
+    parser.add_argument('--password', default='voodoochild')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db
+        setup = {}
+        if db_path is None:
+            db_path = os.path.join(tmp_dir, 'bench.sqlite')
+            summary = create_synthetic_db(db_path, args.images, args.labels, seed=args.seed)
+            setup = {'images': args.images, 'labels': args.labels, 'seed': args.seed,
+                'generate (s)': summary['seconds'], 'generate (rows/sec)': summary['rows/sec']}
+
+        api = bench_api(db_path, args.requests, random.Random(args.seed), args.username, args.password)
+        pii = bench_pii(args.pii_repeats, tmp_dir)
+
+    results = {'db': args.db, **setup, 'requests per endpoint': args.requests, 'api': api, 'check_for_pii': pii}
+    if args.json:
+        print(json.dumps(results))
+    else:
+        if setup:
+            print(f"{setup['images']} images and {setup['labels']} labels, generated in {setup['generate (s)']:.1f}s "
+                f"({setup['generate (rows/sec)']:.0f} rows/sec)\n")
+        print(f"{'endpoint':<20} {'requests':>9} {'req/sec':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}  errors")
+        for result in api:
+            print(f"{result['name']:<20} {result['requests']:>9} {result['requests/sec'] or 0:>9.0f} {result['p50 (ms)'] or 0:>9.2f} "
+                f"{result['p95 (ms)'] or 0:>9.2f} {result['p99 (ms)'] or 0:>9.2f}  {result['errors'] or ''}")
+        print(f"\ncheck_for_pii{'' if pii['tesseract'] else ' (tesseract is not installed, so nothing is OCRed)'}")
+        print(f"{'image':<32} {'uncached p50 (ms)':>18} {'uncached max (ms)':>18} {'cached p50 (ms)':>16}")
+        for result in pii['images']:
+            print(f"{result['image']:<32} {result['uncached p50 (ms)']:>18.1f} {result['uncached max (ms)']:>18.1f} "
+                f"{result['cached p50 (ms)']:>16.2f}")
@@ -0,0 +1,137 @@
+"""
+Compare the hot query paths before and after the schema migrations add their indexes.
+
+Builds a throwaway db with the version 0 schema, fills it with synthetic rows, and times each
+query (with its query plan) first on the unindexed tables, then again after migrate().
+
+    python benchmarks/bench_indexes.py --labels 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from image_db.create_db import create_tables, migrate
+
+
+LOGS_START = datetime.datetime(2020, 1, 1)
+
+QUERIES = {
+    'label by image': """
+        SELECT image_id, label_id, image_path, username, first_name, last_name, class_id, geometry
+        FROM Labels
+        JOIN Images USING(image_id)
+        JOIN Users ON labels.labelled_by = users.username
+        WHERE labels.image_id=:image_id
+        AND NOT labels.deleted
+        ORDER BY label_id
+        """,
+    'labels by user': """
+        SELECT label_id FROM Labels
+        WHERE labels.labelled_by=:username AND NOT labels.deleted AND label_id > :after
+        ORDER BY label_id LIMIT 100
+        """,
+    'labels by class': """
+        SELECT label_id FROM Labels
+        WHERE labels.class_id=:class_id AND NOT labels.deleted AND label_id > :after
+        ORDER BY label_id LIMIT 100
+        """,
+    'logs by image': "SELECT * FROM Logs WHERE image_id=:image_id",
+    'logs by label': "SELECT * FROM Logs WHERE label_id=:label_id",
+    'logs by time': "SELECT count(*) FROM Logs WHERE modified_at_epoch >= :start_epoch AND modified_at_epoch < :end_epoch",
+}
+
+# the version 0 schema has no modified_at_epoch, so until it's migrated logs are read by their text time
+UNMIGRATED_QUERIES = {
+    **QUERIES,
+    'logs by time': "SELECT count(*) FROM Logs WHERE modified_at BETWEEN :start AND :end",
+}
+
+
+def populate(conn, n_images, n_labels, n_users, n_classes, batch_size=100000):
+    cur = conn.cursor()
+    create_tables(cur)
+    cur.executemany("INSERT INTO Users VALUES (?, 'first', 'last', 'hash')",
+        [(f'user_{i}',) for i in range(n_users)])
+    cur.executemany("INSERT INTO Classes (name) VALUES (?)", [(f'class_{i}',) for i in range(n_classes)])
+    cur.executemany("INSERT INTO Images (image_path, deleted, contains_pii) VALUES (?, 0, 0)",
+        [(f'image_{i}.jpeg',) for i in range(n_images)])
+
+    geometry = 'MULTIPOLYGON (((40 40, 20 45, 45 30, 40 40)))'
+    for start in range(0, n_labels, batch_size):
+        rows = range(start, min(start + batch_size, n_labels))
+        cur.executemany(
+            "INSERT INTO Labels (image_id, labelled_by, class_id, geometry, deleted) VALUES (?, ?, ?, ?, ?)",
+            [(random.randint(1, n_images), f'user_{random.randrange(n_users)}', random.randint(1, n_classes),
+                geometry, int(random.random() < 0.05)) for _ in rows])
+        cur.executemany(
+            """INSERT INTO Logs (object, updated_by, method, image_id, label_id, modified_at)
+            VALUES ('Label', ?, 'INSERTION', NULL, ?, datetime(?, ? || ' seconds'))""",
+            [(f'user_{random.randrange(n_users)}', i + 1, str(LOGS_START), i) for i in rows])
+    conn.commit()
+
+
+def random_params(n_images, n_labels, n_users, n_classes):
+    # an hour's worth of logs, which were written a second apart
+    start = LOGS_START + datetime.timedelta(seconds=random.randrange(n_labels))
+    return {
+        'image_id': random.randint(1, n_images),
+        'label_id': random.randint(1, n_labels),
+        'username': f'user_{random.randrange(n_users)}',
+        'class_id': random.randint(1, n_classes),
+        'after': random.randrange(n_labels),
+        'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+        'end': (start + datetime.timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'),
+        # modified_at is local time, which the migration converts to utc epoch seconds
+        'start_epoch': int(start.timestamp()),
+        'end_epoch': int((start + datetime.timedelta(hours=1)).timestamp()),
+        }
+
+
+def run_queries(conn, args, repeats, queries=QUERIES):
+    results = {}
+    random.seed(1)
+    params = [random_params(args.images, args.labels, args.users, args.classes) for _ in range(repeats)]
+    for name, query in queries.items():
+        plan = ' / '.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params[0]))
+        start = time.perf_counter()
+        for p in params:
+            conn.execute(query, p).fetchall()
+        results[name] = ((time.perf_counter() - start) / repeats * 1000, plan)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--labels', type=int, default=1000000)
+    parser.add_argument('--images', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--classes', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = sqlite3.connect(os.path.join(tmp_dir, 'bench.sqlite'))
+        start = time.perf_counter()
+        populate(conn, args.images, args.labels, args.users, args.classes)
+        print(f'Populated {args.labels} labels in {time.perf_counter() - start:.1f}s\n')
+
+        before = run_queries(conn, args, args.repeats, UNMIGRATED_QUERIES)
+        start = time.perf_counter()
+        migrate(conn)
+        print(f'Migrated in {time.perf_counter() - start:.1f}s\n')
+        after = run_queries(conn, args, args.repeats)
+        conn.close()
+
+    print(f"{'query':<18} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>9}")
+    for name in QUERIES:
+        print(f'{name:<18} {before[name][0]:>12.2f} {after[name][0]:>12.2f} {before[name][0] / after[name][0]:>8.1f}x')
+    print('\nQuery plans')
+    for name in QUERIES:
+        print(f'{name}\n  before: {before[name][1]}\n  after:  {after[name][1]}')
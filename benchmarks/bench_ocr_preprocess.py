@@ -0,0 +1,112 @@
+"""
+Compare OCR on the whole image with OCR on the preprocessed regions from ocr_preprocess.
+
+For each image it times the full frame path and the preprocessed path (including the
+preprocessing itself), and reports the recall of the preprocessed path: the fraction of the
+words found in the full frame which are also found in the regions, and whether the pii
+verdicts agree. Besides the `static/images` samples, `--synthetic` adds large generated
+images with text burned into the corners, where the planted words give the recall directly.
+
+Without tesseract only the preprocessing time and the fraction of pixels kept are reported.
+
+    python benchmarks/bench_ocr_preprocess.py --synthetic 5
+"""
+import argparse
+import glob
+import random
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from identify_pii import _check_words_suspect
+from ocr_preprocess import preprocess_for_ocr
+from pii_matcher import tokenize
+
+
+ROOT = Path(__file__).absolute().parent.parent
+OVERLAYS = ['Name: John Smith', 'DOB: 05/12/42', 'Acc: 0545234234', 'Se: 3/2 Im: 1/1', 'Age: 78']
+
+
+def synthetic_image(rng, size=2048):
+    # a smooth blobby "scan" with lines of text in its corners
+    im = Image.new('L', (size, size), 20)
+    draw = ImageDraw.Draw(im)
+    for _ in range(30):
+        x, y, r = rng.randrange(size), rng.randrange(size), rng.randrange(50, 400)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=rng.randrange(60, 200))
+    im = im.filter(ImageFilter.GaussianBlur(25))
+
+    draw = ImageDraw.Draw(im)
+    planted = []
+    for corner in rng.sample([(40, 40), (size - 700, 40), (40, size - 300), (size - 700, size - 300)], 2):
+        for line, text in enumerate(rng.sample(OVERLAYS, 3)):
+            draw.text((corner[0], corner[1] + line * 60), text, fill=255, font_size=48)
+            planted.extend(tokenize(text))
+    return im, planted
+
+
+def ocr(images):
+    import pytesseract
+    words = []
+    for im in images:
+        words.extend(tokenize(pytesseract.image_to_string(im)))
+    return words
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=str(ROOT.joinpath('static', 'images', '*.jpeg')))
+    parser.add_argument('--synthetic', type=int, default=0, help='how many generated images to add')
+    args = parser.parse_args()
+
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+        has_ocr = True
+    except Exception:
+        has_ocr = False
+        print('tesseract is not available, only timing the preprocessing\n')
+
+    samples = []
+    for path in sorted(glob.glob(args.images)):
+        im = Image.open(path)
+        im.load()
+        samples.append((Path(path).name, im, None))
+    rng = random.Random(1)
+    for i in range(args.synthetic):
+        im, planted = synthetic_image(rng)
+        samples.append((f'synthetic_{i}', im, planted))
+
+    header = f"{'image':<32} {'size':>10} {'prep (ms)':>9} {'kept':>6}"
+    if has_ocr:
+        header += f" {'full (ms)':>9} {'crops (ms)':>10} {'recall':>7} {'pii':>10}"
+    print(header)
+    totals = [0.0, 0.0]
+    for name, im, planted in samples:
+        regions, prep_ms = timed(preprocess_for_ocr, im)
+        kept = sum(region.width * region.height for region in regions) / float(im.width * im.height)
+        line = f"{name:<32} {f'{im.width}x{im.height}':>10} {prep_ms:>9.1f} {kept:>6.0%}"
+        if has_ocr:
+            full_words, full_ms = timed(ocr, [im])
+            crop_words, crop_ms = timed(ocr, regions)
+            expected = set(planted if planted is not None else full_words)
+            recall = len(expected & set(crop_words)) / len(expected) if expected else 1.0
+            verdicts = f'{int(_check_words_suspect(full_words))}/{int(_check_words_suspect(crop_words))}'
+            line += f' {full_ms:>9.1f} {crop_ms + prep_ms:>10.1f} {recall:>7.0%} {verdicts:>10}'
+            totals[0] += full_ms
+            totals[1] += crop_ms + prep_ms
+        print(line)
+
+    if has_ocr:
+        print(f'\ntotal OCR time: full frame {totals[0]:.0f}ms, preprocessed {totals[1]:.0f}ms')
+        print('recall is against the planted words for synthetic images, otherwise against the full frame words')
+        print('pii is the full frame verdict / the preprocessed verdict')
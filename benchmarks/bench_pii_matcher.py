@@ -0,0 +1,101 @@
+"""
+Compare the compiled PiiMatcher with the old set intersection over large synthetic OCR outputs.
+
+Each document is a list of random filler tokens. Half of them have one piece of pii planted
+in them: a name, a name split in two by OCR, a name with a one letter OCR error, or the
+phrase "date of birth". For each approach it reports the time per document and how many of
+the planted documents it caught.
+
+    python benchmarks/bench_pii_matcher.py --documents 1000 --tokens 2000
+"""
+import argparse
+import random
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from pii_matcher import PiiMatcher, load_dictionary, tokenize
+
+
+ROOT = Path(__file__).absolute().parent.parent
+HEADERS = ['name', 'dob', 'd.o.b.', 'address', 'date of birth']
+
+
+def random_token(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+
+
+def plant(rng, tokens, names):
+    # returns which kind of pii was planted
+    kind = rng.choice(['name', 'split', 'typo', 'phrase'])
+    name = rng.choice(sorted(name for name in names if len(name) >= 6))
+    at = rng.randrange(len(tokens))
+    if kind == 'name':
+        tokens[at:at] = [name]
+    elif kind == 'split':
+        cut = rng.randint(2, len(name) - 2)
+        tokens[at:at] = [name[:cut], name[cut:]]
+    elif kind == 'typo':
+        i = rng.randrange(len(name))
+        tokens[at:at] = [name[:i] + rng.choice(string.ascii_lowercase.replace(name[i], '')) + name[i + 1:]]
+    else:
+        tokens[at:at] = ['date', 'of', 'birth']
+    return kind
+
+
+def make_documents(n_documents, n_tokens, names, seed=1):
+    rng = random.Random(seed)
+    # a fixed vocabulary of filler words, none of which are in the dictionary
+    vocabulary = [token for token in (random_token(rng) for _ in range(20000)) if token not in names]
+    documents = []
+    for i in range(n_documents):
+        tokens = [rng.choice(vocabulary) for _ in range(n_tokens)]
+        kind = plant(rng, tokens, names) if i % 2 else None
+        documents.append((tokens, kind))
+    return documents
+
+
+def set_intersection(patterns):
+    # the old approach, a set of whole words
+    words = set(token for pattern in patterns for token in tokenize(pattern) if len(tokenize(pattern)) == 1)
+    return lambda tokens: bool(set(tokens) & words)
+
+
+def run(name, check, documents):
+    start = time.perf_counter()
+    found = [check(tokens) for tokens, _ in documents]
+    elapsed = (time.perf_counter() - start) / len(documents) * 1000
+
+    caught = {}
+    for (_, kind), hit in zip(documents, found):
+        if kind is not None:
+            total, hits = caught.get(kind, (0, 0))
+            caught[kind] = (total + 1, hits + hit)
+    false_positives = sum(hit for (_, kind), hit in zip(documents, found) if kind is None)
+    recall = ' '.join(f'{kind}={hits}/{total}' for kind, (total, hits) in sorted(caught.items()))
+    print(f'{name:<22} {elapsed:>9.3f} {false_positives:>6}   {recall}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--tokens', type=int, default=2000, help='tokens per document')
+    args = parser.parse_args()
+
+    patterns = HEADERS + load_dictionary(ROOT.joinpath('names.txt'))
+    names = set(tokenize(' '.join(load_dictionary(ROOT.joinpath('names.txt')))))
+    documents = make_documents(args.documents, args.tokens, names)
+    print(f'{len(documents)} documents of {args.tokens} tokens, {len(patterns)} patterns\n')
+
+    for name, options in [('exact', {'max_join': 1}), ('exact + join', {}), ('fuzzy + join', {'max_edits': 1})]:
+        start = time.perf_counter()
+        matcher = PiiMatcher(patterns, **options)
+        print(f'compiled {name} in {(time.perf_counter() - start) * 1000:.0f}ms')
+
+    print(f"\n{'approach':<22} {'ms/doc':>9} {'false+':>6}   caught")
+    run('set intersection', set_intersection(patterns), documents)
+    for name, options in [('exact', {'max_join': 1}), ('exact + join', {}), ('fuzzy + join', {'max_edits': 1})]:
+        matcher = PiiMatcher(patterns, **options)
+        run(name, matcher.matches, documents)
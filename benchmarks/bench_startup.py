@@ -0,0 +1,84 @@
+"""
+Time how long `import app` takes, and what the first pii check costs once it has.
+
+Each measurement runs in a fresh interpreter, started from outside the repo to make sure
+nothing depends on the working directory. The first check is timed with the suspicious word
+dictionary compiled from scratch, and again loaded from its precompiled form.
+
+    python benchmarks/bench_startup.py --repeats 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+ROOT = Path(__file__).absolute().parent.parent
+
+IMPORT_APP = """
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+"""
+
+FIRST_CHECK = """
+import sys, time
+sys.path.insert(0, {root!r})
+import identify_pii
+identify_pii.MATCHER_PATH = {matcher_path!r}
+start = time.perf_counter()
+identify_pii._check_words_suspect(['tumor'])
+print(time.perf_counter() - start)
+"""
+
+
+def run(code, repeats, cwd):
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True, capture_output=True, text=True)
+        times.append(float(out.stdout.split()[-1]) * 1000)
+    return statistics.median(times)
+
+
+def slowest_imports(cwd, n=10):
+    # the modules with the most self time according to python -X importtime
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import sys; sys.path.insert(0, {str(ROOT)!r}); import app'],
+        cwd=cwd, check=True, capture_output=True, text=True)
+    rows = []
+    for line in out.stderr.splitlines()[1:]:
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        matcher_path = str(Path(tmp_dir).joinpath('pii_matcher.pickle'))
+        results = {
+            'import app (ms)': run(IMPORT_APP.format(root=str(ROOT)), args.repeats, tmp_dir),
+            'first check, no precompiled matcher (ms)': run(FIRST_CHECK.format(root=str(ROOT), matcher_path=None), args.repeats, tmp_dir),
+        }
+        # the first run writes the precompiled matcher, which the rest load
+        run(FIRST_CHECK.format(root=str(ROOT), matcher_path=matcher_path), 1, tmp_dir)
+        results['first check, precompiled matcher (ms)'] = run(
+            FIRST_CHECK.format(root=str(ROOT), matcher_path=matcher_path), args.repeats, tmp_dir)
+        imports = slowest_imports(tmp_dir)
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, ms in results.items():
+            print(f'{name:<44} {ms:>8.1f}')
+        print(f"\n{'slowest imports':<44} {'self (ms)':>9} {'total (ms)':>10}")
+        for self_us, cumulative_us, name in imports:
+            print(f'{name.strip():<44} {self_us / 1000:>9.1f} {cumulative_us / 1000:>10.1f}')
@@ -0,0 +1,154 @@
+"""
+Load test the API with many concurrent clients, comparing the threaded Flask server with the
+ASGI app in asgi_app.py served by uvicorn.
+
+Each client is a coroutine with its own keep-alive connection, sending read requests for
+images and labels back to back. Both servers are started on the test db, one at a time,
+unless their urls are given. For each it reports the requests per second, the median and
+p99 latency, and the errors, which include connections that couldn't be opened.
+
+    python benchmarks/load_test.py --clients 1000 --duration 20
+
+Raise the open file limit first (`ulimit -n 8192`), as every client holds a socket open.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlsplit
+
+
+ROOT = Path(__file__).absolute().parent.parent
+PATHS = ['/image/1', '/image/2', '/image/3', '/label/1', '/label/4', '/image/1/labels', '/labels?class_id=1']
+
+SERVERS = {
+    'flask': [sys.executable, '-c', 'import sys; from app import app; app.run(port=int(sys.argv[1]), threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--log-level', 'warning', '--port'],
+}
+
+
+async def client(host, port, auth, deadline, latencies, errors, rng):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            path = rng.choice(PATHS)
+            start = time.perf_counter()
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\nAuthorization: Basic {auth}\r\n\r\n'.encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            status_line, *header_lines = head.decode('latin-1').split('\r\n')
+            headers = dict(line.lower().split(': ', 1) for line in header_lines if line)
+            if headers.get('transfer-encoding') == 'chunked':
+                # streamed label lists
+                while True:
+                    size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+                    await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+            elif 'content-length' in headers:
+                await reader.readexactly(int(headers['content-length']))
+            else:
+                await reader.read()
+                headers['connection'] = 'close'
+            latencies.append(time.perf_counter() - start)
+
+            status = int(status_line.split()[1])
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            if headers.get('connection') == 'close' or status_line.startswith('HTTP/1.0'):
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.1)
+    if writer is not None:
+        writer.close()
+
+
+async def load(url, clients, duration, username, password):
+    parts = urlsplit(url)
+    auth = base64.b64encode(f'{username}:{password}'.encode()).decode()
+    latencies = []
+    errors = {}
+    deadline = time.perf_counter() + duration
+    rng = random.Random(0)
+    await asyncio.gather(*[
+        client(parts.hostname, parts.port, auth, deadline, latencies, errors, random.Random(rng.random()))
+        for _ in range(clients)])
+    return latencies, errors
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/image/1', timeout=1)
+        except urllib.error.HTTPError:
+            # a 401 means it's serving
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not start')
+
+
+def run(name, url, args):
+    server = None
+    if url is None:
+        url = f'http://127.0.0.1:{args.port}'
+        server = subprocess.Popen(SERVERS[name] + [str(args.port)], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(url)
+        # warm the db pool, credential cache and the like
+        asyncio.run(load(url, 10, 1, args.username, args.password))
+        latencies, errors = asyncio.run(load(url, args.clients, args.duration, args.username, args.password))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    return {
+        'server': name,
+        'requests': len(latencies),
+        'requests/sec': len(latencies) / args.duration,
+        'p50 (ms)': statistics.median(latencies) * 1000 if latencies else None,
+        'p99 (ms)': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+        'errors': errors,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run each server for')
+    parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['flask', 'asgi'])
+    parser.add_argument('--flask-url', help='use an already running Flask server')
+    parser.add_argument('--asgi-url', help='use an already running ASGI server')
+    parser.add_argument('--port', type=int, default=8123, help='port to start servers on')
+    parser.add_argument('--username', default='rock_god_9000')
+    parser.add_argument('--password', default='voodoochild')
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    urls = {'flask': args.flask_url, 'asgi': args.asgi_url}
+    results = [run(name, urls[name], args) for name in args.servers]
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print(f"{'server':<8} {'requests':>9} {'req/sec':>9} {'p50 (ms)':>9} {'p99 (ms)':>9}  errors")
+        for result in results:
+            print(f"{result['server']:<8} {result['requests']:>9} {result['requests/sec']:>9.0f} "
+                f"{result['p50 (ms)'] or 0:>9.1f} {result['p99 (ms)'] or 0:>9.1f}  {result['errors'] or ''}")
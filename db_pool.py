@@ -0,0 +1,124 @@
+import queue
+import sqlite3
+import threading
+
+
+# applied to every connection. cache_size is negative to mean KiB rather than pages
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def connect(db_path, busy_timeout=30, cached_statements=256, pragmas=DEFAULT_PRAGMAS, check_same_thread=True,
+        factory=sqlite3.Connection):
+    # open a connection configured the same way everywhere in the app
+    conn = sqlite3.connect(str(db_path), timeout=busy_timeout, cached_statements=cached_statements,
+        check_same_thread=check_same_thread, factory=factory)
+    conn.row_factory = sqlite3.Row
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+
+class ConnectionPool:
+    """
+    A fixed size pool of sqlite connections, shared by every request.
+
+    Keeping the connections open keeps sqlite's page cache and each connection's prepared
+    statement cache warm across requests. A connection that's returned mid transaction is
+    rolled back before it's reused, and releasing one twice is harmless. `on_connect` is called
+    with each new connection, before it's first handed out. `factory` is the sqlite3.Connection
+    subclass connections are made with.
+    """
+    def __init__(self, db_path, size=8, timeout=30, busy_timeout=30, cached_statements=256,
+            pragmas=DEFAULT_PRAGMAS, on_connect=None, factory=sqlite3.Connection):
+        self.db_path = str(db_path)
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self.on_connect = on_connect
+        self.factory = factory
+
+        # most recently used first, so the busiest connections have the warmest caches
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._in_use = set()
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        # requests are served on different threads, so connections can't be tied to the one that opened them
+        conn = connect(self.db_path, busy_timeout=self.busy_timeout, cached_statements=self.cached_statements,
+            pragmas=self.pragmas, check_same_thread=False, factory=self.factory)
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        return conn
+
+    def acquire(self):
+        conn = self._acquire()
+        with self._lock:
+            self._in_use.add(conn)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._new_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # every connection is in use, wait for one to be released
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f'No db connection became free within {self.timeout}s')
+
+    def release(self, conn):
+        with self._lock:
+            if conn not in self._in_use:
+                # already released, putting it back twice would hand it to two requests at once
+                return
+            self._in_use.discard(conn)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # a broken connection isn't worth keeping
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._lock:
+                self._created -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(conn)
@@ -0,0 +1,133 @@
+from pathlib import Path
+
+from pii_matcher import tokenize
+
+
+DICOM_SUFFIXES = ('.dcm', '.dicom')
+
+# a set value in any of these means the file identifies the patient
+IDENTIFYING_TAGS = (
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientAddress', 'OtherPatientIDs',
+    'OtherPatientNames', 'PatientBirthName', 'PatientMotherBirthName', 'PatientTelephoneNumbers',
+    'MilitaryRank', 'MedicalRecordLocator', 'ResponsiblePerson',
+)
+
+# free text, which is checked against the dictionary like OCR output
+TEXT_TAGS = (
+    'StudyDescription', 'SeriesDescription', 'ImageComments', 'PatientComments',
+    'AdditionalPatientHistory', 'RequestedProcedureDescription', 'PerformedProcedureStepDescription',
+)
+
+# identifying tags are reported as words with this prefix, which OCR can never produce, so
+# they're flagged whatever the dictionary
+TAG_WORD_PREFIX = 'dicom:'
+TAG_WORDS = frozenset(TAG_WORD_PREFIX + keyword for keyword in IDENTIFYING_TAGS + ('BurnedInAnnotation',))
+
+FRAME_POLICIES = ('all', 'first', 'first_last', 'uniform')
+
+
+def is_dicom(path):
+    # by suffix, or the DICM marker which follows the 128 byte preamble
+    if Path(path).suffix.lower() in DICOM_SUFFIXES:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+def sample_frames(n_frames, policy='uniform', max_frames=5):
+    """
+    Which frames to OCR. Burned in text is normally on every frame of a series, so a few
+    evenly spaced frames, always including the first and last, find it without decoding a
+    whole CT or cine loop.
+    """
+    if policy not in FRAME_POLICIES:
+        raise ValueError(f'policy should be one of {", ".join(FRAME_POLICIES)}')
+    if n_frames <= 0:
+        return []
+    if policy == 'all':
+        return list(range(n_frames))
+    if policy == 'first' or n_frames == 1:
+        return [0]
+    if policy == 'first_last' or max_frames <= 2:
+        return [0, n_frames - 1]
+    count = min(n_frames, max_frames)
+    return sorted({round(i * (n_frames - 1) / (count - 1)) for i in range(count)})
+
+
+def header_words(ds, trust_burned_in_flag=False):
+    """
+    The words from a header read with stop_before_pixels, and whether the pixels still need to
+    be scanned. A burned in annotation is reported like an identifying tag. The pixels are only
+    skipped when the flag says there's no burned in text, and trust_burned_in_flag is set.
+    """
+    words = [TAG_WORD_PREFIX + keyword for keyword in IDENTIFYING_TAGS if str(ds.get(keyword, '') or '').strip()]
+
+    burned_in = str(ds.get('BurnedInAnnotation', '') or '').strip().upper()
+    if burned_in == 'YES':
+        words.append(TAG_WORD_PREFIX + 'BurnedInAnnotation')
+
+    for keyword in TEXT_TAGS:
+        value = ds.get(keyword)
+        if value:
+            words.extend(tokenize(str(value)))
+
+    # the pixel data itself wasn't read, but every image has its dimensions in the header
+    scan_pixels = 'Rows' in ds and 'Columns' in ds
+    if burned_in == 'NO' and trust_burned_in_flag:
+        scan_pixels = False
+    return words, scan_pixels
+
+
+def frame_to_image(frame):
+    # one decoded frame as an 8 bit PIL image, stretched to the full range so overlays stay high contrast
+    import numpy as np
+    from PIL import Image
+
+    frame = frame.astype(np.float32)
+    low, high = float(frame.min()), float(frame.max())
+    if high > low:
+        frame = (frame - low) * (255.0 / (high - low))
+    else:
+        frame = np.zeros_like(frame)
+    return Image.fromarray(frame.astype(np.uint8))
+
+
+def iter_frames(path, indices):
+    """Decode the given frames one at a time, as PIL images. Only one frame is in memory at once."""
+    from pydicom.pixels import iter_pixels
+
+    for frame in iter_pixels(path, indices=indices):
+        yield frame_to_image(frame)
+
+
+def extract_dicom_words(path, ocr, frame_policy='uniform', max_frames=5, trust_burned_in_flag=False):
+    """
+    Words for check_for_pii from a DICOM file: the header's words first, then the words `ocr`
+    finds in each sampled frame. `ocr` takes a PIL image and returns a list of words, or True
+    if OCR isn't available. Returns True if either pydicom or OCR is needed but missing.
+
+    The header is read without the pixel data, and the frames are decoded one at a time, so
+    memory use doesn't grow with the size of the series. pydicom is only imported here.
+    """
+    try:
+        import pydicom
+    except ModuleNotFoundError:
+        return True
+
+    ds = pydicom.dcmread(str(path), stop_before_pixels=True)
+    words, scan_pixels = header_words(ds, trust_burned_in_flag)
+    if not scan_pixels or not TAG_WORDS.isdisjoint(words):
+        # nothing to read, or it's already known to be pii
+        return words
+
+    n_frames = int(ds.get('NumberOfFrames', 1) or 1)
+    for image in iter_frames(path, sample_frames(n_frames, frame_policy, max_frames)):
+        frame_words = ocr(image)
+        if frame_words is True:
+            return True
+        words.extend(frame_words)
+    return words
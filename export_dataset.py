@@ -0,0 +1,169 @@
+import argparse
+import json
+import sqlite3
+import sys
+from pathlib import Path
+
+from geometry import GEOMETRY_FORMATS, label_row_to_dict
+
+
+DB_PATH = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+EXPORT_CHUNK_SIZE = 500  # images read per query
+EXPORT_FORMATS = ('jsonl', 'parquet')
+
+# images which have been written since the watermark, directly or through one of their labels
+CHANGED_IMAGES_QUERY = """
+    SELECT coalesce(logs.image_id, labels.image_id)
+    FROM Logs
+    LEFT JOIN Labels ON logs.object = 'Label' AND logs.label_id = labels.label_id
+    WHERE logs.log_id > :since_log_id
+    """
+
+
+def begin_export(conn):
+    """
+    Start the read transaction an export runs in, so every chunk sees the same snapshot, and
+    return the last log_id in it. Passing that as since_log_id to the next export picks up
+    exactly the changes made after this one.
+    """
+    conn.execute('BEGIN')
+    return conn.execute('SELECT max(log_id) FROM Logs').fetchone()[0] or 0
+
+
+def export_records(conn, since_log_id=None, chunk_size=EXPORT_CHUNK_SIZE, fmt='wkt'):
+    """
+    Yield a record for each non-deleted image, with its labels, their class names and annotators.
+
+    Images are read in image_id order, `chunk_size` at a time, with the labels for each chunk
+    in one query, so memory use doesn't grow with the size of the dataset. With since_log_id,
+    only the images with a logged change after that log entry are exported. Images deleted
+    since then are included as {"image_id": ..., "deleted": true}, so a consumer can apply
+    the export as upserts keyed by image_id.
+    """
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    params = {'since_log_id': since_log_id, 'limit': chunk_size, 'after': 0}
+    changed = f'AND image_id IN ({CHANGED_IMAGES_QUERY})' if since_log_id is not None else 'AND NOT deleted'
+
+    while True:
+        images = cur.execute(f"""
+            SELECT image_id, image_path, contains_pii, deleted
+            FROM Images
+            WHERE image_id > :after {changed}
+            ORDER BY image_id
+            LIMIT :limit
+            """, params).fetchall()
+        if not images:
+            return
+        params['after'] = images[-1]['image_id']
+
+        labels = {}
+        live_ids = [image['image_id'] for image in images if not image['deleted']]
+        label_rows = cur.execute(f"""
+            SELECT image_id, label_id, class_id, name AS class_name, labelled_by, first_name, last_name,
+                geometry, geometry_wkb, version
+            FROM Labels
+            LEFT JOIN Classes USING(class_id)
+            LEFT JOIN Users ON labels.labelled_by = users.username
+            WHERE image_id IN ({', '.join('?' * len(live_ids))})
+            AND NOT labels.deleted
+            ORDER BY image_id, label_id
+            """, live_ids) if live_ids else ()
+        for row in label_rows:
+            label = label_row_to_dict(row, fmt)
+            labels.setdefault(label.pop('image_id'), []).append(label)
+
+        for image in images:
+            if image['deleted']:
+                yield {'image_id': image['image_id'], 'deleted': True}
+            else:
+                yield {'image_id': image['image_id'], 'image_path': image['image_path'], 'contains_pii': image['contains_pii'],
+                    'deleted': False, 'labels': labels.get(image['image_id'], [])}
+
+
+def write_jsonl(records, f):
+    count = 0
+    for record in records:
+        f.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+def parquet_schema():
+    import pyarrow as pa
+
+    label = pa.struct([
+        ('label_id', pa.int64()), ('class_id', pa.int64()), ('class_name', pa.string()),
+        ('labelled_by', pa.string()), ('first_name', pa.string()), ('last_name', pa.string()),
+        ('geometry', pa.string()),
+        ])
+    return pa.schema([
+        ('image_id', pa.int64()), ('image_path', pa.string()), ('contains_pii', pa.int64()),
+        ('deleted', pa.bool_()), ('labels', pa.list_(label)),
+        ])
+
+
+def write_parquet(records, path, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write records to a parquet file, a row group of `chunk_size` images at a time. Geometries
+    are stored as wkt or hex wkb, as parquet has no geojson type. Needs pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    count = 0
+    with pq.ParquetWriter(str(path), schema) as writer:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def export_dataset(conn, out, export_format='jsonl', since_log_id=None, chunk_size=EXPORT_CHUNK_SIZE, fmt='wkt'):
+    """
+    Export the dataset to `out`, a path or, for jsonl, an open text file. Returns a summary with
+    the number of records and the log_id to pass as since_log_id next time.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'export_format should be one of {", ".join(EXPORT_FORMATS)}')
+    if export_format == 'parquet' and fmt == 'geojson':
+        raise ValueError('parquet exports need the geometry as wkt or wkb')
+
+    log_id = begin_export(conn)
+    try:
+        records = export_records(conn, since_log_id, chunk_size, fmt)
+        if export_format == 'parquet':
+            count = write_parquet(records, out, chunk_size)
+        elif hasattr(out, 'write'):
+            count = write_jsonl(records, out)
+        else:
+            with open(out, 'w') as f:
+                count = write_jsonl(records, f)
+    finally:
+        conn.rollback()
+    return {'records': count, 'log_id': log_id, 'since_log_id': since_log_id}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export every image with its labels, printing a json summary to stderr')
+    parser.add_argument('out', help='file to write, or - for jsonl on stdout')
+    parser.add_argument('--export-format', choices=EXPORT_FORMATS, default='jsonl')
+    parser.add_argument('--format', choices=GEOMETRY_FORMATS, default='wkt', help='how to write the geometries')
+    parser.add_argument('--since-log-id', type=int, help='only export images changed after this log entry')
+    parser.add_argument('--db', default=str(DB_PATH))
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    summary = export_dataset(conn, sys.stdout if args.out == '-' else args.out, args.export_format,
+        args.since_log_id, args.chunk_size, args.format)
+    conn.close()
+    print(json.dumps(summary), file=sys.stderr)
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+import shapely.errors
+import shapely.geometry
+import shapely.wkb
+import shapely.wkt
+
+
+# shapely 2 raises ShapelyError for bad wkt, older versions raise WKTReadingError
+WKT_ERROR = getattr(shapely.errors, 'ShapelyError', None) or shapely.errors.WKTReadingError
+
+GEOMETRY_FORMATS = ('wkt', 'geojson', 'wkb')
+
+# columns read alongside a label's geometry, which aren't part of the api's label format
+INTERNAL_LABEL_COLUMNS = ('geometry_wkb', 'version')
+
+
+def parse_wkt(wkt):
+    # parse a label geometry, raising ValueError if it isn't valid wkt
+    if not isinstance(wkt, str):
+        raise ValueError('Geometry is not a valid wkt')
+    try:
+        return shapely.wkt.loads(wkt)
+    except WKT_ERROR:
+        raise ValueError('Geometry is not a valid wkt')
+
+
+def to_wkb(geom):
+    return None if geom is None else shapely.wkb.dumps(geom)
+
+
+class GeometryCache:
+    """
+    LRU cache of parsed label geometries, keyed by (label_id, version).
+
+    Every change to a label bumps its version, so stale geometries are never returned, they
+    just fall out of the cache.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, label_id, version, wkb=None, wkt=None):
+        """The label's shapely geometry, parsed from wkb if it has one, otherwise from wkt."""
+        key = (label_id, version)
+        with self._lock:
+            geom = self._entries.get(key)
+            if geom is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return geom
+            self.misses += 1
+
+        geom = shapely.wkb.loads(bytes(wkb)) if wkb is not None else parse_wkt(wkt)
+        with self._lock:
+            self._entries[key] = geom
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return geom
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+geometry_cache = GeometryCache()
+
+
+def row_geometry(row):
+    # the parsed geometry of a label row, which needs label_id, version, geometry_wkb and geometry
+    return geometry_cache.get(row['label_id'], row['version'], row['geometry_wkb'], row['geometry'])
+
+
+def format_geometry(geom, fmt='wkt'):
+    # a shapely geometry as wkt, geojson or hex encoded wkb
+    if geom is None:
+        return None
+    if fmt == 'geojson':
+        return shapely.geometry.mapping(geom)
+    if fmt == 'wkb':
+        return shapely.wkb.dumps(geom, hex=True)
+    return geom.wkt
+
+
+def label_row_to_dict(row, fmt='wkt'):
+    """A label row in the api's format, with its geometry as wkt, geojson or hex encoded wkb."""
+    data = dict(row)
+    if fmt != 'wkt':
+        try:
+            geom = row_geometry(row)
+        except ValueError:
+            # stored before geometries were validated, all we have is the text
+            geom = None
+        data['geometry'] = format_geometry(geom, fmt)
+    for column in INTERNAL_LABEL_COLUMNS:
+        data.pop(column, None)
+    return data
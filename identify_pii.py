@@ -1,27 +1,104 @@
-import string
+import threading
+from pathlib import Path
 
-from PIL import Image
+from dicom_scanner import TAG_WORDS, extract_dicom_words, is_dicom, sample_frames
+from metrics import ocr_seconds
+from pii_cache import PiiCache, hash_image
+from pii_matcher import PiiMatcher, dictionaries_key, tokenize
 
 
-# list of suspicious words. 
-suspicious_words = {'name', 'dob', 'd.o.b.', 'address'} # headers for ppi
-with open('names.txt') as f:  # common names
-    names = {line.rstrip('\n').lower() for line in f}
-suspicious_words.update(names)
+ROOT = Path(__file__).absolute().parent
+
+# suspicious words and phrases. Each dictionary is a list, or a file with one per line
+PII_HEADERS = ['name', 'dob', 'd.o.b.', 'address', 'date of birth']  # headers for ppi
+DICTIONARIES = [PII_HEADERS, ROOT.joinpath('names.txt')]  # common names
+MATCHER_OPTIONS = {}
+
+# options for ocr_preprocess.preprocess_for_ocr, which crops images down to where text might be. None OCRs the whole
+# image, which is the default until the cropped path's recall has been measured with tesseract. {} for the defaults
+OCR_PREPROCESS = None
+
+# which frames of multi-frame images are read, and whether DICOM's burned in annotation flag is trusted to skip the pixels
+FRAME_POLICY = {'frame_policy': 'uniform', 'max_frames': 5}
+DICOM_TRUST_BURNED_IN_FLAG = False
+
+# the compiled matcher is kept here, and only rebuilt when the dictionaries change. None to always build it
+MATCHER_PATH = ROOT.joinpath('image_db', 'pii_matcher.pickle')
+
+# built on the first check rather than at import, then shared by every scan in this process
+_matcher = None
+_matcher_lock = threading.Lock()
+
+# scan results are cached by image contents, so re-registering the same image skips tesseract
+pii_cache = PiiCache(ROOT.joinpath('image_db', 'pii_cache.sqlite'))
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        with _matcher_lock:
+            if _matcher is None:
+                _matcher = _load_matcher()
+    return _matcher
+
+def _load_matcher():
+    if MATCHER_PATH is None:
+        return PiiMatcher.from_dictionaries(DICTIONARIES, **MATCHER_OPTIONS)
+
+    key = dictionaries_key(DICTIONARIES, **MATCHER_OPTIONS)
+    matcher = PiiMatcher.load(MATCHER_PATH, key)
+    if matcher is None:
+        matcher = PiiMatcher.from_dictionaries(DICTIONARIES, **MATCHER_OPTIONS)
+        try:
+            matcher.save(MATCHER_PATH, key)
+        except OSError:
+            # it's only a shortcut for next time
+            pass
+    return matcher
+
+def set_dictionaries(dictionaries, **options):
+    # swap in other dictionaries, or matcher options such as max_edits. They're compiled on the next check
+    global DICTIONARIES, MATCHER_OPTIONS, _matcher
+    with _matcher_lock:
+        DICTIONARIES = list(dictionaries)
+        MATCHER_OPTIONS = options
+        _matcher = None
+
+def dictionary_version():
+    # cached verdicts made with a different set of suspicious words are re-checked
+    return get_matcher().version
 
 def _extract_words(im_path):
+    if is_dicom(im_path):
+        return extract_dicom_words(im_path, _ocr_words, trust_burned_in_flag=DICOM_TRUST_BURNED_IN_FLAG, **FRAME_POLICY)
+
+    # multi-frame images, eg. tiffs, are read a frame at a time
+    from PIL import Image
+    im = Image.open(im_path)
+    words = []
+    for frame in sample_frames(getattr(im, 'n_frames', 1), FRAME_POLICY['frame_policy'], FRAME_POLICY['max_frames']):
+        im.seek(frame)
+        frame_words = _ocr_words(im)
+        if frame_words is True:
+            return True
+        words.extend(frame_words)
+    return words
+
+def _ocr_words(im):
     try:
         import pytesseract
     except ModuleNotFoundError:
         return True
 
-    # get words from image using tesseract
-    im = Image.open(im_path)
-    text = pytesseract.image_to_string(im)
+    # get words from image using tesseract, only reading the parts which might have text
+    from ocr_preprocess import preprocess_for_ocr
+    regions = [im] if OCR_PREPROCESS is None else preprocess_for_ocr(im, **OCR_PREPROCESS)
 
-    # remove punctutation and split into set of words
-    clean_text = text.lower().translate(str.maketrans('', '', string.punctuation))
-    words = set(clean_text.split())
+    # remove punctutation and split into words, keeping their order so phrases can be found
+    words = []
+    for region in regions:
+        with ocr_seconds.time():
+            text = pytesseract.image_to_string(region)
+        words.extend(tokenize(text))
     return words
 
 def _check_words_suspect(words):
@@ -29,15 +106,47 @@ def _check_words_suspect(words):
         # if there are no words, its fine
         return False
 
-    if (set(words) & suspicious_words):
-        # if there are any suspicious words report it
+    if not TAG_WORDS.isdisjoint(words):
+        # a DICOM header which identifies the patient
+        return True
+
+    if get_matcher().matches(words):
+        # if there are any suspicious words or phrases report it
         return True
 
     # if none of the words are suspicious, its fine
     return False
 
-def check_for_pii(im_path):
+def lookup_cached_pii(im_path, cache=pii_cache, content_hash=None):
+    # returns the cached verdict for this image, or None if it needs to be scanned
+    if cache is None:
+        return None
+    content_hash = content_hash or hash_image(im_path)
+    cached = cache.lookup(content_hash)
+    if cached is None:
+        return None
+
+    words, contains_pii, cached_version = cached
+    version = dictionary_version()
+    if cached_version != version:
+        # the dictionary changed, but the words in the image didn't. Re-check without tesseract
+        contains_pii = _check_words_suspect(words)
+        cache.store(content_hash, words, contains_pii, version)
+    return contains_pii
+
+def check_for_pii(im_path, cache=pii_cache):
+    content_hash = hash_image(im_path) if cache is not None else None
+    contains_pii = lookup_cached_pii(im_path, cache, content_hash)
+    if contains_pii is not None:
+        return contains_pii
+
     # check if there are any words on the image
     words = _extract_words(im_path)
+    if words is True:
+        # tesseract isn't available, so assume the worst
+        return True
 
-    return _check_words_suspect(words)
+    contains_pii = _check_words_suspect(words)
+    if cache is not None:
+        cache.store(content_hash, words, contains_pii, dictionary_version())
+    return contains_pii
@@ -1,9 +1,17 @@
+import argparse
+import datetime
 import os
 import csv
+import time
 
 from glob import glob
 from pathlib import Path
+import numpy as np
+import shapely
+import shapely.wkb
+import shapely.wkt
 import sqlite3
+import zlib
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -21,29 +29,31 @@ def insert_test_data(cur, users_psv, labels_psv, classes_psv):
 
 def insert_image_data(cur):
     insertion_query = """
-        INSERT INTO Images (image_path, deleted, contains_pii) 
+        INSERT INTO Images (image_path, deleted, contains_pii)
         VALUES (:im_path, :deleted, 0)
     """
 
-    # Insert every jpeg in the static/images folder into the db
+    # Insert every jpeg in the static/images folder into the db, then a deleted copy of the last one
     data_dir = Path(__file__).absolute().parent.parent.joinpath('static', 'images')
-    for image_name in sorted(data_dir.rglob("*.jpeg")):
-        image_path = image_name.relative_to(data_dir)
-        cur.execute(insertion_query, {'im_path': str(image_path), 'deleted': 0})
-    cur.execute(insertion_query, {'im_path': str(image_path), 'deleted': 1})
+    rows = [{'im_path': str(image_path), 'deleted': 0} for image_path in find_images(data_dir)]
+    rows.append({**rows[-1], 'deleted': 1})
+    cur.executemany(insertion_query, rows)
 
+def find_images(data_dir, sub_dir='.', pattern='*.jpeg'):
+    # walk data_dir/sub_dir for images, yielding their paths relative to data_dir
+    for image_name in sorted(Path(data_dir).joinpath(sub_dir).rglob(pattern)):
+        yield image_name.relative_to(data_dir)
 
-def insert_users_data(cur, users_psv):
+def insert_users_data(cur, users_psv, hash_password=generate_password_hash):
     data = psv_to_list_dicts(users_psv)
     insert_users_query = """
-        INSERT INTO Users (username, first_name, last_name, pwd_hash) 
+        INSERT INTO Users (username, first_name, last_name, pwd_hash)
             VALUES (:username, :first_name, :last_name, :hash)
         """
 
     for row in data:
-        pwd_hash = generate_password_hash(row['password'])
-        row.update({'hash': pwd_hash})
-        cur.execute(insert_users_query, row)
+        row.update({'hash': hash_password(row['password'])})
+    cur.executemany(insert_users_query, data)
 
 def insert_classes_data(cur, classes_psv):
     data = psv_to_list_dicts(classes_psv)
@@ -52,19 +62,156 @@ def insert_classes_data(cur, classes_psv):
         VALUES (:name)
         """
 
-    for row in data:
-        cur.execute(insert_class_query, row)
+    cur.executemany(insert_class_query, data)
 
 def insert_labels_data(cur, labels_psv):
     data = psv_to_list_dicts(labels_psv)
     insert_label_query = """
-        INSERT INTO Labels (image_id, labelled_by, class_id, geometry, deleted) 
+        INSERT INTO Labels (image_id, labelled_by, class_id, geometry, deleted)
         VALUES (:image_id, :labelled_by, :class_id, :geometry, :deleted)
         """
 
-    for row in data:
-        cur.execute(insert_label_query, row)
+    cur.executemany(insert_label_query, data)
+
+
+
+### Synthetic data, for benchmarks
+SYNTHETIC_IMAGE_SIZE = (2048, 2048)
+SYNTHETIC_DELETED_RATE = 0.02  # fraction of images and labels which are deleted
+SYNTHETIC_PII_RATE = 0.1
+SYNTHETIC_TIME_SPAN = 365 * 24 * 3600  # seconds of history the logs are spread over
+SYNTHETIC_BATCH_SIZE = 50000  # rows generated and inserted at a time
+SYNTHETIC_GRID = 4  # the parts of a label each sit in their own cell of a grid this size over the image
+
+# the default hash takes a noticeable fraction of a second, so synthetic users get a cheap one.
+# check_password_hash reads the method from the hash, so they still log in as usual
+SYNTHETIC_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+# while loading there's no journal and no fsync, as a crash means generating the db again anyway
+LOAD_PRAGMAS = {'journal_mode': 'OFF', 'synchronous': 'OFF', 'cache_size': -256000, 'temp_store': 'MEMORY'}
+
+INSERT_SYNTHETIC_LOGS_QUERY = """
+    INSERT INTO Logs (object, updated_by, method, image_id, label_id, modified_at, modified_at_epoch)
+    VALUES (?1, ?2, ?3, ?4, ?5, datetime(?6, 'unixepoch', 'localtime'), ?6)
+    """
+
+def fast_password_hash(password):
+    return generate_password_hash(password, method=SYNTHETIC_HASH_METHOD)
+
+def random_multipolygons(rng, count, width=SYNTHETIC_IMAGE_SIZE[0], height=SYNTHETIC_IMAGE_SIZE[1], max_parts=3,
+        grid=SYNTHETIC_GRID):
+    """
+    An array of `count` irregular multipolygons, like the outlines of segmented regions, made
+    all at once with numpy from `rng`, a numpy Generator. Each has 1 to max_parts star shaped
+    parts of 6 to 40 vertices, a fifth of them with a hole. The parts of a multipolygon sit in
+    different cells of a grid over the image, so they never overlap. Coordinates are rounded
+    to 0.1 pixels.
+    """
+    # the parts, each in a different cell
+    n_parts = rng.integers(1, max_parts + 1, count)
+    part_label = np.repeat(np.arange(count), n_parts)
+    part_index = np.arange(len(part_label)) - np.repeat(np.cumsum(n_parts) - n_parts, n_parts)
+    part_cell = rng.random((count, grid * grid)).argsort(axis=1)[part_label, part_index]
+    cell_width, cell_height = width / grid, height / grid
+    radius = rng.uniform(10, min(cell_width, cell_height) / 2, len(part_label))
+    cx = (part_cell % grid) * cell_width + rng.uniform(radius, cell_width - radius)
+    cy = (part_cell // grid) * cell_height + rng.uniform(radius, cell_height - radius)
+
+    # a shell for every part, followed by its hole if it has one. With at least 6 vertices, a
+    # shell never comes closer than 0.35 * radius, so a hole of 0.3 * radius is always inside it
+    n_rings = 1 + (rng.random(len(part_label)) < 0.2)
+    ring_part = np.repeat(np.arange(len(part_label)), n_rings)
+    is_hole = np.arange(len(ring_part)) - np.repeat(np.cumsum(n_rings) - n_rings, n_rings) == 1
+    n_vertices = np.where(is_hole, rng.integers(4, 11, len(ring_part)), rng.integers(6, 41, len(ring_part)))
+    ring_radius = radius[ring_part] * np.where(is_hole, 0.3, 1)
+    min_scale = np.where(is_hole, 0.5, 0.6)
 
+    # star shaped rings around the part's centre. The gaps between vertices are kept under half a turn so they can't cross themselves
+    vertex_ring = np.repeat(np.arange(len(ring_part)), n_vertices)
+    vertex_index = np.arange(len(vertex_ring)) - np.repeat(np.cumsum(n_vertices) - n_vertices, n_vertices)
+    angle = (vertex_index + rng.uniform(0, 0.8, len(vertex_ring))) * (2 * np.pi / n_vertices[vertex_ring])
+    distance = ring_radius[vertex_ring] * rng.uniform(min_scale[vertex_ring], 1)
+    x = np.round(cx[ring_part][vertex_ring] + distance * np.cos(angle), 1)
+    y = np.round(cy[ring_part][vertex_ring] + distance * np.sin(angle), 1)
+
+    rings = shapely.linearrings(np.column_stack([x, y]), indices=vertex_ring)
+    polygons = shapely.polygons(rings, indices=ring_part)
+    return shapely.multipolygons(polygons, indices=part_label)
+
+def insert_synthetic_data(cur, n_images, n_labels, n_users=10, seed=0, batch_size=SYNTHETIC_BATCH_SIZE):
+    """
+    Insert n_images images, using the files in static/images in turn, n_labels labels spread
+    across them at random, n_users annotators, whose passwords are their usernames, and a log
+    of every insertion. A label is only ever on an image uploaded before it.
+
+    Expects a migrated db with the classes already in it. Rows go straight into the latest
+    schema, with their wkb, spatial index entries and revisions, and are generated, inserted
+    and committed `batch_size` at a time, so memory use doesn't grow with the volume. Returns
+    the number of rows put in each table.
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(__file__).absolute().parent.parent.joinpath('static', 'images')
+    image_paths = [str(image_path) for image_path in find_images(data_dir)]
+    class_ids = np.array([row[0] for row in cur.execute('SELECT class_id FROM Classes').fetchall()])
+    usernames = [f'annotator_{i}' for i in range(n_users)]
+    start = int(datetime.datetime.now().timestamp()) - SYNTHETIC_TIME_SPAN
+    rows = {'Users': n_users, 'Images': 0, 'Labels': 0, 'LabelsRtree': 0, 'LabelRevisions': 0, 'Logs': 0}
+
+    cur.executemany('INSERT INTO Users (username, first_name, last_name, pwd_hash) VALUES (?, ?, ?, ?)',
+        [(username, 'Synthetic', f'Annotator {i}', fast_password_hash(username)) for i, username in enumerate(usernames)])
+
+    # images are uploaded at a steady rate over the time span
+    first_image_id = (cur.execute('SELECT max(image_id) FROM Images').fetchone()[0] or 0) + 1
+    for batch_start in range(0, n_images, batch_size):
+        index = np.arange(batch_start, min(batch_start + batch_size, n_images))
+        image_ids = (first_image_id + index).tolist()
+        epochs = (start + index * SYNTHETIC_TIME_SPAN // n_images).tolist()
+        cur.executemany('INSERT INTO Images (image_id, image_path, deleted, contains_pii) VALUES (?, ?, ?, ?)', zip(
+            image_ids, [image_paths[i % len(image_paths)] for i in index.tolist()],
+            (rng.random(len(index)) < SYNTHETIC_DELETED_RATE).astype(int).tolist(),
+            (rng.random(len(index)) < SYNTHETIC_PII_RATE).astype(int).tolist()))
+        cur.executemany(INSERT_SYNTHETIC_LOGS_QUERY, [
+            ('Image', usernames[user], 'INSERTION', image_id, None, epoch)
+            for user, image_id, epoch in zip(rng.integers(0, n_users, len(index)).tolist(), image_ids, epochs)])
+        cur.connection.commit()
+        rows['Images'] += len(index)
+        rows['Logs'] += len(index)
+
+    # labels are made in label_id order, each on one of the images uploaded by then
+    first_label_id = (cur.execute('SELECT max(label_id) FROM Labels').fetchone()[0] or 0) + 1
+    for batch_start in range(0, n_labels if n_images else 0, batch_size):
+        index = np.arange(batch_start, min(batch_start + batch_size, n_labels))
+        label_ids = first_label_id + index
+        epochs = start + ((index + rng.random(len(index))) * SYNTHETIC_TIME_SPAN / n_labels).astype(np.int64)
+        uploaded = np.minimum((epochs - start) * n_images // SYNTHETIC_TIME_SPAN + 1, n_images)
+        image_ids = first_image_id + (rng.random(len(index)) * uploaded).astype(np.int64)
+        labelled_by = [usernames[user] for user in rng.integers(0, n_users, len(index)).tolist()]
+        label_classes = rng.choice(class_ids, len(index)).tolist()
+        deleted = rng.random(len(index)) < SYNTHETIC_DELETED_RATE
+        geometries = random_multipolygons(rng, len(index))
+        wkts = shapely.to_wkt(geometries, rounding_precision=1).tolist()
+        wkbs = shapely.to_wkb(geometries).tolist()
+        bounds = shapely.bounds(geometries[~deleted])
+
+        cur.executemany("""
+            INSERT INTO Labels (label_id, image_id, labelled_by, class_id, geometry, geometry_wkb, deleted, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+            """, zip(label_ids.tolist(), image_ids.tolist(), labelled_by, label_classes, wkts, wkbs, deleted.astype(int).tolist()))
+        # the spatial index only has the live labels
+        cur.executemany('INSERT INTO LabelsRtree VALUES (?, ?, ?, ?, ?)', zip(
+            label_ids[~deleted].tolist(), bounds[:, 0].tolist(), bounds[:, 2].tolist(), bounds[:, 1].tolist(), bounds[:, 3].tolist()))
+        # the fastest compression level, which packs the wkb almost as small as the default, in half the time
+        cur.executemany('INSERT INTO LabelRevisions VALUES (?, 1, ?, ?, ?, ?, ?, ?)', zip(
+            label_ids.tolist(), label_classes, wkts, [zlib.compress(wkb, 1) for wkb in wkbs], deleted.astype(int).tolist(),
+            labelled_by, epochs.tolist()))
+        cur.executemany(INSERT_SYNTHETIC_LOGS_QUERY, zip(
+            ['Label'] * len(index), labelled_by, ['INSERTION'] * len(index), [None] * len(index), label_ids.tolist(), epochs.tolist()))
+        cur.connection.commit()
+        rows['Labels'] += len(index)
+        rows['LabelsRtree'] += len(bounds)
+        rows['LabelRevisions'] += len(index)
+        rows['Logs'] += len(index)
+    return rows
 
 
 ### Create the DB
@@ -113,12 +260,180 @@ def create_tables(cur):
     return
 
 
-def create_db(db_file):
-    # remove existing db file, create fresh one
-    if os.path.exists(db_file):
-        os.remove(db_file)
+### Migrations
+# Each migration upgrades the schema by one version, tracked in PRAGMA user_version. create_tables
+# builds version 0, so new dbs and existing ones both end up on the latest version via migrate.
+def migration_1_pii_jobs(cur):
+    cur.execute('''CREATE TABLE IF NOT EXISTS PiiJobs
+        (job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_id INTEGER,
+        image_path TEXT,
+        status TEXT,
+        attempts INTEGER,
+        error TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY(image_id) REFERENCES Images(image_id)
+        )''')
 
-    conn = sqlite3.connect(db_file)
+def migration_2_indexes(cur):
+    # partial indexes only cover the live rows, which is what the API reads
+    cur.execute('CREATE INDEX IF NOT EXISTS Labels_image_id ON Labels(image_id, label_id) WHERE NOT deleted')
+    cur.execute('CREATE INDEX IF NOT EXISTS Labels_labelled_by ON Labels(labelled_by, label_id) WHERE NOT deleted')
+    cur.execute('CREATE INDEX IF NOT EXISTS Labels_class_id ON Labels(class_id, label_id) WHERE NOT deleted')
+    cur.execute('CREATE INDEX IF NOT EXISTS Logs_image_id ON Logs(image_id) WHERE image_id IS NOT NULL')
+    cur.execute('CREATE INDEX IF NOT EXISTS Logs_label_id ON Logs(label_id) WHERE label_id IS NOT NULL')
+    cur.execute('CREATE INDEX IF NOT EXISTS Logs_modified_at ON Logs(modified_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS PiiJobs_status ON PiiJobs(status, job_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS PiiJobs_image_id ON PiiJobs(image_id, job_id)')
+
+def migration_3_spatial_index(cur):
+    # bounding boxes of the live labels, kept up to date by the app whenever a geometry changes
+    cur.execute('CREATE VIRTUAL TABLE IF NOT EXISTS LabelsRtree USING rtree(label_id, min_x, max_x, min_y, max_y)')
+    rows = []
+    for label_id, geometry in cur.execute('SELECT label_id, geometry FROM Labels WHERE NOT deleted').fetchall():
+        try:
+            geom = shapely.wkt.loads(geometry)
+        except Exception:
+            # invalid wkt can't be indexed
+            continue
+        if not geom.is_empty:
+            min_x, min_y, max_x, max_y = geom.bounds
+            rows.append((label_id, min_x, max_x, min_y, max_y))
+    cur.executemany('INSERT OR REPLACE INTO LabelsRtree VALUES (?, ?, ?, ?, ?)', rows)
+
+def migration_4_geometry_wkb(cur):
+    # a binary copy of each geometry, which is much cheaper to parse than the wkt. version
+    # goes up on every change to a label, so parsed geometries can be cached by (label_id, version)
+    cur.execute('ALTER TABLE Labels ADD COLUMN geometry_wkb BLOB')
+    cur.execute('ALTER TABLE Labels ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    rows = []
+    for label_id, geometry in cur.execute('SELECT label_id, geometry FROM Labels').fetchall():
+        try:
+            rows.append((shapely.wkb.dumps(shapely.wkt.loads(geometry)), label_id))
+        except Exception:
+            # invalid wkt stays text only
+            continue
+    cur.executemany('UPDATE Labels SET geometry_wkb=? WHERE label_id=?', rows)
+
+def migration_5_log_epoch(cur):
+    # modified_at is local time text, which is ambiguous around daylight saving changes and slow to
+    # range scan. Existing rows are converted assuming they were written in this machine's timezone
+    cur.execute('ALTER TABLE Logs ADD COLUMN modified_at_epoch INTEGER')
+    cur.execute("UPDATE Logs SET modified_at_epoch=CAST(strftime('%s', modified_at, 'utc') AS INTEGER)")
+    cur.execute('CREATE INDEX IF NOT EXISTS Logs_modified_at_epoch ON Logs(modified_at_epoch, log_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS Logs_updated_by ON Logs(updated_by, modified_at_epoch, log_id)')
+    cur.execute('DROP INDEX IF EXISTS Logs_modified_at')
+
+def migration_6_label_revisions(cur):
+    # every version of every label, with its geometry as zlib compressed wkb, or as text if it isn't valid wkt.
+    # Labels written before this only have their current version, timestamped when they were inserted, or now if that wasn't logged
+    cur.execute('''CREATE TABLE IF NOT EXISTS LabelRevisions
+        (label_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        class_id INTEGER,
+        geometry TEXT,
+        geometry_wkb BLOB,
+        deleted INTEGER,
+        updated_by TEXT,
+        modified_at_epoch INTEGER,
+        PRIMARY KEY (label_id, version),
+        FOREIGN KEY(label_id) REFERENCES Labels(label_id)
+        ) WITHOUT ROWID''')
+    rows = cur.execute('''
+        SELECT label_id, version, class_id, geometry, geometry_wkb, deleted,
+            coalesce((SELECT updated_by FROM Logs WHERE Logs.label_id = Labels.label_id ORDER BY log_id DESC LIMIT 1), labelled_by),
+            (SELECT min(modified_at_epoch) FROM Logs WHERE Logs.label_id = Labels.label_id AND method = 'INSERTION')
+        FROM Labels
+        ''').fetchall()
+    now = int(time.time())
+    cur.executemany('INSERT OR IGNORE INTO LabelRevisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+        (label_id, version, class_id, None if wkb is not None else geometry, None if wkb is None else zlib.compress(wkb),
+            deleted, updated_by, now if epoch is None else epoch)
+        for label_id, version, class_id, geometry, wkb, deleted, updated_by, epoch in rows])
+
+def migration_7_pii_job_owner(cur):
+    # the queue which claimed a running job. Its updated_at is a lease the owner keeps renewing
+    cur.execute('ALTER TABLE PiiJobs ADD COLUMN owner TEXT')
+
+def migration_8_revision_text(cur):
+    # revisions keep the wkt they were given, so a revert restores it exactly. Older revisions only had wkb,
+    # their text can be recovered where the label hasn't changed since
+    cur.execute('''
+        UPDATE LabelRevisions
+        SET geometry=(SELECT geometry FROM Labels WHERE Labels.label_id = LabelRevisions.label_id AND Labels.version = LabelRevisions.version)
+        WHERE geometry IS NULL
+        ''')
+
+MIGRATIONS = [
+    (1, migration_1_pii_jobs),
+    (2, migration_2_indexes),
+    (3, migration_3_spatial_index),
+    (4, migration_4_geometry_wkb),
+    (5, migration_5_log_epoch),
+    (6, migration_6_label_revisions),
+    (7, migration_7_pii_job_owner),
+    (8, migration_8_revision_text),
+    ]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def migrate(conn):
+    # upgrade the db in place to the latest version, returns the version it started at
+    start_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if start_version >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # re-check inside the transaction, in case another process migrated in the meantime
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version={version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # wal lets readers carry on while something is writing. This is stored in the db file
+    conn.execute('PRAGMA journal_mode=WAL')
+    return start_version
+
+
+def reset_db(conn):
+    # drop everything in place, so connections the server already has open stay valid
+    tables = conn.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type='table' AND name NOT LIKE 'sqlite_%'
+        ORDER BY sql LIKE 'CREATE VIRTUAL%' DESC
+        ''').fetchall()
+    conn.execute('BEGIN IMMEDIATE')
+    for (table,) in tables:
+        conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_sequence'").fetchone():
+        conn.execute('DELETE FROM sqlite_sequence')
+    conn.execute('PRAGMA user_version=0')
+    conn.commit()
+
+
+def open_empty_db(db_file):
+    # empty the existing db, or create a fresh one
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        reset_db(conn)
+    except sqlite3.DatabaseError:
+        # not a usable db, start again from scratch
+        conn.close()
+        for path in (str(db_file), f'{db_file}-journal', f'{db_file}-wal', f'{db_file}-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        conn = sqlite3.connect(db_file, timeout=30)
+    return conn
+
+
+def create_db(db_file):
+    conn = open_empty_db(db_file)
     cur = conn.cursor()
 
     create_tables(cur)
@@ -128,10 +443,59 @@ def create_db(db_file):
         classes_psv=Path(__file__).absolute().parent.joinpath('test_classes.psv')
         )
     conn.commit()
+    migrate(conn)
+    conn.close()
+
+
+def create_synthetic_db(db_file, n_images, n_labels, n_users=10, seed=0):
+    """
+    A db with the example users and classes, and n_images images with n_labels labels between
+    them, for benchmarking. The same seed always gives the same data. Returns the rows put in
+    each table, the seconds it took and the rows per second.
+    """
+    start = time.perf_counter()
+    conn = open_empty_db(db_file)
+    cur = conn.cursor()
+
+    create_tables(cur)
+    insert_users_data(cur, users_psv=Path(__file__).absolute().parent.joinpath('test_users.psv'), hash_password=fast_password_hash)
+    insert_classes_data(cur, classes_psv=Path(__file__).absolute().parent.joinpath('test_classes.psv'))
+    conn.commit()
+    migrate(conn)
+
+    for name, value in LOAD_PRAGMAS.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    rows = insert_synthetic_data(cur, n_images, n_labels, n_users, seed)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+
+    seconds = time.perf_counter() - start
+    return {'rows': rows, 'seconds': seconds, 'rows/sec': sum(rows.values()) / seconds}
 
 
 if __name__ == '__main__':
-    db_file = Path(__file__).absolute().parent.joinpath('test_db.sqlite')
+    parser = argparse.ArgumentParser(description='Create the example db, or upgrade an existing db')
+    parser.add_argument('db_file', nargs='?', default=str(Path(__file__).absolute().parent.joinpath('test_db.sqlite')))
+    parser.add_argument('--migrate', action='store_true', help='upgrade the db in place instead of recreating it')
+    parser.add_argument('--synthetic', nargs=2, type=int, metavar=('IMAGES', 'LABELS'),
+        help='fill the db with this many synthetic images and labels instead of the example data')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    args = parser.parse_args()
+    db_file = args.db_file
+
+    if args.migrate:
+        conn = sqlite3.connect(db_file)
+        start_version = migrate(conn)
+        print(f'Migrated {db_file} from version {start_version} to {LATEST_VERSION}')
+        exit()
+
+    if args.synthetic:
+        summary = create_synthetic_db(db_file, *args.synthetic, seed=args.seed)
+        print(f'Created {db_file} with {args.synthetic[0]} images and {args.synthetic[1]} labels')
+        print(f"{sum(summary['rows'].values())} rows in {summary['seconds']:.1f}s, {summary['rows/sec']:.0f} rows/sec")
+        for table, count in summary['rows'].items():
+            print(f'  {table}: {count}')
+        exit()
     create_db(db_file)
 
     conn = sqlite3.connect(db_file)
@@ -0,0 +1,190 @@
+import sqlite3
+import time
+import zlib
+
+from audit_log import insert_logs, log_row
+from geometry import parse_wkt, to_wkb
+from spatial_index import index_labels, unindex_labels
+
+
+BATCH_METHODS = ('POST', 'PUT', 'DELETE')
+MAX_SQL_VARIABLES = 500
+
+
+def _as_int(value, field):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} should be an integer')
+
+
+def _validate_operation(op):
+    # returns the cleaned up operation, or raises ValueError with the reason it's invalid
+    if not isinstance(op, dict):
+        raise ValueError('Operation should be an object')
+    method = str(op.get('method', '')).upper()
+    if method not in BATCH_METHODS:
+        raise ValueError(f'method should be one of {", ".join(BATCH_METHODS)}')
+
+    if method == 'POST':
+        for field in ('image_id', 'class_id', 'geometry'):
+            if field not in op:
+                raise ValueError(f'{field} was not provided')
+        return {'method': method, 'image_id': _as_int(op['image_id'], 'image_id'),
+            'class_id': _as_int(op['class_id'], 'class_id'), 'geometry': op['geometry'],
+            'geom': parse_wkt(op['geometry'])}
+
+    if 'label_id' not in op:
+        raise ValueError('label_id was not provided')
+    cleaned = {'method': method, 'label_id': _as_int(op['label_id'], 'label_id')}
+    if method == 'PUT':
+        if ('class_id' not in op) and ('geometry' not in op):
+            raise ValueError('Neither class_id or geometry was provided')
+        cleaned['class_id'] = _as_int(op['class_id'], 'class_id') if 'class_id' in op else None
+        cleaned['geometry'] = op.get('geometry')
+        if cleaned['geometry'] is not None:
+            cleaned['geom'] = parse_wkt(cleaned['geometry'])
+    return cleaned
+
+
+def _existing_label_ids(cur, label_ids):
+    # labels which can be updated or deleted, looked up in chunks to stay under sqlite's variable limit
+    label_ids = list(set(label_ids))
+    existing = set()
+    for start in range(0, len(label_ids), MAX_SQL_VARIABLES):
+        chunk = label_ids[start:start + MAX_SQL_VARIABLES]
+        rows = cur.execute(
+            f"SELECT label_id FROM Labels WHERE NOT deleted AND label_id IN ({','.join('?' * len(chunk))})",
+            chunk).fetchall()
+        existing.update(row[0] for row in rows)
+    return existing
+
+
+def label_image_ids(cur, label_ids):
+    # the images the labels are on, deleted or not
+    label_ids = list(set(label_ids))
+    image_ids = set()
+    for start in range(0, len(label_ids), MAX_SQL_VARIABLES):
+        chunk = label_ids[start:start + MAX_SQL_VARIABLES]
+        rows = cur.execute(
+            f"SELECT DISTINCT image_id FROM Labels WHERE label_id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        image_ids.update(row[0] for row in rows)
+    return image_ids
+
+
+def record_revisions(cur, label_ids, username, now=None):
+    """
+    Append the current version of each label to LabelRevisions, in the same transaction as the
+    change that made it. Geometries are stored as the text they were given, and as zlib
+    compressed wkb if valid.
+    """
+    now = int(time.time()) if now is None else int(now)
+    label_ids = list(set(label_ids))
+    for start in range(0, len(label_ids), MAX_SQL_VARIABLES):
+        chunk = label_ids[start:start + MAX_SQL_VARIABLES]
+        rows = cur.execute(f"""
+            SELECT label_id, version, class_id, geometry, geometry_wkb, deleted
+            FROM Labels
+            WHERE label_id IN ({','.join('?' * len(chunk))})
+            """, chunk).fetchall()
+        cur.executemany("INSERT INTO LabelRevisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+            (label_id, version, class_id, geometry, None if wkb is None else zlib.compress(wkb),
+                deleted, username, now)
+            for label_id, version, class_id, geometry, wkb, deleted in rows])
+
+
+def apply_label_batch(conn, operations, username, atomic=True, write_logs=insert_logs):
+    """
+    Insert, update and delete many labels in a single transaction.
+
+    Every operation is validated before anything is written, and a label can only be updated or
+    deleted once per batch. In atomic mode a single invalid
+    operation means nothing is applied, otherwise the valid operations are applied and the
+    invalid ones reported. Inserts are applied first, then updates, then deletes, each with a
+    single executemany, and all the log rows are written with one more call to `write_logs`.
+
+    Returns (results, applied), with a result for each operation in the order given.
+    """
+    cur = conn.cursor()
+    results = []
+    valid = []
+    for index, op in enumerate(operations):
+        result = {'index': index, 'method': op.get('method') if isinstance(op, dict) else None}
+        try:
+            cleaned = _validate_operation(op)
+            result.update({'method': cleaned['method'], 'label_id': cleaned.get('label_id')})
+            valid.append((result, cleaned))
+        except ValueError as e:
+            result.update({'status': 'error', 'message': str(e)})
+        results.append(result)
+
+    # each label can only be changed once per batch, so it gets one version and one revision per change
+    seen = set()
+    still_valid = []
+    for result, op in valid:
+        if op['method'] != 'POST' and op['label_id'] in seen:
+            result.update({'status': 'error', 'message': 'Label is changed more than once in the batch'})
+        else:
+            seen.add(op.get('label_id'))
+            still_valid.append((result, op))
+    valid = still_valid
+
+    # updates and deletes need a label that exists
+    existing = _existing_label_ids(cur, [op['label_id'] for _, op in valid if op['method'] != 'POST'])
+    still_valid = []
+    for result, op in valid:
+        if op['method'] != 'POST' and op['label_id'] not in existing:
+            result.update({'status': 'error', 'message': 'Label not found'})
+        else:
+            still_valid.append((result, op))
+    valid = still_valid
+
+    if atomic and len(valid) != len(results):
+        # nothing has been written yet
+        for result, _ in valid:
+            result.update({'status': 'skipped', 'message': 'Batch was not applied'})
+        return results, False
+
+    inserts = [(result, op) for result, op in valid if op['method'] == 'POST']
+    updates = [(result, op) for result, op in valid if op['method'] == 'PUT']
+    deletes = [(result, op) for result, op in valid if op['method'] == 'DELETE']
+    try:
+        if inserts:
+            cur.executemany("""
+                INSERT INTO Labels (image_id, labelled_by, class_id, geometry, geometry_wkb, deleted)
+                VALUES (?, ?, ?, ?, ?, 0)
+                """, [(op['image_id'], username, op['class_id'], op['geometry'], to_wkb(op['geom'])) for _, op in inserts])
+
+            # the write lock is held for the whole transaction, so the new ids are consecutive
+            last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+            for label_id, (result, op) in enumerate(inserts, start=last_id - len(inserts) + 1):
+                result['label_id'] = op['label_id'] = label_id
+
+        if updates:
+            cur.executemany("""
+                UPDATE Labels
+                SET class_id=coalesce(?, class_id), geometry=coalesce(?, geometry),
+                    geometry_wkb=coalesce(?, geometry_wkb), version=version+1
+                WHERE label_id=?
+                """, [(op['class_id'], op['geometry'], to_wkb(op.get('geom')), op['label_id']) for _, op in updates])
+
+        if deletes:
+            cur.executemany("UPDATE Labels SET deleted=1, version=version+1 WHERE label_id=?",
+                [(op['label_id'],) for _, op in deletes])
+
+        # keep the spatial index in step with the new geometries
+        index_labels(cur, [(op['label_id'], op['geom']) for _, op in inserts + updates if 'geom' in op])
+        unindex_labels(cur, [op['label_id'] for _, op in deletes])
+        record_revisions(cur, [op['label_id'] for _, op in inserts + updates + deletes], username)
+
+        log_methods = {'POST': 'INSERTION', 'PUT': 'UPDATE', 'DELETE': 'DELETE'}
+        write_logs(cur, [log_row('Label', username, log_methods[op['method']], None, op['label_id'])
+            for _, op in inserts + updates + deletes])
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    for result, _ in valid:
+        result['status'] = 'ok'
+    return results, True
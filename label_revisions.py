@@ -0,0 +1,93 @@
+import datetime
+import zlib
+
+import shapely.wkb
+
+from audit_log import insert_logs, log_row
+from geometry import format_geometry, parse_wkt
+from label_batch import record_revisions
+from spatial_index import index_labels
+
+
+REVISION_COLUMNS = 'label_id, version, class_id, geometry, geometry_wkb, deleted, updated_by, modified_at_epoch'
+
+
+def revision_geometry(row):
+    # the revision's shapely geometry, or None if it was stored as invalid wkt
+    if row['geometry_wkb'] is not None:
+        return shapely.wkb.loads(zlib.decompress(row['geometry_wkb']))
+    try:
+        return parse_wkt(row['geometry'])
+    except ValueError:
+        return None
+
+
+def revision_to_dict(row, fmt='wkt'):
+    """A revision in the api's format, with its geometry as wkt, geojson or hex encoded wkb."""
+    data = dict(row)
+    # wkt is the text the label was given. Revisions from before that was kept only have their wkb,
+    # and all there is of an invalid geometry is its text, so it has no other format
+    if fmt != 'wkt' or row['geometry'] is None:
+        data['geometry'] = format_geometry(revision_geometry(row), fmt)
+    data.pop('geometry_wkb')
+    data['modified_at'] = datetime.datetime.fromtimestamp(row['modified_at_epoch'], datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return data
+
+
+def label_history(cur, label_id):
+    # every revision of a label, oldest first
+    return cur.execute(f"""
+        SELECT {REVISION_COLUMNS}
+        FROM LabelRevisions
+        WHERE label_id=:label_id
+        ORDER BY version
+        """, {'label_id': label_id}).fetchall()
+
+
+def label_as_of(cur, label_id, epoch):
+    """
+    The revision of a label that was current at `epoch`, UTC seconds, or None if it didn't exist
+    yet. Every revision is a whole copy of the label, so this is a single lookup on the primary
+    key rather than a replay of its history.
+    """
+    return cur.execute(f"""
+        SELECT {REVISION_COLUMNS}
+        FROM LabelRevisions
+        WHERE label_id=:label_id AND modified_at_epoch <= :epoch
+        ORDER BY version DESC
+        LIMIT 1
+        """, {'label_id': label_id, 'epoch': epoch}).fetchone()
+
+
+def revert_label(cur, label_id, version, username, write_logs=insert_logs):
+    """
+    Put a label's class and geometry back to what they were at `version`, undeleting it if it has
+    since been deleted. The revert is a new version, so the history is never rewritten. Raises
+    LookupError if there's no such version, and ValueError if the label was deleted at it.
+    Returns the new version. The log is written with `write_logs`, and the caller commits.
+    """
+    target = cur.execute(f"""
+        SELECT {REVISION_COLUMNS}
+        FROM LabelRevisions
+        WHERE label_id=:label_id AND version=:version
+        """, {'label_id': label_id, 'version': version}).fetchone()
+    if target is None:
+        raise LookupError('Revision not found')
+    if target['deleted']:
+        raise ValueError('The label was deleted at that version, delete it instead')
+
+    geom = revision_geometry(target)
+    cur.execute("""
+        UPDATE Labels
+        SET class_id=:class_id, geometry=:geometry, geometry_wkb=:geometry_wkb, deleted=0, version=version+1
+        WHERE label_id=:label_id
+        """, {
+            'label_id': label_id,
+            'class_id': target['class_id'],
+            'geometry': target['geometry'] if target['geometry'] is not None else geom.wkt,
+            'geometry_wkb': zlib.decompress(target['geometry_wkb']) if target['geometry_wkb'] is not None else None,
+            })
+    index_labels(cur, [(label_id, geom)])
+    write_logs(cur, [log_row('Label', username, 'UPDATE', None, label_id)])
+    record_revisions(cur, [label_id], username)
+    return cur.execute('SELECT version FROM Labels WHERE label_id=:label_id', {'label_id': label_id}).fetchone()[0]
@@ -0,0 +1,232 @@
+import bisect
+import contextlib
+import cProfile
+import math
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+# seconds, from a cached lookup up to a slow OCR
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """
+    A Prometheus histogram, with a set of bucket counts, a sum and a count for each combination
+    of label values. Thread safe, and cheap enough to observe every sql statement with.
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return series[2] if series is not None else 0
+
+    def collect(self):
+        with self._lock:
+            series = {labels: ([*counts], total, count) for labels, (counts, total, count) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames + ("le",), labels + (format_value(bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labelnames + ("le",), labels + ("+Inf",))} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class CacheMetrics:
+    """
+    Hit and miss counters, and the hit ratio, of the in-memory caches, read from their own
+    hits and misses when scraped. `caches` maps a name to a function returning the cache, or
+    None if it isn't in use.
+    """
+    def __init__(self, caches):
+        self.caches = caches
+
+    def collect(self):
+        counts = []
+        for name, get_cache in self.caches.items():
+            cache = get_cache()
+            if cache is not None:
+                counts.append((name, cache.hits, cache.misses))
+        lines = ['# HELP cache_hits_total Lookups answered from the cache.', '# TYPE cache_hits_total counter']
+        lines += [f'cache_hits_total{format_labels(("cache",), (name,))} {hits}' for name, hits, _ in counts]
+        lines += ['# HELP cache_misses_total Lookups the cache could not answer.', '# TYPE cache_misses_total counter']
+        lines += [f'cache_misses_total{format_labels(("cache",), (name,))} {misses}' for name, _, misses in counts]
+        lines += ['# HELP cache_hit_ratio Fraction of lookups answered from the cache since the process started.',
+            '# TYPE cache_hit_ratio gauge']
+        lines += [f'cache_hit_ratio{format_labels(("cache",), (name,))} {format_value(hits / (hits + misses) if hits + misses else 0)}'
+            for name, hits, misses in counts]
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        # the Prometheus text exposition format
+        with self._lock:
+            metrics = list(self.metrics)
+        return ''.join(line + '\n' for metric in metrics for line in metric.collect())
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+# every process has one registry, which /metrics renders
+registry = MetricsRegistry()
+request_seconds = registry.histogram('http_request_duration_seconds',
+    'Time to handle a request, up to the start of a streamed body.', ('route', 'method', 'status'))
+sql_seconds = registry.histogram('sql_query_duration_seconds',
+    'Time in sqlite, by the kind of statement. Rows read with fetchone, fetchmany or fetchall are counted as FETCH.', ('statement',))
+commit_seconds = registry.histogram('sql_commit_duration_seconds', 'Time to commit a transaction.')
+password_seconds = registry.histogram('password_check_duration_seconds',
+    'Time to check a password against its hash, when the credential cache could not answer.')
+pii_scan_seconds = registry.histogram('pii_scan_duration_seconds', 'Time for a background job to scan an image for pii.')
+ocr_seconds = registry.histogram('ocr_duration_seconds', 'Time tesseract takes to read an image region, in this process.')
+
+
+def statement_kind(sql):
+    # SELECT, INSERT and so on, to label sql timings without one series per query
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor which records the time of every statement, and of reading its rows, in sql_seconds."""
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            sql_seconds.observe(time.perf_counter() - start, statement_kind(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            sql_seconds.observe(time.perf_counter() - start, statement_kind(sql))
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            sql_seconds.observe(time.perf_counter() - start, 'FETCH')
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            sql_seconds.observe(time.perf_counter() - start, 'FETCH')
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            sql_seconds.observe(time.perf_counter() - start, 'FETCH')
+
+
+class TimedConnection(sqlite3.Connection):
+    """A connection whose cursors are TimedCursors, and whose commits are timed."""
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with commit_seconds.time():
+            super().commit()
+
+
+class SlowRequestProfiler:
+    """
+    Profiles a request with cProfile, and keeps the profile if the request took longer than
+    `threshold` seconds. Profiles are written to `profile_dir` as .prof files, which can be read
+    with pstats or snakeviz. Only one profiler can run at a time on Python 3.12 and later, so
+    there, requests which overlap one being profiled aren't.
+    """
+    def __init__(self, threshold, profile_dir):
+        self.threshold = threshold
+        self.profile_dir = Path(profile_dir)
+        self.dumped = 0
+
+    def start(self):
+        # the running profiler, or None if another one is already running
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        return profiler
+
+    def stop(self, profiler, elapsed, name):
+        # returns the path the profile was written to, if the request was slow enough
+        profiler.disable()
+        if elapsed < self.threshold:
+            return None
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        safe_name = re.sub('[^A-Za-z0-9]+', '_', name).strip('_')
+        path = self.profile_dir.joinpath(f'{time.strftime("%Y%m%d-%H%M%S")}-{int(elapsed * 1000)}ms-{safe_name}-{threading.get_ident()}.prof')
+        profiler.dump_stats(str(path))
+        self.dumped += 1
+        return path
@@ -0,0 +1,120 @@
+from PIL import Image, ImageChops, ImageFilter
+
+
+def downscale_factor(im, target_dpi=300, max_size=2000):
+    """
+    How much to shrink an image by so it's at most `target_dpi`, if it's recorded at a higher
+    resolution, and its longest side is at most `max_size`. Images are never scaled up.
+    """
+    scale = 1.0
+    dpi = im.info.get('dpi')
+    if target_dpi and dpi and dpi[0] and dpi[0] > target_dpi:
+        scale = target_dpi / float(dpi[0])
+    if max_size and max(im.size) * scale > max_size:
+        scale = max_size / float(max(im.size))
+    return min(scale, 1.0)
+
+
+def _resize(im, scale, resample=Image.LANCZOS):
+    if scale >= 1.0:
+        return im
+    return im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), resample, reducing_gap=2.0)
+
+
+def _components(cells):
+    # groups of candidate cells, joining cells up to two apart horizontally so the letters of a line stay together
+    seen = set()
+    for start in cells:
+        if start in seen:
+            continue
+        seen.add(start)
+        group = [start]
+        todo = [start]
+        while todo:
+            x, y = todo.pop()
+            for dx in (-2, -1, 0, 1, 2):
+                for dy in (-1, 0, 1):
+                    neighbour = (x + dx, y + dy)
+                    if neighbour in cells and neighbour not in seen:
+                        seen.add(neighbour)
+                        group.append(neighbour)
+                        todo.append(neighbour)
+        yield group
+
+
+def _merge_boxes(boxes):
+    # merge overlapping boxes until none overlap
+    boxes = sorted(boxes)
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for i, other in enumerate(result):
+                if box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]:
+                    result[i] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return boxes
+
+
+def find_text_regions(im, analysis_size=512, cell_size=8, edge_threshold=64, min_cell_density=0.12,
+        min_region_cells=3, margin_cells=1):
+    """
+    Boxes (left, top, right, bottom) of the parts of an image which look like text.
+
+    Burned in text is made of small, sharp, high contrast strokes, while anatomy mostly has
+    soft edges. On a small copy of the image, the difference between a max and a min filter
+    marks the sharp edges, and the image is split into cells of `cell_size` pixels. Cells with
+    enough sharp edges are grouped, and groups of fewer than `min_region_cells` cells are
+    dropped as noise. Anything bigger is kept, as cropping too much only costs OCR time.
+    """
+    small = _resize(im, analysis_size / float(max(im.size)), Image.BOX).convert('L')
+    edges = ImageChops.difference(small.filter(ImageFilter.MaxFilter(3)), small.filter(ImageFilter.MinFilter(3)))
+    edges = edges.point(lambda value: 255 if value >= edge_threshold else 0)
+
+    # each pixel of the grid is the fraction of a cell's pixels which are sharp edges
+    grid_width = max(1, small.width // cell_size)
+    grid_height = max(1, small.height // cell_size)
+    grid = edges.resize((grid_width, grid_height), Image.BOX)
+    pixels = grid.load()
+    cells = {(x, y) for y in range(grid_height) for x in range(grid_width) if pixels[x, y] >= min_cell_density * 255}
+
+    boxes = []
+    cell_width = im.width / float(grid_width)
+    cell_height = im.height / float(grid_height)
+    for group in _components(cells):
+        xs = [x for x, _ in group]
+        ys = [y for _, y in group]
+        left, top, right, bottom = min(xs), min(ys), max(xs) + 1, max(ys) + 1
+        if len(group) < min_region_cells:
+            continue
+        boxes.append((
+            max(0, int((left - margin_cells) * cell_width)),
+            max(0, int((top - margin_cells) * cell_height)),
+            min(im.width, int((right + margin_cells) * cell_width + 0.5)),
+            min(im.height, int((bottom + margin_cells) * cell_height + 0.5)),
+            ))
+    return _merge_boxes(boxes)
+
+
+def preprocess_for_ocr(im, grayscale=True, target_dpi=300, max_size=2000, detect_regions=True, **region_options):
+    """
+    The images to pass to OCR in place of `im`: cropped to the regions which might hold text,
+    converted to grayscale and downscaled. An empty list means no text was found.
+
+    The regions are cropped before anything else, so only the pixels that are kept get
+    converted and resized. region_options are passed to find_text_regions.
+    """
+    boxes = find_text_regions(im, **region_options) if detect_regions else [(0, 0, im.width, im.height)]
+    scale = downscale_factor(im, target_dpi, max_size)
+    regions = []
+    for box in boxes:
+        region = im.crop(box)
+        if grayscale and region.mode != 'L':
+            region = region.convert('L')
+        regions.append(_resize(region, scale))
+    return regions
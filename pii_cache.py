@@ -0,0 +1,104 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def hash_image(im_path, chunk_size=1 << 20):
+    # hash the file contents, so the same image under a different path is a cache hit
+    h = hashlib.blake2b(digest_size=20)
+    with open(im_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PiiCache:
+    """
+    Persistent cache of pii scan results, keyed by a hash of the image bytes.
+
+    Each entry holds the words tesseract found, in the order it found them, and the verdict,
+    along with the version of the suspicious word dictionary the verdict was made with. The
+    least recently used entries over `max_entries` are evicted every `evict_every` stores, so
+    the table isn't counted on every insert, and can run that many entries over in between.
+    """
+    def __init__(self, db_path, max_entries=100000, evict_every=100):
+        self.db_path = str(db_path)
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._created = False
+        self._stores = 0
+
+    def _connect(self):
+        # a short lived connection per call, so the cache can be shared by threads and worker processes
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._created:
+            conn.execute('''CREATE TABLE IF NOT EXISTS PiiCache
+                (content_hash TEXT PRIMARY KEY,
+                words TEXT,
+                contains_pii INTEGER,
+                dictionary_version TEXT,
+                last_used REAL)
+                ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS PiiCache_last_used ON PiiCache(last_used)')
+            conn.commit()
+            self._created = True
+        return conn
+
+    def lookup(self, content_hash):
+        """Returns (words, contains_pii, dictionary_version), or None if the image hasn't been scanned."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                'SELECT words, contains_pii, dictionary_version FROM PiiCache WHERE content_hash=:hash',
+                {'hash': content_hash}).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+            # mark as recently used
+            conn.execute('UPDATE PiiCache SET last_used=:now WHERE content_hash=:hash',
+                {'now': time.time(), 'hash': content_hash})
+            conn.commit()
+        finally:
+            conn.close()
+
+        words, contains_pii, dictionary_version = row
+        return json.loads(words), bool(contains_pii), dictionary_version
+
+    def store(self, content_hash, words, contains_pii, dictionary_version):
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO PiiCache (content_hash, words, contains_pii, dictionary_version, last_used)
+                VALUES (:hash, :words, :contains_pii, :version, :now)
+                ''', {
+                    'hash': content_hash,
+                    'words': json.dumps(list(words)),
+                    'contains_pii': int(contains_pii),
+                    'version': dictionary_version,
+                    'now': time.time()
+                    })
+
+            # evict the least recently used entries over the limit
+            self._stores += 1
+            if self._stores % self.evict_every == 0:
+                conn.execute('''
+                    DELETE FROM PiiCache WHERE content_hash IN
+                    (SELECT content_hash FROM PiiCache ORDER BY last_used
+                    LIMIT max(0, (SELECT count(*) FROM PiiCache) - :max_entries))
+                    ''', {'max_entries': self.max_entries})
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM PiiCache')
+            conn.commit()
+        finally:
+            conn.close()
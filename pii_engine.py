@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from identify_pii import check_for_pii
+
+
+logger = logging.getLogger(__name__)
+
+# result of scanning a single image. error is None when contains_pii is valid
+PiiResult = namedtuple('PiiResult', ['path', 'contains_pii', 'error'])
+
+
+class PiiScanError(Exception):
+    pass
+
+
+class PiiEngine:
+    """
+    Spreads check_for_pii over a pool of worker processes, so OCR can use every core.
+
+    Each image gets `timeout` seconds in a worker. A worker that hangs or crashes takes the
+    whole pool down with it, so the pool is recycled and any other in-flight images are
+    resubmitted. Only a crash counts against an image's `max_retries`, an image that was
+    caught up in another image's timeout is resubmitted for free.
+    """
+    def __init__(self, num_workers=None, timeout=60, max_retries=1, scanner=check_for_pii):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.scanner = scanner
+
+        self._executor = None
+        self._lock = threading.Lock()
+        # pools killed because an image hung, rather than because a worker crashed
+        self._timed_out = weakref.WeakSet()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+            return self._executor
+
+    def _recycle(self, executor, timed_out=False):
+        # kill the workers outright, a hung tesseract process won't stop on its own
+        with self._lock:
+            if self._executor is not executor:
+                # another thread already replaced it
+                return
+            self._executor = None
+            if timed_out:
+                self._timed_out.add(executor)
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def check(self, path):
+        """Scan a single image in the pool, blocking until it's done. Raises PiiScanError on failure."""
+        attempt = 0
+        while True:
+            executor = self._get_executor()
+            try:
+                future = executor.submit(self.scanner, path)
+            except (BrokenProcessPool, RuntimeError):
+                # the pool broke or was recycled between us getting it and using it, neither was our image's doing
+                self._recycle(executor)
+                continue
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                self._recycle(executor, timed_out=True)
+                raise PiiScanError(f'PII scan of {path} timed out after {self.timeout}s')
+            except (BrokenProcessPool, CancelledError):
+                if executor in self._timed_out:
+                    # killed for another caller's hung image, not our fault
+                    continue
+                # our worker crashed, or another caller's did and took ours with it
+                self._recycle(executor)
+                attempt += 1
+                logger.warning('PII worker crashed scanning %s (attempt %s)', path, attempt)
+                if attempt > self.max_retries:
+                    raise PiiScanError(f'PII worker crashed scanning {path}')
+
+    def scan(self, paths):
+        """
+        Scan a batch of images, yielding a PiiResult for each one in the order they finish.
+
+        Only as many images as there are workers are submitted at a time, so the time an image
+        has been in flight is the time it has been running, and huge batches aren't all held
+        in the executor's queue at once.
+        """
+        paths = iter(paths)
+        retries = deque()
+        in_flight = {}  # future -> (path, started, attempts)
+        executor = self._get_executor()
+
+        def fill():
+            while len(in_flight) < self.num_workers:
+                if retries:
+                    path, attempts = retries.popleft()
+                else:
+                    path = next(paths, None)
+                    attempts = 0
+                    if path is None:
+                        return
+                in_flight[executor.submit(self.scanner, path)] = (path, time.monotonic(), attempts)
+
+        fill()
+        while in_flight:
+            oldest = min(started for _, started, _ in in_flight.values())
+            done, _ = wait(in_flight, timeout=max(0, oldest + self.timeout - time.monotonic()),
+                return_when=FIRST_COMPLETED)
+
+            broken = False
+            for future in done:
+                path, started, attempts = in_flight.pop(future)
+                try:
+                    yield PiiResult(path, future.result(), None)
+                except (BrokenProcessPool, CancelledError):
+                    if executor in self._timed_out:
+                        # a check() elsewhere timed out and recycled the shared pool
+                        retries.append((path, attempts))
+                        continue
+                    broken = True
+                    if attempts < self.max_retries:
+                        retries.append((path, attempts + 1))
+                    else:
+                        yield PiiResult(path, None, 'PII worker crashed')
+                except Exception as e:
+                    yield PiiResult(path, None, repr(e))
+
+            # anything over its time budget is reported, everything else in flight is resubmitted
+            now = time.monotonic()
+            timed_out = [f for f, (_, started, _) in in_flight.items() if now - started >= self.timeout]
+            for future in timed_out:
+                path, started, attempts = in_flight.pop(future)
+                yield PiiResult(path, None, f'PII scan timed out after {self.timeout}s')
+
+            if broken or timed_out or executor in self._timed_out:
+                for path, started, attempts in in_flight.values():
+                    retries.append((path, attempts + 1 if broken else attempts))
+                in_flight.clear()
+                self._recycle(executor, timed_out=not broken)
+                executor = self._get_executor()
+
+            fill()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scan images for pii, printing one json result per line')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    with PiiEngine(num_workers=args.workers, timeout=args.timeout) as engine:
+        for result in engine.scan(args.paths):
+            print(json.dumps(result._asdict()), flush=True)
@@ -0,0 +1,208 @@
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+
+from audit_log import insert_logs, log_row
+from db_pool import connect
+from identify_pii import check_for_pii
+from metrics import pii_scan_seconds
+
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class PiiJobQueue:
+    """
+    Runs PII scans in background worker threads instead of on the request path.
+
+    Jobs are persisted in the PiiJobs table, so anything left pending when the process stops is
+    picked up again on the next start. A running job belongs to the queue which claimed it, which
+    renews its lease on the job every `lease_seconds / 3` seconds. Any queue can take over a job
+    whose lease has run out, as its owner has died, so several processes can share the table
+    without scanning each other's jobs. When a scan finishes the verdict is
+    written to Images.contains_pii, which is NULL while the scan is outstanding, and logged as
+    an UPDATE of the image with no updated_by. The log is written in the verdict's transaction,
+    or when a `log_writer` is given, handed to it once the verdict has committed.
+    """
+    def __init__(self, db_path, images_dir, num_workers=2, max_attempts=3, poll_interval=1.0, scanner=check_for_pii,
+            lease_seconds=300, log_writer=None):
+        self.db_path = str(db_path)
+        self.images_dir = Path(images_dir)
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.scanner = scanner
+        self.lease_seconds = lease_seconds
+        self.log_writer = log_writer
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, cur, image_id, image_path):
+        # insert with the caller's cursor so the job commits in the same transaction as the image
+        insert_job_query = """
+            INSERT INTO PiiJobs (image_id, image_path, status, attempts, created_at, updated_at)
+            VALUES (:image_id, :image_path, :status, 0, datetime('now', 'localtime'), datetime('now', 'localtime'))
+            """
+        cur.execute(insert_job_query, {'image_id': image_id, 'image_path': str(image_path), 'status': JOB_PENDING})
+
+    def enqueue_many(self, cur, jobs):
+        # jobs is an iterable of (image_id, image_path)
+        insert_job_query = """
+            INSERT INTO PiiJobs (image_id, image_path, status, attempts, created_at, updated_at)
+            VALUES (?, ?, ?, 0, datetime('now', 'localtime'), datetime('now', 'localtime'))
+            """
+        cur.executemany(insert_job_query, ((image_id, str(image_path), JOB_PENDING) for image_id, image_path in jobs))
+
+    def notify(self):
+        # wake the workers once the enqueuing transaction has been committed
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            self._renew_leases()
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._worker_loop, name=f'pii-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._lease_loop, name='pii-leases', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def job_status(self, cur, image_id):
+        get_job_query = """
+            SELECT image_id, status, attempts, error, updated_at, contains_pii
+            FROM PiiJobs
+            JOIN Images USING(image_id)
+            WHERE image_id=:image_id
+            ORDER BY job_id DESC
+            LIMIT 1
+            """
+        row = cur.execute(get_job_query, {'image_id': image_id}).fetchone()
+        return None if row is None else dict(row)
+
+    def _connect(self):
+        return connect(self.db_path)
+
+    def _renew_leases(self):
+        # keep hold of this queue's running jobs, and put back any whose owner has stopped renewing them
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("UPDATE PiiJobs SET updated_at=datetime('now', 'localtime') WHERE status=:running AND owner=:owner",
+                    {'running': JOB_RUNNING, 'owner': self.owner})
+                r = conn.execute("""
+                    UPDATE PiiJobs SET status=:pending, owner=NULL
+                    WHERE status=:running AND updated_at < datetime('now', 'localtime', :expiry)
+                    """, {'pending': JOB_PENDING, 'running': JOB_RUNNING, 'expiry': f'-{self.lease_seconds} seconds'})
+                conn.commit()
+                if r.rowcount:
+                    self._wakeup.set()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            logger.exception('Could not renew PII job leases')
+
+    def _lease_loop(self):
+        while not self._stopping.wait(self.lease_seconds / 3):
+            self._renew_leases()
+
+    def _claim_job(self, conn):
+        row = conn.execute(
+            "SELECT job_id, image_id, image_path, attempts FROM PiiJobs WHERE status=:pending ORDER BY job_id LIMIT 1",
+            {'pending': JOB_PENDING}).fetchone()
+        if row is None:
+            return None
+
+        # only one worker can move the job out of pending, anyone else gets rowcount 0
+        r = conn.execute("""
+            UPDATE PiiJobs
+            SET status=:running, owner=:owner, attempts=attempts+1, updated_at=datetime('now', 'localtime')
+            WHERE job_id=:job_id AND status=:pending
+            """, {'running': JOB_RUNNING, 'pending': JOB_PENDING, 'owner': self.owner, 'job_id': row['job_id']})
+        conn.commit()
+        if r.rowcount != 1:
+            return None
+        return dict(row)
+
+    def _finish_job(self, conn, job, contains_pii, status, error=None):
+        r = conn.execute("""
+            UPDATE PiiJobs
+            SET status=:status, error=:error, owner=NULL, updated_at=datetime('now', 'localtime')
+            WHERE job_id=:job_id AND owner=:owner
+            """, {'status': status, 'error': error, 'job_id': job['job_id'], 'owner': self.owner})
+        if r.rowcount != 1:
+            # the lease ran out and another queue has the job now, so its result is the one kept
+            conn.rollback()
+            return
+        if contains_pii is not None:
+            conn.execute("UPDATE Images SET contains_pii=:contains_pii WHERE image_id=:image_id",
+                {'contains_pii': int(contains_pii), 'image_id': job['image_id']})
+            # log the verdict like any other change, so incremental exports and the response cache see it
+            logs = [log_row('Image', None, 'UPDATE', job['image_id'], None)]
+            if self.log_writer is None:
+                insert_logs(conn.cursor(), logs)
+        conn.commit()
+        if contains_pii is not None and self.log_writer is not None:
+            self.log_writer.write(logs)
+
+    def _run_job(self, conn, job):
+        try:
+            with pii_scan_seconds.time():
+                contains_pii = self.scanner(self.images_dir.joinpath(job['image_path']))
+        except Exception as e:
+            logger.exception('PII scan failed for image %s', job['image_id'])
+            if job['attempts'] + 1 < self.max_attempts:
+                self._finish_job(conn, job, None, JOB_PENDING, error=str(e))
+            else:
+                # out of retries. Prefer flagging the image to letting pii through unchecked
+                self._finish_job(conn, job, True, JOB_FAILED, error=str(e))
+            return
+        self._finish_job(conn, job, contains_pii, JOB_DONE)
+
+    def _worker_loop(self):
+        # each worker keeps its own connection, reopened if anything goes wrong with it
+        conn = None
+        while not self._stopping.is_set():
+            try:
+                if conn is None:
+                    conn = self._connect()
+                job = self._claim_job(conn)
+                if job is not None:
+                    self._run_job(conn, job)
+                    continue
+            except sqlite3.Error:
+                # the db may be missing or being recreated, try again on the next poll
+                logger.exception('PII worker could not reach the database')
+                if conn is not None:
+                    conn.close()
+                conn = None
+
+            # nothing to do, sleep until new work arrives or the next poll
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,269 @@
+import gc
+import hashlib
+import os
+import pickle
+import string
+from collections import deque
+from pathlib import Path
+
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation)
+
+# marks the end of a word in the character trie
+_END = ''
+
+# bump whenever PiiMatcher's attributes change, so older precompiled matchers are rebuilt
+MATCHER_FORMAT = 1
+
+
+def tokenize(text):
+    # lower case, strip punctuation and split on whitespace, the same way for patterns and ocr text
+    return text.lower().translate(_PUNCTUATION).split()
+
+
+def load_dictionary(path):
+    # one pattern per line, blank lines ignored
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def dictionaries_key(dictionaries, **options):
+    # identifies the matcher these dictionaries and options would build. Files are identified by their mtime and size
+    parts = [str(MATCHER_FORMAT), repr(sorted(options.items()))]
+    for dictionary in dictionaries:
+        if isinstance(dictionary, (str, Path)):
+            stat = os.stat(dictionary)
+            parts.append(f'{Path(dictionary).absolute()}:{stat.st_mtime_ns}:{stat.st_size}')
+        else:
+            parts.append('\n'.join(dictionary))
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+
+class PiiMatcher:
+    """
+    Finds dictionary words and phrases in a list of tokens, in a single pass.
+
+    The patterns are compiled once into a token level Aho-Corasick automaton, so multi word
+    phrases like "date of birth" cost no more to find than single words. Every token from the
+    patterns is also kept in a character trie, which is used to:
+
+    - rejoin words that OCR has split into pieces, eg. "jo hn", up to `max_join` tokens
+    - optionally match tokens within `max_edits` edits of a dictionary token, for tokens of at
+      least `min_fuzzy_length` characters. Short tokens are always matched exactly, otherwise
+      nearly every short word would be within an edit of a name
+
+    A matcher isn't changed by matching, apart from its cache of fuzzy lookups, so one can be
+    shared by every thread.
+    """
+    def __init__(self, patterns=(), max_edits=0, min_fuzzy_length=5, max_join=3, fuzzy_cache_size=100000):
+        self.max_edits = max_edits
+        self.min_fuzzy_length = min_fuzzy_length
+        self.max_join = max_join
+        self.fuzzy_cache_size = fuzzy_cache_size
+
+        self.patterns = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._trie = {}
+        self._vocabulary = set()
+        self._single_tokens = set()
+        self._join_prefixes = set()
+        self._phrases = []
+        self._fuzzy_cache = {}
+
+        seen = set()
+        for pattern in patterns:
+            tokens = tuple(tokenize(pattern))
+            if tokens and tokens not in seen:
+                seen.add(tokens)
+                self._add(tokens)
+        self._link()
+        self.version = hashlib.sha1('\n'.join(sorted(' '.join(p) for p in self.patterns)
+            + [f'{max_edits},{min_fuzzy_length},{max_join}']).encode()).hexdigest()
+
+    @classmethod
+    def from_dictionaries(cls, dictionaries, **options):
+        """Build a matcher from several dictionaries, each either a list of patterns or the path of a file of them."""
+        patterns = []
+        for dictionary in dictionaries:
+            if isinstance(dictionary, (str, Path)):
+                dictionary = load_dictionary(dictionary)
+            patterns.extend(dictionary)
+        return cls(patterns, **options)
+
+    def __getstate__(self):
+        # the fuzzy lookups are only a cache, so aren't worth saving
+        state = dict(self.__dict__)
+        state['_fuzzy_cache'] = {}
+        return state
+
+    def save(self, path, key=None):
+        """Write the compiled matcher to disk, tagged with `key` so a stale one can be spotted."""
+        # written to a temporary file first, so other processes never load a partial one
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, key=None):
+        """
+        A matcher saved by `save`, or None if there isn't one or it was saved with another key.
+
+        This unpickles the file, so only load matchers this app saved itself.
+        """
+        try:
+            with open(path, 'rb') as f:
+                # the garbage collector would otherwise keep walking the trie while it's still being built
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    saved_key, matcher = pickle.load(f)
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+            return None
+        if saved_key != key or not isinstance(matcher, cls):
+            return None
+        return matcher
+
+    def _add(self, tokens):
+        pattern_id = len(self.patterns)
+        self.patterns.append(tokens)
+        self._vocabulary.update(tokens)
+        if len(tokens) == 1:
+            self._single_tokens.add(tokens[0])
+            self._join_prefixes.update(tokens[0][:i] for i in range(1, len(tokens[0])))
+        else:
+            self._phrases.append(tokens)
+
+        state = 0
+        for token in tokens:
+            node = self._trie
+            for char in token:
+                node = node.setdefault(char, {})
+            node[_END] = token
+
+            if token not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][token] = len(self._goto) - 1
+            state = self._goto[state][token]
+        self._output[state].append(pattern_id)
+
+    def _link(self):
+        # breadth first, so a state's failure link is always resolved before its children's
+        todo = deque(self._goto[0].values())
+        while todo:
+            state = todo.popleft()
+            for token, child in self._goto[state].items():
+                todo.append(child)
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def _step(self, state, token):
+        while state and token not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(token, 0)
+
+    def _fuzzy(self, token):
+        # dictionary tokens within max_edits of token, by walking the trie a row of the edit distance table at a time
+        cached = self._fuzzy_cache.get(token)
+        if cached is not None:
+            return cached
+
+        found = set()
+        first_row = list(range(len(token) + 1))
+        todo = [(self._trie, char, first_row) for char in self._trie if char != _END]
+        while todo:
+            parent, char, prev_row = todo.pop()
+            node = parent[char]
+            row = [prev_row[0] + 1]
+            for i, token_char in enumerate(token, start=1):
+                row.append(min(row[i - 1] + 1, prev_row[i] + 1, prev_row[i - 1] + (token_char != char)))
+            if row[-1] <= self.max_edits and _END in node:
+                found.add(node[_END])
+            if min(row) <= self.max_edits:
+                todo.extend((node, next_char, row) for next_char in node if next_char != _END)
+
+        found = frozenset(found)
+        if len(self._fuzzy_cache) >= self.fuzzy_cache_size:
+            self._fuzzy_cache.clear()
+        self._fuzzy_cache[token] = found
+        return found
+
+    def _candidates(self, token):
+        # the dictionary tokens this token could be
+        if self.max_edits and len(token) >= self.min_fuzzy_length:
+            return self._fuzzy(token)
+        return (token,) if token in self._vocabulary else ()
+
+    def _joined(self, tokens, start):
+        # a single token pattern spread over tokens[start:start + max_join], or None
+        if tokens[start] not in self._join_prefixes:
+            return None
+        node = self._trie
+        for end in range(start, min(start + self.max_join, len(tokens))):
+            for char in tokens[end]:
+                node = node.get(char)
+                if node is None:
+                    return None
+            if end > start and node.get(_END) in self._single_tokens:
+                return node[_END]
+        return None
+
+    def find(self, tokens, ordered=True):
+        """
+        Yields (index, pattern) for each pattern found, with the index of the token it starts at.
+
+        If the tokens aren't in their original order, eg. they've been deduplicated into a set,
+        pass ordered=False. Phrases then match whenever all their tokens are present, which
+        can flag too much but never misses one, and split words can't be rejoined.
+        """
+        tokens = list(tokens)
+        if not ordered:
+            present = set()
+            for token in tokens:
+                present.update(self._candidates(token))
+            for token in sorted(present & self._single_tokens):
+                yield None, token
+            for phrase in self._phrases:
+                if all(token in present for token in phrase):
+                    yield None, ' '.join(phrase)
+            return
+
+        # each token can be read as several dictionary tokens when matching fuzzily, so track every state it leads to
+        states = {0}
+        for index, token in enumerate(tokens):
+            candidates = self._candidates(token)
+            if candidates:
+                states = {self._step(state, candidate) for state in states for candidate in candidates}
+                for state in states:
+                    for pattern_id in self._output[state]:
+                        pattern = self.patterns[pattern_id]
+                        yield index - len(pattern) + 1, ' '.join(pattern)
+            else:
+                states = {0}
+
+            if self.max_join > 1:
+                joined = self._joined(tokens, index)
+                if joined is not None:
+                    yield index, joined
+
+    def matches(self, tokens, ordered=True):
+        # True as soon as any pattern is found
+        if not self.max_edits:
+            # most text has nothing in it that could start a match, which sets can rule out without a python loop
+            tokens = list(tokens)
+            present = set(tokens)
+            if self._vocabulary.isdisjoint(present) and (self.max_join < 2 or self._join_prefixes.isdisjoint(present)):
+                return False
+        for _ in self.find(tokens, ordered):
+            return True
+        return False
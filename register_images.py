@@ -0,0 +1,149 @@
+import argparse
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from audit_log import insert_logs, log_row
+from identify_pii import lookup_cached_pii
+from image_db.create_db import find_images, migrate
+from pii_engine import PiiEngine
+
+
+IMAGES_DIR = Path(__file__).absolute().parent.joinpath('static', 'images')
+DB_PATH = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+
+
+def resolve_image_path(image_path, images_dir=IMAGES_DIR):
+    """
+    Check that an image path is an existing file within the images dir.
+    Returns (absolute path, error message), one of which will be None.
+    """
+    images_dir = Path(images_dir)
+    # resolve '..' and symlinks before checking, so the path can't escape the images dir
+    resolved_dir = images_dir.resolve()
+    resolved_path = images_dir.joinpath(image_path).resolve()
+    if not resolved_dir in resolved_path.parents:
+        return None, 'Image should be in a direcotry within static/images'
+    if not resolved_path.is_file():
+        return None, 'Image does not exist at specified path'
+    return images_dir.joinpath(resolved_path.relative_to(resolved_dir)), None
+
+
+def _check_image(image_path, images_dir):
+    provided_path, message = resolve_image_path(image_path, images_dir)
+    if provided_path is None:
+        return {'image_path': str(image_path), 'image_id': None, 'status': 'error', 'message': message}
+
+    # an image which has been scanned before doesn't need to go near tesseract
+    return {
+        'image_path': str(provided_path.relative_to(images_dir)),
+        'abs_path': provided_path,
+        'contains_pii': lookup_cached_pii(provided_path)
+        }
+
+
+def register_images(conn, image_paths, username, images_dir=IMAGES_DIR, engine=None, queue=None, batch_size=500, io_workers=16,
+        write_logs=insert_logs):
+    """
+    Insert many images into the db at once, returning a result for each path in the order given.
+
+    The filesystem checks and cache lookups run in a thread pool. Images which aren't cached
+    are either scanned in `engine`'s process pool, or when a `queue` is given left pending and
+    handed to the background pii workers. Rows are inserted `batch_size` at a time, with one
+    transaction per batch. Each batch's logs are written with `write_logs`, just before it commits.
+    """
+    images_dir = Path(images_dir)
+    with ThreadPoolExecutor(max_workers=io_workers) as pool:
+        results = list(pool.map(lambda path: _check_image(path, images_dir), image_paths))
+
+    to_insert = [result for result in results if 'abs_path' in result]
+    if queue is None:
+        # scan everything that wasn't cached now, once per file even if it's listed more than once
+        to_scan = {}
+        for result in to_insert:
+            if result['contains_pii'] is None:
+                to_scan.setdefault(result['abs_path'], []).append(result)
+        if to_scan:
+            own_engine = engine is None
+            engine = engine or PiiEngine()
+            try:
+                for scan in engine.scan(list(to_scan)):
+                    for result in to_scan[scan.path]:
+                        # a failed scan is treated as containing pii
+                        result['contains_pii'] = True if scan.error else scan.contains_pii
+            finally:
+                if own_engine:
+                    engine.shutdown()
+
+    insert_image_query = """
+        INSERT INTO Images (image_path, deleted, contains_pii)
+        VALUES (?, 0, ?)
+        """
+    cur = conn.cursor()
+    for start in range(0, len(to_insert), batch_size):
+        batch = to_insert[start:start + batch_size]
+        try:
+            cur.executemany(insert_image_query, [
+                (result['image_path'], None if result['contains_pii'] is None else int(result['contains_pii']))
+                for result in batch])
+
+            # the write lock is held for the whole transaction, so the new ids are consecutive
+            last_id = cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+            for image_id, result in enumerate(batch, start=last_id - len(batch) + 1):
+                result['image_id'] = image_id
+
+            if queue is not None:
+                queue.enqueue_many(cur, [(result['image_id'], result['image_path'])
+                    for result in batch if result['contains_pii'] is None])
+            write_logs(cur, [log_row('Image', username, 'INSERTION', result['image_id'], None) for result in batch])
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            for result in batch:
+                result.update({'image_id': None, 'status': 'error', 'message': f'Problem inserting new image: {e}'})
+            continue
+
+        for result in batch:
+            result['status'] = 'inserted'
+
+    # tidy up the report
+    for result in results:
+        result.pop('abs_path', None)
+        if result.get('status') == 'inserted':
+            result['contains_pii'] = 'pending' if result['contains_pii'] is None else int(result['contains_pii'])
+    if queue is not None:
+        queue.notify()
+    return results
+
+
+def list_image_paths(sub_dir, images_dir=IMAGES_DIR, pattern='*.jpeg'):
+    # every image in a subdirectory of static/images, relative to static/images
+    images_dir = Path(images_dir)
+    if not (images_dir.joinpath(sub_dir).resolve() == images_dir.resolve()
+            or images_dir.resolve() in images_dir.joinpath(sub_dir).resolve().parents):
+        raise ValueError('Directory should be within static/images')
+    return [str(path) for path in find_images(images_dir, sub_dir, pattern)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register many images in the db, printing a json report')
+    parser.add_argument('paths', nargs='*', help='image paths relative to static/images')
+    parser.add_argument('--directory', help='register every image in this subdirectory of static/images')
+    parser.add_argument('--pattern', default='*.jpeg')
+    parser.add_argument('--user', required=True, help='username to log the insertions against')
+    parser.add_argument('--db', default=str(DB_PATH))
+    parser.add_argument('--workers', type=int, default=None, help='number of pii scanning processes')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    image_paths = list(args.paths)
+    if args.directory:
+        image_paths += list_image_paths(args.directory, pattern=args.pattern)
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    with PiiEngine(num_workers=args.workers) as engine:
+        results = register_images(conn, image_paths, args.user, engine=engine, batch_size=args.batch_size)
+    conn.close()
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    LRU cache of serialized GET responses, each stored with its ETag.
+
+    Entries are keyed by (kind, id, variant), eg. ('label', 4, 'geojson'), and every variant of
+    an image or label is dropped together when it's written. The cache is bounded both by the
+    number of entries and by the total size of their bodies.
+
+    Every write to images and labels is logged, so `sync` catches up with writes made by other
+    processes, or by this one, by reading the Logs table written since it last looked. A new
+    schema, as when the db is rebuilt, drops everything. Entries also expire after `ttl`
+    seconds, which bounds how stale they can get after a write that isn't logged.
+
+    A response read before a write commits could be put after the write's invalidation, so
+    callers take `generation` before querying and pass it to put, which skips the response if
+    anything has been invalidated since.
+    """
+    def __init__(self, max_entries=4096, max_bytes=32 * 1024 * 1024, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped by every invalidation
+
+        self._entries = OrderedDict()  # (kind, id, variant) -> (body, etag, expiry)
+        self._variants = {}  # (kind, id) -> set of variants cached
+        self._bytes = 0
+        self._seen = None  # (schema_version, last log_id) as of the last sync
+        self._lock = threading.Lock()
+
+    def sync(self, cur):
+        # invalidate whatever has been written since the last sync, through any connection
+        schema_version = cur.execute('PRAGMA schema_version').fetchone()[0]
+        last_log_id = cur.execute('SELECT max(log_id) FROM Logs').fetchone()[0] or 0
+        seen = self._seen
+        if seen == (schema_version, last_log_id):
+            return
+        if seen is None or seen[0] != schema_version or last_log_id < seen[1]:
+            self.invalidate()
+        else:
+            rows = cur.execute("""
+                SELECT object, image_id, label_id
+                FROM Logs
+                WHERE log_id > :seen AND log_id <= :last
+                """, {'seen': seen[1], 'last': last_log_id}).fetchall()
+            self.invalidate('image', {row[1] for row in rows if row[0] == 'Image'})
+            self.invalidate('label', {row[2] for row in rows if row[0] == 'Label'})
+        self._seen = (schema_version, last_log_id)
+
+    def get(self, kind, key, variant=None):
+        # (body, etag), or None if it isn't cached or has expired
+        with self._lock:
+            entry = self._entries.get((kind, key, variant))
+            if entry is not None and entry[2] > time.monotonic():
+                self._entries.move_to_end((kind, key, variant))
+                self.hits += 1
+                return entry[0], entry[1]
+            if entry is not None:
+                self._remove((kind, key, variant))
+            self.misses += 1
+            return None
+
+    def put(self, kind, key, body, variant=None, generation=None):
+        # cache a response body, returning its etag
+        etag = make_etag(body)
+        if len(body) > self.max_bytes:
+            return etag
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return etag
+            if (kind, key, variant) in self._entries:
+                self._remove((kind, key, variant))
+            self._entries[(kind, key, variant)] = (body, etag, time.monotonic() + self.ttl)
+            self._variants.setdefault((kind, key), set()).add(variant)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return etag
+
+    def invalidate(self, kind=None, keys=None):
+        # forget some images or labels, everything of one kind, or everything
+        with self._lock:
+            self.generation += 1
+            if kind is None:
+                self._entries.clear()
+                self._variants.clear()
+                self._bytes = 0
+            elif keys is None:
+                for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == kind]:
+                    self._remove(entry_key)
+            else:
+                for key in keys:
+                    for variant in list(self._variants.get((kind, key), ())):
+                        self._remove((kind, key, variant))
+
+    def _remove(self, entry_key):
+        body, _, _ = self._entries.pop(entry_key)
+        self._bytes -= len(body)
+        variants = self._variants[entry_key[:2]]
+        variants.discard(entry_key[2])
+        if not variants:
+            del self._variants[entry_key[:2]]
+
+
+def make_etag(body):
+    # a strong etag from the response body, so identical responses share it whichever process made them
+    return hashlib.blake2b(body.encode() if isinstance(body, str) else body, digest_size=16).hexdigest()
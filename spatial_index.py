@@ -0,0 +1,81 @@
+import shapely.geometry
+from shapely.validation import make_valid
+
+from geometry import WKT_ERROR, row_geometry
+
+
+def bounds_row(label_id, geom):
+    # (label_id, min_x, max_x, min_y, max_y) in the order of the rtree's columns, or None if empty
+    if geom is None or geom.is_empty:
+        return None
+    min_x, min_y, max_x, max_y = geom.bounds
+    return (label_id, min_x, max_x, min_y, max_y)
+
+
+def index_labels(cur, labels):
+    """Add or move labels in the spatial index. labels is an iterable of (label_id, shapely geometry)."""
+    rows = []
+    removed = []
+    for label_id, geom in labels:
+        row = bounds_row(label_id, geom)
+        if row is None:
+            removed.append(label_id)
+        else:
+            rows.append(row)
+    cur.executemany("INSERT OR REPLACE INTO LabelsRtree (label_id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)", rows)
+    unindex_labels(cur, removed)
+
+
+def unindex_labels(cur, label_ids):
+    cur.executemany("DELETE FROM LabelsRtree WHERE label_id=?", [(label_id,) for label_id in label_ids])
+
+
+def parse_bbox(bbox):
+    # "min_x,min_y,max_x,max_y" to a shapely box
+    try:
+        min_x, min_y, max_x, max_y = (float(value) for value in bbox.split(','))
+    except ValueError:
+        raise ValueError('bbox should be min_x,min_y,max_x,max_y')
+    return shapely.geometry.box(min_x, min_y, max_x, max_y)
+
+
+def query_intersecting(cur, image_id, region, class_id=None):
+    """
+    Label rows on an image whose geometry intersects region, a shapely geometry.
+
+    The rtree narrows the labels down to those whose bounding boxes overlap the region's, and
+    only those are parsed and tested exactly.
+    """
+    min_x, min_y, max_x, max_y = region.bounds
+    query = """
+        SELECT image_id, label_id, image_path, username, first_name, last_name, class_id, geometry,
+            geometry_wkb, version
+        FROM LabelsRtree
+        JOIN Labels USING(label_id)
+        JOIN Images USING(image_id)
+        JOIN Users ON labels.labelled_by = users.username
+        WHERE LabelsRtree.max_x >= :min_x AND LabelsRtree.min_x <= :max_x
+        AND LabelsRtree.max_y >= :min_y AND LabelsRtree.min_y <= :max_y
+        AND labels.image_id=:image_id
+        AND NOT labels.deleted
+        """
+    params = {'min_x': min_x, 'min_y': min_y, 'max_x': max_x, 'max_y': max_y, 'image_id': image_id}
+    if class_id is not None:
+        query += " AND labels.class_id=:class_id"
+        params['class_id'] = class_id
+    query += " ORDER BY label_id"
+
+    matches = []
+    for row in cur.execute(query, params):
+        try:
+            geom = row_geometry(row)
+        except ValueError:
+            continue
+        try:
+            intersects = geom.intersects(region)
+        except WKT_ERROR:
+            # self intersecting polygons can't be tested as they are
+            intersects = make_valid(geom).intersects(region)
+        if intersects:
+            matches.append(row)
+    return matches
@@ -1,28 +1,88 @@
+import asyncio
+import base64
 import os
 import datetime
+import io
 import json
-from unittest import TestCase
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
 
 from pathlib import Path
+from urllib.parse import urlencode
+from a2wsgi import WSGIMiddleware
 import pytest
 import requests
+from PIL import Image, ImageDraw, ImageFilter
+import shapely.wkb
+import shapely.wkt
 from requests.auth import HTTPBasicAuth
 import shutil
 import sqlite3
+from werkzeug.security import check_password_hash
 
-from image_db.create_db import create_db
+from image_db.create_db import LATEST_VERSION, create_db, create_synthetic_db, create_tables, migrate
 from app import get_db, STATUS_OK, STATUS_BAD_REQUEST, STATUS_NOT_FOUND, STATUS_INTERNAL_ERROR
 
-from identify_pii import _check_words_suspect, _extract_words
+from identify_pii import _check_words_suspect, _extract_words, _ocr_words, check_for_pii, dictionary_version, pii_cache
+from pii_cache import PiiCache, hash_image
+from auth_cache import CredentialCache
+from db_pool import ConnectionPool, PoolTimeout
+from pii_engine import PiiEngine, PiiScanError
+from pii_jobs import JOB_DONE, JOB_PENDING, JOB_RUNNING, PiiJobQueue
+from pii_matcher import PiiMatcher, tokenize
+from dicom_scanner import extract_dicom_words, sample_frames
+from ocr_preprocess import downscale_factor, find_text_regions, preprocess_for_ocr
+from thumbnails import ThumbnailCache, ThumbnailError
+from export_dataset import export_dataset
+from register_images import IMAGES_DIR, register_images, resolve_image_path
+from audit_log import BufferedLogWriter, log_row
+from response_cache import ResponseCache
+from metrics import Histogram, SlowRequestProfiler, TimedConnection, sql_seconds
+from app import app as flask_app
 
 STATUS_UNAUTHORISED = 401
 
 
+def misbehaving_scanner(path):
+    # a scanner for PiiEngine's worker processes, which hangs, dawdles or kills its worker depending on the file name
+    name = os.path.basename(str(path))
+    if name.startswith('hang'):
+        time.sleep(60)
+    if name.startswith('slow'):
+        time.sleep(1.5)
+    if name.startswith('crash_once') and not os.path.exists(f'{path}.crashed'):
+        open(f'{path}.crashed', 'w').close()
+        os._exit(1)
+    if name.startswith('crash_always'):
+        os._exit(1)
+    return os.path.exists(path)
+
+
 class TestApis(TestCase):
     def setUp(self):
         db_path = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+        self.wait_for_pii_jobs(db_path)
         create_db(db_path)
 
+    def wait_for_pii_jobs(self, db_path, timeout=30):
+        # the server's background pii workers write to the db, so let them finish before replacing it
+        deadline = time.time() + timeout
+        while os.path.exists(db_path) and time.time() < deadline:
+            conn = sqlite3.connect(str(db_path))
+            try:
+                outstanding = conn.execute("SELECT count(*) FROM PiiJobs WHERE status IN ('pending', 'running')").fetchone()[0]
+            except sqlite3.OperationalError:
+                outstanding = 0
+            finally:
+                conn.close()
+            if outstanding == 0:
+                return
+            time.sleep(0.1)
+
     def get_request(self, url, usr='rock_god_9000', pwd='voodoochild'):
         return requests.get(f"http://localhost:5000/{url}", auth=HTTPBasicAuth('rock_god_9000', pwd))
 
@@ -35,6 +95,32 @@ class TestApis(TestCase):
     def put_request(self, url, data, usr='rock_god_9000', pwd='voodoochild'):
         return requests.put(f"http://localhost:5000/{url}", data=data, auth=HTTPBasicAuth('rock_god_9000', pwd))
 
+    def post_json_request(self, url, data, usr='rock_god_9000', pwd='voodoochild'):
+        return requests.post(f"http://localhost:5000/{url}", json=data, auth=HTTPBasicAuth('rock_god_9000', pwd))
+
+    def check_unread_bodies_release(self, url):
+        # a HEAD, or a body that's never read, must still give the connection back to the pool
+        import app as app_module
+        previous = app_module.db_pool
+        pool = app_module.db_pool = ConnectionPool(flask_app.config['DATABASE'], size=2, timeout=1, on_connect=migrate)
+        auth = {'Authorization': 'Basic ' + base64.b64encode(b'rock_god_9000:voodoochild').decode()}
+        try:
+            client = flask_app.test_client()
+            # closed without reading the body, as a server does once it's done with a response
+            for _ in range(3):
+                response = client.head(url, headers=auth)
+                self.assertEqual(response.status_code, STATUS_OK)
+                response.close()
+                client.get(url, headers=auth).close()
+            response = client.get('/image/1', headers=auth)
+            self.assertEqual(response.status_code, STATUS_OK)
+            response.close()
+            self.assertEqual(pool._idle.qsize(), pool._created)
+            self.assertFalse(any(conn.in_transaction for conn in pool._idle.queue))
+        finally:
+            app_module.db_pool = previous
+            pool.close_all()
+
 
 class TestGetImage(TestApis):
     def test_invalid_auth(self):
@@ -108,6 +194,103 @@ class TestCreateImage(TestApis):
         self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
 
 
+class TestBulkImages(TestApis):
+    def test_invalid_auth(self):
+        r = self.post_json_request('images/bulk', data={'image_paths': ['brain_jeff.jpeg']}, pwd='invalidpwd')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_bulk_paths(self):
+        r = self.post_json_request('images/bulk', data={'image_paths': ['brain_jeff.jpeg', 'this_doesnt_exist.jpeg']})
+        self.assertEqual(r.status_code, STATUS_OK)
+        report = json.loads(r.content)
+        self.assertEqual((report['inserted'], report['failed']), (1, 1))
+
+        inserted, failed = report['results']
+        self.assertEqual(failed['status'], 'error')
+        r = self.get_request(f"image/{inserted['image_id']}")
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['image_path'], 'brain_jeff.jpeg')
+
+    def test_bulk_directory(self):
+        r = self.post_json_request('images/bulk', data={'directory': '.'})
+        self.assertEqual(r.status_code, STATUS_OK)
+        image_dir = Path(__file__).absolute().parent.joinpath('static', 'images')
+        self.assertEqual(json.loads(r.content)['inserted'], len(list(image_dir.rglob('*.jpeg'))))
+
+    def test_duplicate_paths_scanned(self):
+        # every row for a path listed twice gets the inline scan's verdict
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            images_dir = Path(tmp_dir)
+            Image.effect_noise((32, 32), 64).save(images_dir.joinpath('noise.jpeg'))
+            db_path = images_dir.joinpath('bulk.sqlite')
+            create_db(db_path)
+            conn = sqlite3.connect(str(db_path))
+            with PiiEngine(num_workers=1, timeout=10, scanner=os.path.exists) as engine:
+                results = register_images(conn, ['noise.jpeg', 'noise.jpeg', './noise.jpeg'], 'rock_god_9000',
+                    images_dir=images_dir, engine=engine)
+            self.assertEqual([result['contains_pii'] for result in results], [1, 1, 1])
+            image_ids = [result['image_id'] for result in results]
+            rows = conn.execute(f"SELECT contains_pii FROM Images WHERE image_id IN ({', '.join('?' * len(image_ids))})", image_ids)
+            self.assertEqual(rows.fetchall(), [(1,), (1,), (1,)])
+            conn.close()
+
+    def test_bulk_outside_images(self):
+        r = self.post_json_request('images/bulk', data={'directory': '..'})
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+
+
+class TestImagePiiScan(TestApis):
+    def setUp(self):
+        super().setUp()
+        # duplicate an existing image
+        image_dir = Path(__file__).absolute().parent.joinpath('static', 'images')
+        self.new_image_path = image_dir.joinpath('new_brain_jeff.jpeg')
+        if not os.path.exists(self.new_image_path):
+            shutil.copyfile(image_dir.joinpath('brain_jeff.jpeg'), self.new_image_path)
+
+        # make sure the image is actually scanned rather than found in the cache
+        pii_cache.clear()
+
+    def tearDown(self):
+        os.remove(self.new_image_path)
+
+    def test_cached_scan(self):
+        pii_cache.store(hash_image(self.new_image_path), ['john'], True, dictionary_version())
+
+        r = self.post_request('image', data={'image_path': 'new_brain_jeff.jpeg'})
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['contains_pii'], 1)
+
+    def wait_for_scan(self, image_id, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            r = self.get_request(f'image/{image_id}/pii')
+            if json.loads(r.content)['status'] in ('done', 'failed'):
+                return json.loads(r.content)
+            time.sleep(0.2)
+        self.fail('PII scan did not finish')
+
+    def test_insert_returns_pending(self):
+        r = self.post_request('image', data={'image_path': 'new_brain_jeff.jpeg'})
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['contains_pii'], 'pending')
+
+    def test_scan_completes(self):
+        r = self.post_request('image', data={'image_path': 'new_brain_jeff.jpeg'})
+        image_id = int(json.loads(r.content)['image_id'])
+
+        job = self.wait_for_scan(image_id)
+        self.assertIn(job['contains_pii'], (0, 1))
+
+        r = self.get_request(f'image/{image_id}?scanned_only=1')
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['contains_pii'], job['contains_pii'])
+
+    def test_status_nonexistant(self):
+        r = self.get_request('image/9999999/pii')
+        self.assertEqual(r.status_code, STATUS_NOT_FOUND)
+
+
 class TestGetLabel(TestApis):
     def test_invalid_auth(self):
         r = self.get_request('label/1', pwd='invalidpwd')
@@ -146,6 +329,31 @@ class TestGetLabel(TestApis):
         r = self.get_request(f'label/{invalid_label_id}')
         self.assertEqual(r.status_code, STATUS_NOT_FOUND)
 
+class TestLabelFormats(TestApis):
+    def test_geojson(self):
+        r = self.get_request('label/2?format=geojson')
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['geometry'], {
+            'type': 'MultiPolygon',
+            'coordinates': [[[[10.0, 10.0], [20.0, 25.0], [15.0, 30.0], [10.0, 10.0]]]]
+            })
+
+    def test_wkb(self):
+        r = self.get_request('label/2?format=wkb')
+        self.assertEqual(r.status_code, STATUS_OK)
+        geom = shapely.wkb.loads(json.loads(r.content)['geometry'], hex=True)
+        self.assertEqual(geom.wkt, 'MULTIPOLYGON (((10 10, 20 25, 15 30, 10 10)))')
+
+    def test_updated_geometry(self):
+        self.put_request('label/2', data={'geometry': 'MULTIPOLYGON (((1 1, 2 2, 1 2, 1 1)))'})
+        r = self.get_request('label/2?format=geojson')
+        self.assertEqual(json.loads(r.content)['geometry']['coordinates'], [[[[1.0, 1.0], [2.0, 2.0], [1.0, 2.0], [1.0, 1.0]]]])
+
+    def test_invalid_format(self):
+        r = self.get_request('label/2?format=svg')
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+
+
 class TestDeleteLabel(TestApis):
     def test_invalid_auth(self):
         r = self.delete_request('label/1', pwd='invalidpwd')
@@ -216,6 +424,323 @@ class TestUpdateLabel(TestApis):
             'image_id': 1, 
             'geometry': 'MULTIPOLYGON (((10 10, 20 25, 15 30, 10 10)))'})
         
+class TestListLabels(TestApis):
+    def get_lines(self, url):
+        r = self.get_request(url)
+        self.assertEqual(r.status_code, STATUS_OK)
+        return [json.loads(line) for line in r.content.decode().splitlines()]
+
+    def test_invalid_auth(self):
+        r = self.get_request('labels', pwd='invalidpwd')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_head_releases_connection(self):
+        self.check_unread_bodies_release('/labels')
+
+    def test_image_labels(self):
+        labels = self.get_lines('image/1/labels')
+        self.assertEqual([label['label_id'] for label in labels], [1, 4])
+        self.assertEqual(labels[0]['username'], 'rock_god_9000')
+
+    def test_image_nonexistant(self):
+        r = self.get_request('image/9999999/labels')
+        self.assertEqual(r.status_code, STATUS_NOT_FOUND)
+
+    def test_filters(self):
+        labels = self.get_lines('labels?labelled_by=noot_noot')
+        self.assertEqual([label['label_id'] for label in labels], [3, 4])
+
+        labels = self.get_lines('labels?class_id=1')
+        self.assertEqual([label['label_id'] for label in labels], [1, 3])
+
+    def test_deleted(self):
+        self.delete_request('label/2')
+        self.assertNotIn(2, [label['label_id'] for label in self.get_lines('labels')])
+        deleted = self.get_lines('labels?deleted=1')
+        self.assertIn(2, [label['label_id'] for label in deleted])
+        self.assertTrue(all(label['deleted'] for label in deleted))
+
+    def test_pagination(self):
+        first_page = self.get_lines('labels?limit=2')
+        self.assertEqual([label['label_id'] for label in first_page], [1, 2])
+
+        second_page = self.get_lines(f"labels?limit=2&after={first_page[-1]['label_id']}")
+        self.assertEqual([label['label_id'] for label in second_page], [3, 4])
+
+
+class TestLabelsIntersecting(TestApis):
+    def get_label_ids(self, url):
+        r = self.get_request(url)
+        self.assertEqual(r.status_code, STATUS_OK)
+        return [json.loads(line)['label_id'] for line in r.content.decode().splitlines()]
+
+    def test_invalid_auth(self):
+        r = self.get_request('image/1/labels/intersecting?bbox=0,0,50,50', pwd='invalidpwd')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_bbox(self):
+        # label 1 is within (10 5, 45 45), label 4 has polygons at both (0 0) and (1234 0)
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=0,0,50,50'), [1, 4])
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=1100,0,1300,20'), [4])
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=500,500,600,600'), [])
+
+    def test_exact_intersection(self):
+        # within label 4's bounding box, but between its two polygons
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=500,0,600,10'), [])
+
+    def test_geometry(self):
+        r = self.get_label_ids('image/1/labels/intersecting?geometry=POLYGON ((15 15, 18 15, 18 18, 15 15))')
+        self.assertEqual(r, [1])
+
+    def test_follows_updates(self):
+        self.put_request('label/1', data={'geometry': 'MULTIPOLYGON (((500 500, 520 500, 510 520, 500 500)))'})
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=500,500,600,600'), [1])
+
+        self.delete_request('label/1')
+        self.assertEqual(self.get_label_ids('image/1/labels/intersecting?bbox=500,500,600,600'), [])
+
+    def test_invalid_region(self):
+        r = self.get_request('image/1/labels/intersecting?bbox=1,2,3')
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+
+
+class TestLabelBatch(TestApis):
+    def test_invalid_auth(self):
+        r = self.post_json_request('labels/batch', data=[{'method': 'DELETE', 'label_id': 1}], pwd='invalidpwd')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_mixed_batch(self):
+        r = self.post_json_request('labels/batch', data=[
+            {'method': 'POST', 'image_id': 2, 'class_id': 1, 'geometry': 'MULTIPOLYGON (((10 10, 20 25, 15 30, 10 10)))'},
+            {'method': 'POST', 'image_id': 2, 'class_id': 3, 'geometry': 'MULTIPOLYGON (((1 1, 2 2, 1 2, 1 1)))'},
+            {'method': 'PUT', 'label_id': 1, 'class_id': 2},
+            {'method': 'DELETE', 'label_id': 2},
+            ])
+        self.assertEqual(r.status_code, STATUS_OK)
+        results = json.loads(r.content)['results']
+        self.assertTrue(all(result['status'] == 'ok' for result in results))
+
+        r = self.get_request(f"label/{results[1]['label_id']}")
+        self.assertEqual(json.loads(r.content)['class_id'], 3)
+        r = self.get_request('label/1')
+        self.assertEqual(json.loads(r.content)['class_id'], 2)
+        r = self.get_request('label/2')
+        self.assertEqual(r.status_code, STATUS_NOT_FOUND)
+
+    def test_atomic_rejects_batch(self):
+        r = self.post_json_request('labels/batch', data=[
+            {'method': 'DELETE', 'label_id': 2},
+            {'method': 'POST', 'image_id': 2, 'class_id': 1, 'geometry': 'not a wkt'},
+            ])
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+        self.assertEqual([result['status'] for result in json.loads(r.content)['results']], ['skipped', 'error'])
+
+        # nothing was applied
+        r = self.get_request('label/2')
+        self.assertEqual(r.status_code, STATUS_OK)
+
+    def test_duplicate_label(self):
+        # the second change to a label is rejected, rather than skipping its revision
+        r = self.post_json_request('labels/batch?mode=best_effort', data=[
+            {'method': 'PUT', 'label_id': 1, 'class_id': 2},
+            {'method': 'PUT', 'label_id': 1, 'class_id': 3},
+            {'method': 'DELETE', 'label_id': 1},
+            ])
+        self.assertEqual([result['status'] for result in json.loads(r.content)['results']], ['ok', 'error', 'error'])
+        r = self.get_request('label/1')
+        self.assertEqual(json.loads(r.content)['class_id'], 2)
+        r = self.get_request('label/1/history')
+        self.assertEqual([revision['version'] for revision in json.loads(r.content)['revisions']], [1, 2])
+
+    def test_best_effort(self):
+        r = self.post_json_request('labels/batch', data={'mode': 'best_effort', 'operations': [
+            {'method': 'DELETE', 'label_id': 2},
+            {'method': 'PUT', 'label_id': 9999999, 'class_id': 1},
+            ]})
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual([result['status'] for result in json.loads(r.content)['results']], ['ok', 'error'])
+
+        r = self.get_request('label/2')
+        self.assertEqual(r.status_code, STATUS_NOT_FOUND)
+
+
+class TestLabelHistory(TestApis):
+    new_geometry = 'MULTIPOLYGON (((0 0, 10 0, 10 10, 0 0)))'
+
+    def get_history(self, label_id, fmt='wkt'):
+        r = self.get_request(f'label/{label_id}/history?format={fmt}')
+        self.assertEqual(r.status_code, STATUS_OK)
+        return json.loads(r.content)['revisions']
+
+    def test_existing_labels(self):
+        # labels from before revisions were kept have their current version
+        history = self.get_history(4)
+        self.assertEqual([(row['version'], row['class_id'], row['deleted']) for row in history], [(1, 4, 0)])
+        self.assertEqual(history[0]['updated_by'], 'noot_noot')
+
+    def test_existing_label_times(self):
+        # upgrading a db seeds each label's revision with the time it was inserted, or the upgrade time
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conn = sqlite3.connect(os.path.join(tmp_dir, 'old.sqlite'))
+            create_tables(conn.cursor())
+            conn.execute("INSERT INTO Images (image_path, deleted, contains_pii) VALUES ('brain_jeff.jpeg', 0, 0)")
+            conn.executemany("INSERT INTO Labels (image_id, labelled_by, class_id, geometry, deleted) VALUES (1, 'noot_noot', 1, ?, 0)",
+                [(self.new_geometry,), (self.new_geometry,)])
+            conn.executemany("INSERT INTO Logs (object, updated_by, method, image_id, label_id, modified_at) VALUES ('Label', 'noot_noot', ?, NULL, 1, ?)",
+                [('INSERTION', '2020-06-01 00:00:00'), ('UPDATE', '2020-06-02 00:00:00')])
+            conn.commit()
+            start = int(time.time())
+            migrate(conn)
+            epochs = [row[0] for row in conn.execute('SELECT modified_at_epoch FROM LabelRevisions ORDER BY label_id')]
+            conn.close()
+        self.assertEqual(epochs[0], int(datetime.datetime(2020, 6, 1).timestamp()))
+        self.assertGreaterEqual(epochs[1], start)
+
+    def test_history(self):
+        self.put_request('label/1', data={'class_id': 3})
+        self.put_request('label/1', data={'geometry': self.new_geometry})
+        self.delete_request('label/1')
+        history = self.get_history(1)
+        self.assertEqual([(row['version'], row['class_id'], row['deleted']) for row in history],
+            [(1, 1, 0), (2, 3, 0), (3, 3, 0), (4, 3, 1)])
+        self.assertEqual(shapely.wkt.loads(history[2]['geometry']), shapely.wkt.loads(self.new_geometry))
+        self.assertEqual(self.get_history(1, 'geojson')[2]['geometry']['type'], 'MultiPolygon')
+        self.assertEqual(self.get_request('label/100/history').status_code, STATUS_NOT_FOUND)
+
+    def test_new_label(self):
+        r = self.post_request('label', data={'image_id': 2, 'class_id': 2, 'geometry': self.new_geometry})
+        label_id = json.loads(r.content)['label_id']
+        self.assertEqual([row['version'] for row in self.get_history(label_id)], [1])
+        # it didn't exist at the start of the epoch
+        self.assertEqual(self.get_request(f'label/{label_id}?as_of=1').status_code, STATUS_NOT_FOUND)
+
+    def test_as_of(self):
+        # the example labels were never logged, so their history starts when the db was created
+        created = int(time.time())
+        time.sleep(1.1)
+        self.put_request('label/1', data={'class_id': 3})
+        self.assertEqual(self.get_request('label/1?as_of=1').status_code, STATUS_NOT_FOUND)
+        r = self.get_request(f'label/1?as_of={created}')
+        self.assertEqual(r.status_code, STATUS_OK)
+        label = json.loads(r.content)
+        self.assertEqual((label['class_id'], label['image_path']), (1, 'brain_jeff.jpeg'))
+        # the same fields as a normal GET
+        self.assertEqual(set(label), set(json.loads(self.get_request('label/1').content)))
+        label = json.loads(self.get_request(f'label/1?as_of={int(time.time()) + 1}').content)
+        self.assertEqual(label['class_id'], 3)
+        self.assertEqual(self.get_request('label/1?as_of=yesterday').status_code, STATUS_BAD_REQUEST)
+
+        self.delete_request('label/1')
+        self.assertEqual(self.get_request(f'label/1?as_of={int(time.time()) + 1}').status_code, STATUS_NOT_FOUND)
+
+    def test_revert(self):
+        original = json.loads(self.get_request('label/1').content)
+        self.put_request('label/1', data={'class_id': 3, 'geometry': self.new_geometry})
+        self.delete_request('label/1')
+
+        r = self.post_request('label/1/revert', data={'version': 1})
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['version'], 4)
+        label = json.loads(self.get_request('label/1').content)
+        self.assertEqual(label['class_id'], original['class_id'])
+        self.assertEqual(label['geometry'], original['geometry'])
+        self.assertEqual([row['version'] for row in self.get_history(1)], [1, 2, 3, 4])
+        # it's back in the spatial index
+        r = self.get_request('image/1/labels/intersecting?bbox=20,20,30,30')
+        self.assertIn(1, [json.loads(line)['label_id'] for line in r.content.splitlines()])
+
+    def test_revert_keeps_text(self):
+        # the wkt comes back exactly as it was given, not as shapely would write it
+        geometry = 'MULTIPOLYGON(((0 0,10 0,10 10,0 0)))'
+        self.put_request('label/1', data={'geometry': geometry})
+        self.put_request('label/1', data={'geometry': self.new_geometry})
+        self.assertEqual(self.get_history(1)[1]['geometry'], geometry)
+        self.assertEqual(self.post_request('label/1/revert', data={'version': 2}).status_code, STATUS_OK)
+        self.assertEqual(json.loads(self.get_request('label/1').content)['geometry'], geometry)
+        label = json.loads(self.get_request(f'label/1?as_of={int(time.time()) + 1}').content)
+        self.assertEqual(label['geometry'], geometry)
+
+    def test_revert_invalid(self):
+        self.delete_request('label/1')
+        self.assertEqual(self.post_request('label/1/revert', data={'version': 2}).status_code, STATUS_BAD_REQUEST)
+        self.assertEqual(self.post_request('label/1/revert', data={'version': 10}).status_code, STATUS_NOT_FOUND)
+        self.assertEqual(self.post_request('label/1/revert', data={'version': 'one'}).status_code, STATUS_BAD_REQUEST)
+
+    def test_batch(self):
+        self.post_json_request('labels/batch', [{'method': 'PUT', 'label_id': 2, 'class_id': 4}, {'method': 'DELETE', 'label_id': 4}])
+        self.assertEqual([row['class_id'] for row in self.get_history(2)], [2, 4])
+        self.assertEqual([row['deleted'] for row in self.get_history(4)], [0, 1])
+
+
+class TestLabelAnalytics(TestApis):
+    label_4 = 'MULTIPOLYGON (((1234 0, 1222 5, 1000 10, 1234 0)), ((9 4, 3 9, 1 4, 0 1, 9 4)))'
+
+    def test_invalid_auth(self):
+        r = self.get_request('image/1/analytics', pwd='invalidpwd')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_areas(self):
+        r = self.get_request('image/1/analytics')
+        self.assertEqual(r.status_code, STATUS_OK)
+        analytics = json.loads(r.content)
+        self.assertEqual([label['label_id'] for label in analytics['labels']], [1, 4])
+        self.assertAlmostEqual(analytics['labels'][1]['area'], shapely.wkt.loads(self.label_4).area)
+        self.assertEqual([summary['class_id'] for summary in analytics['classes']], [1, 4])
+
+        # the two annotators labelled different classes, so they don't agree at all
+        self.assertEqual(analytics['pairs'], [])
+        self.assertTrue(all(pair['iou'] == 0 for pair in analytics['annotators']))
+        # each class has a single annotator, so there's no agreement to report
+        self.assertEqual([summary['intersection_area'] for summary in analytics['classes']], [None, None])
+
+    def test_iou_between_annotators(self):
+        # a copy of noot_noot's label 4
+        r = self.post_request('label', data={'image_id': 1, 'class_id': 4, 'geometry': self.label_4})
+        label_id = json.loads(r.content)['label_id']
+
+        analytics = json.loads(self.get_request('image/1/analytics?class_id=4').content)
+        self.assertEqual([(pair['label_a'], pair['label_b']) for pair in analytics['pairs']], [(4, label_id)])
+        self.assertAlmostEqual(analytics['pairs'][0]['iou'], 1)
+        self.assertAlmostEqual(analytics['annotators'][0]['iou'], 1)
+        self.assertAlmostEqual(analytics['classes'][0]['intersection_area'], shapely.wkt.loads(self.label_4).area)
+
+        # changing the label updates the cached analytics
+        self.put_request(f'label/{label_id}', data={'geometry': 'MULTIPOLYGON (((9 4, 3 9, 1 4, 0 1, 9 4)))'})
+        analytics = json.loads(self.get_request('image/1/analytics?class_id=4').content)
+        self.assertLess(analytics['pairs'][0]['iou'], 1)
+
+        self.delete_request(f'label/{label_id}')
+        analytics = json.loads(self.get_request('image/1/analytics?class_id=4').content)
+        self.assertEqual(analytics['pairs'], [])
+
+    def test_geometry(self):
+        r = self.get_request('image/1/analytics/geometry?class_id=4&format=geojson')
+        self.assertEqual(r.status_code, STATUS_OK)
+        classes = json.loads(r.content)['classes']
+        self.assertEqual(len(classes), 1)
+        self.assertEqual(classes[0]['union']['type'], 'MultiPolygon')
+        self.assertAlmostEqual(classes[0]['union_area'], shapely.wkt.loads(self.label_4).area)
+
+    def test_invalid_geometry_skipped(self):
+        r = self.get_request('image/2/analytics')
+        self.assertEqual(json.loads(r.content)['skipped'], [3])
+
+    def test_image_not_found(self):
+        r = self.get_request('image/7/analytics')
+        self.assertEqual(r.status_code, STATUS_NOT_FOUND)
+
+    def test_dataset(self):
+        self.post_request('label', data={'image_id': 1, 'class_id': 4, 'geometry': self.label_4})
+        r = self.get_request('analytics?class_id=4')
+        self.assertEqual(r.status_code, STATUS_OK)
+        analytics = json.loads(r.content)
+        self.assertEqual([summary['class_id'] for summary in analytics['classes']], [4])
+        self.assertEqual(analytics['classes'][0]['label_count'], 2)
+        pair = analytics['annotators'][0]
+        self.assertEqual((pair['user_a'], pair['user_b']), ('noot_noot', 'rock_god_9000'))
+        self.assertAlmostEqual(pair['iou'], 1)
+
+
 class TestLog(TestApis):
     def get_log(self):
         db_path = str(Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite'))
@@ -370,6 +895,139 @@ class TestLog(TestApis):
             'label_id': None
             })
 
+class TestLogsApi(TestApis):
+    def setUp(self):
+        super().setUp()
+        self.start = int(time.time())
+        self.delete_request('label/1')
+        self.put_request('label/2', data={'class_id': 3})
+        self.delete_request('image/4')
+
+    def get_logs(self, query=''):
+        r = self.get_request(f'logs?{query}')
+        self.assertEqual(r.status_code, STATUS_OK)
+        return json.loads(r.content)
+
+    def test_filters(self):
+        logs = self.get_logs('object=Label')['logs']
+        self.assertEqual([(log['method'], log['label_id']) for log in logs], [('DELETE', 1), ('UPDATE', 2)])
+        self.assertEqual([log['image_id'] for log in self.get_logs('method=DELETE&object=Image')['logs']], [4])
+        self.assertEqual(len(self.get_logs('username=rock_god_9000')['logs']), 3)
+        self.assertEqual(self.get_logs('username=noot_noot')['logs'], [])
+
+    def test_time_range(self):
+        self.assertEqual(len(self.get_logs(f'since={self.start}')['logs']), 3)
+        self.assertEqual(self.get_logs(f'until={self.start}')['logs'], [])
+        since = datetime.datetime.fromtimestamp(self.start, datetime.timezone.utc).isoformat()
+        logs = self.get_logs(urlencode({'since': since}))['logs']
+        self.assertEqual(len(logs), 3)
+        self.assertTrue(logs[0]['modified_at'].endswith('Z'))
+
+    def test_pagination(self):
+        for order in ('asc', 'desc'):
+            seen = []
+            page = self.get_logs(f'limit=2&order={order}')
+            seen += page['logs']
+            while page['next_cursor'] is not None:
+                page = self.get_logs(f'limit=2&order={order}&cursor={page["next_cursor"]}')
+                seen += page['logs']
+            log_ids = [log['log_id'] for log in seen]
+            self.assertEqual(log_ids, sorted(log_ids, reverse=(order == 'desc')))
+            self.assertEqual(len(log_ids), 3)
+
+    def test_invalid(self):
+        for query in ('limit=0', 'since=yesterday', 'cursor=abc', 'object=User', 'method=GET', 'order=up'):
+            self.assertEqual(self.get_request(f'logs?{query}').status_code, STATUS_BAD_REQUEST)
+
+
+class TestBufferedLogWriter(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, 'test.sqlite')
+        create_db(self.db_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def count_logs(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT count(*), count(modified_at_epoch) FROM Logs').fetchone()
+        finally:
+            conn.close()
+
+    def test_batches(self):
+        writer = BufferedLogWriter(self.db_path, flush_interval=10, batch_size=10)
+        writer.write([log_row('Label', 'rock_god_9000', 'UPDATE', None, i) for i in range(25)])
+        writer.write([log_row('Image', 'rock_god_9000', 'DELETE', 1, None)])
+        # two full batches are written straight away, the rest waits for the interval or close
+        deadline = time.time() + 5
+        while writer.batches < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.count_logs(), (20, 20))
+        writer.close()
+        self.assertEqual(self.count_logs(), (26, 26))
+
+    def test_flush(self):
+        writer = BufferedLogWriter(self.db_path, flush_interval=0.01)
+        writer.write([log_row('Label', 'rock_god_9000', 'DELETE', None, 1)])
+        writer.flush()
+        self.assertEqual(self.count_logs(), (1, 1))
+        writer.close()
+        with self.assertRaises(RuntimeError):
+            writer.write([log_row('Label', 'rock_god_9000', 'DELETE', None, 1)])
+
+    def test_failed_batch_dropped(self):
+        # a db without a Logs table fails every insert, so the batch is retried then dropped
+        broken_path = os.path.join(self.tmp_dir.name, 'broken.sqlite')
+        sqlite3.connect(broken_path).close()
+        writer = BufferedLogWriter(broken_path, flush_interval=0.01, retry_interval=0.01, max_retries=2)
+        writer.write([log_row('Label', 'rock_god_9000', 'DELETE', None, i) for i in range(3)])
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual((writer.failures, writer.dropped, writer.batches), (3, 3, 0))
+        writer.close()
+
+    def test_full_writer_does_not_block(self):
+        # the thread is stuck retrying its first row, and the buffer holds one more
+        broken_path = os.path.join(self.tmp_dir.name, 'broken.sqlite')
+        sqlite3.connect(broken_path).close()
+        writer = BufferedLogWriter(broken_path, flush_interval=0, max_pending=1, retry_interval=10, put_timeout=0.05)
+        start = time.time()
+        writer.write([log_row('Label', 'rock_god_9000', 'DELETE', None, i) for i in range(3)])
+        self.assertFalse(writer.flush(timeout=0.05))
+        writer.close(timeout=0.05)
+        self.assertLess(time.time() - start, 5)
+        self.assertGreaterEqual(writer.dropped, 1)
+
+
+class TestBufferedRequestLogs(TestApis):
+    def test_every_log_is_buffered(self):
+        # batches and reverts write their logs through the same path as single changes
+        import app as app_module
+        previous = app_module.log_writer
+        writer = app_module.log_writer = mock.Mock()
+        flask_app.config['LOG_WRITE_MODE'] = 'buffered'
+        auth = {'Authorization': 'Basic ' + base64.b64encode(b'rock_god_9000:voodoochild').decode()}
+        conn = sqlite3.connect(flask_app.config['DATABASE'])
+        logs_before = conn.execute('SELECT count(*) FROM Logs').fetchone()[0]
+        try:
+            client = flask_app.test_client()
+            r = client.post('/labels/batch', headers=auth, json=[
+                {'method': 'PUT', 'label_id': 1, 'class_id': 2},
+                {'method': 'DELETE', 'label_id': 2},
+                ])
+            self.assertEqual(r.status_code, STATUS_OK)
+            r = client.post('/label/2/revert', headers=auth, data={'version': 1})
+            self.assertEqual(r.status_code, STATUS_OK)
+        finally:
+            flask_app.config['LOG_WRITE_MODE'] = 'sync'
+            app_module.log_writer = previous
+        self.assertEqual(conn.execute('SELECT count(*) FROM Logs').fetchone()[0], logs_before)
+        conn.close()
+        rows = [row for call in writer.write.call_args_list for row in call.args[0]]
+        self.assertEqual([(row[2], row[4]) for row in rows], [('UPDATE', 1), ('DELETE', 2), ('UPDATE', 2)])
+
+
 class TestCheckForPII(TestApis):
     def test_has_keyword(self):
         has_keyword = ['name', 'tumor', 'is', 'vas2348agnas123']
@@ -393,6 +1051,103 @@ class TestCheckForPII(TestApis):
         has_name_2 = ['mary']
         self.assertTrue(_check_words_suspect(has_name_1))
 
+    def test_has_phrase(self):
+        self.assertTrue(_check_words_suspect(['patient', 'date', 'of', 'birth', '2271994']))
+        self.assertFalse(_check_words_suspect(['date', 'of', 'scan']))
+
+    def test_split_name(self):
+        # ocr split "john" in two
+        self.assertTrue(_check_words_suspect(['tumor', 'jo', 'hn']))
+
+
+class TestPiiMatcher(TestCase):
+    def test_phrases(self):
+        matcher = PiiMatcher(['date of birth', 'birth', 'd.o.b.'])
+        found = list(matcher.find(tokenize('Date of Birth: 22/7/1994, D.O.B.')))
+        self.assertEqual(found, [(0, 'date of birth'), (2, 'birth'), (4, 'dob')])
+
+    def test_unordered(self):
+        # sorted words can't be checked for the phrase, so all its words being there is enough
+        matcher = PiiMatcher(['date of birth'])
+        self.assertFalse(matcher.matches(['birth', 'date', 'of']))
+        self.assertTrue(matcher.matches(['birth', 'date', 'of'], ordered=False))
+
+    def test_fuzzy(self):
+        matcher = PiiMatcher(['jonathan', 'ann'], max_edits=1)
+        self.assertTrue(matcher.matches(['jonathon']))
+        self.assertFalse(matcher.matches(['jonathxyz']))
+
+        # short words are only matched exactly
+        self.assertFalse(matcher.matches(['anne']))
+
+    def test_dictionaries(self):
+        names_path = Path(__file__).absolute().parent.joinpath('names.txt')
+        matcher = PiiMatcher.from_dictionaries([['patient id'], names_path])
+        self.assertTrue(matcher.matches(['patient', 'id']))
+        self.assertTrue(matcher.matches(['mary']))
+        self.assertNotEqual(matcher.version, PiiMatcher(['patient id']).version)
+
+    def test_precompiled(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'matcher.pickle')
+            PiiMatcher(['date of birth']).save(path, key='v1')
+            self.assertTrue(PiiMatcher.load(path, key='v1').matches(['date', 'of', 'birth']))
+
+            # a matcher saved from other dictionaries isn't used
+            self.assertIsNone(PiiMatcher.load(path, key='v2'))
+            self.assertIsNone(PiiMatcher.load(os.path.join(tmp_dir, 'missing.pickle'), key='v1'))
+
+    def test_check_from_other_directory(self):
+        # the dictionary is found relative to the code, not the working directory
+        code = f"import sys; sys.path.insert(0, {str(Path(__file__).absolute().parent)!r}); import identify_pii; print(identify_pii._check_words_suspect(['mary']))"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out = subprocess.run([sys.executable, '-c', code], cwd=tmp_dir, capture_output=True, text=True)
+        self.assertEqual(out.stdout.strip(), 'True')
+
+class TestPiiCache(TestCase):
+    def setUp(self):
+        self.cache_path = Path(__file__).absolute().parent.joinpath('image_db', 'test_pii_cache.sqlite')
+        self.cache = PiiCache(self.cache_path, max_entries=2, evict_every=1)
+        self.image_path = Path(__file__).absolute().parent.joinpath('static', 'images', 'brain_jeff.jpeg')
+
+    def tearDown(self):
+        os.remove(self.cache_path)
+
+    def test_hit_skips_ocr(self):
+        # the cached words say pii even though this image has no text
+        self.cache.store(hash_image(self.image_path), ['john'], True, dictionary_version())
+        self.assertTrue(check_for_pii(self.image_path, cache=self.cache))
+
+    def test_dictionary_change(self):
+        # a verdict made with another dictionary is re-checked against the cached words
+        self.cache.store(hash_image(self.image_path), ['tumor'], True, 'old_version')
+        self.assertFalse(check_for_pii(self.image_path, cache=self.cache))
+        self.assertEqual(self.cache.lookup(hash_image(self.image_path))[2], dictionary_version())
+
+    def test_words_keep_their_order(self):
+        self.cache.store(hash_image(self.image_path), ['date', 'of', 'birth'], True, dictionary_version())
+        self.assertEqual(self.cache.lookup(hash_image(self.image_path))[0], ['date', 'of', 'birth'])
+
+    def test_eviction(self):
+        for i in range(3):
+            self.cache.store(f'hash_{i}', [], False, 'version')
+            time.sleep(0.01)
+        self.assertIsNone(self.cache.lookup('hash_0'))
+        self.assertIsNotNone(self.cache.lookup('hash_2'))
+
+    def test_eviction_is_batched(self):
+        # the table is only trimmed every third store, back down to max_entries
+        cache = PiiCache(self.cache_path, max_entries=2, evict_every=3)
+        for i in range(5):
+            cache.store(f'hash_{i}', [], False, 'version')
+            time.sleep(0.01)
+        conn = sqlite3.connect(self.cache_path)
+        self.assertEqual(sorted(row[0] for row in conn.execute('SELECT content_hash FROM PiiCache')), ['hash_1', 'hash_2', 'hash_3', 'hash_4'])
+        conn.close()
+        cache.store('hash_5', [], False, 'version')
+        self.assertEqual([cache.lookup(f'hash_{i}') is not None for i in range(6)], [False] * 4 + [True] * 2)
+
+
 class TestExtractWords(TestApis):
     def test_no_words(self):
         image_dir = Path(__file__).absolute().parent.joinpath('static', 'images', 'brain_jeff.jpeg')
@@ -403,3 +1158,749 @@ class TestExtractWords(TestApis):
         image_dir = Path(__file__).absolute().parent.joinpath('static', 'images', 'ribs_contains_identity_1.jpeg')
         words = _extract_words(str(image_dir))
         self.assertTrue('john' in words)
+
+class TestOcrPreprocess(TestCase):
+    def ocr_sizes(self, im):
+        # the size of each image handed to tesseract, without needing tesseract
+        sizes = []
+        fake = type(sys)('pytesseract')
+        fake.image_to_string = lambda region: sizes.append(region.size) or ''
+        with mock.patch.dict(sys.modules, {'pytesseract': fake}):
+            _ocr_words(im)
+        return sizes
+
+    def test_opt_in(self):
+        # the whole image is read unless preprocessing is turned on
+        im = Image.open(Path(__file__).absolute().parent.joinpath('static', 'images', 'ribs_contains_identity_1.jpeg'))
+        self.assertEqual(self.ocr_sizes(im), [im.size])
+        with mock.patch('identify_pii.OCR_PREPROCESS', {}):
+            sizes = self.ocr_sizes(im)
+        self.assertTrue(sizes)
+        self.assertLess(sum(width * height for width, height in sizes), im.width * im.height)
+
+    def test_finds_burned_in_text(self):
+        # the name and dob are in the top right corner
+        im = Image.open(Path(__file__).absolute().parent.joinpath('static', 'images', 'ribs_contains_identity_1.jpeg'))
+        boxes = find_text_regions(im)
+        self.assertTrue(any(box[0] <= 520 and box[1] <= 110 and box[2] >= 650 and box[3] >= 160 for box in boxes))
+
+        # most of the image isn't text
+        self.assertLess(sum((box[2] - box[0]) * (box[3] - box[1]) for box in boxes), 0.3 * im.width * im.height)
+
+    def test_no_text(self):
+        im = Image.new('L', (1024, 1024), 40)
+        ImageDraw.Draw(im).ellipse((200, 200, 800, 800), fill=160)
+        self.assertEqual(preprocess_for_ocr(im.filter(ImageFilter.GaussianBlur(20))), [])
+
+    def test_grayscale_and_downscale(self):
+        im = Image.new('RGB', (4000, 1000), (255, 255, 255))
+        regions = preprocess_for_ocr(im, detect_regions=False, max_size=2000)
+        self.assertEqual([(region.mode, region.size) for region in regions], [('L', (2000, 500))])
+
+        im.info['dpi'] = (600, 600)
+        self.assertEqual(downscale_factor(im, target_dpi=300, max_size=None), 0.5)
+
+
+class TestDicomScanner(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'series.dcm')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_dicom(self, n_frames=20, **tags):
+        pydicom = pytest.importorskip('pydicom')
+        import numpy as np
+        meta = pydicom.dataset.FileMetaDataset()
+        meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.7'
+        meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        ds = pydicom.dataset.Dataset()
+        ds.file_meta = meta
+        ds.update({'Rows': 64, 'Columns': 64, 'NumberOfFrames': n_frames, 'SamplesPerPixel': 1,
+            'PhotometricInterpretation': 'MONOCHROME2', 'BitsAllocated': 16, 'BitsStored': 12, 'HighBit': 11,
+            'PixelRepresentation': 0, **tags})
+        ds.PixelData = np.arange(n_frames * 64 * 64, dtype=np.uint16).tobytes()
+        ds.save_as(self.path, enforce_file_format=True)
+
+    def test_identifying_header(self):
+        # the patient's name is enough, so the frames are never decoded
+        self.write_dicom(PatientName='Doe^John')
+        frames = []
+        words = extract_dicom_words(self.path, lambda im: frames.append(im) or [])
+        self.assertEqual(words, ['dicom:PatientName'])
+        self.assertEqual(frames, [])
+        self.assertTrue(check_for_pii(self.path, cache=None))
+
+    def test_samples_frames(self):
+        self.write_dicom(StudyDescription='chest xray')
+        frames = []
+        words = extract_dicom_words(self.path, lambda im: frames.append(im.size) or ['tumor'], max_frames=3)
+        self.assertEqual(frames, [(64, 64)] * 3)
+        self.assertEqual(words, ['chest', 'xray', 'tumor', 'tumor', 'tumor'])
+        self.assertFalse(_check_words_suspect(words))
+
+    def test_burned_in_flag(self):
+        self.write_dicom(BurnedInAnnotation='NO')
+        self.assertEqual(extract_dicom_words(self.path, lambda im: True, trust_burned_in_flag=True), [])
+
+        self.write_dicom(BurnedInAnnotation='YES')
+        self.assertEqual(extract_dicom_words(self.path, lambda im: []), ['dicom:BurnedInAnnotation'])
+
+    def test_sample_frames(self):
+        self.assertEqual(sample_frames(100, 'uniform', 5), [0, 25, 50, 74, 99])
+        self.assertEqual(sample_frames(3, 'uniform', 5), [0, 1, 2])
+        self.assertEqual(sample_frames(100, 'first_last'), [0, 99])
+        self.assertEqual(sample_frames(1, 'all'), [0])
+
+
+class TestImageContent(TestApis):
+    def setUp(self):
+        super().setUp()
+        self.image_bytes = Path(__file__).absolute().parent.joinpath('static', 'images', 'brain_jeff.jpeg').read_bytes()
+
+    def test_content(self):
+        r = self.get_request('image/1/content')
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(r.content, self.image_bytes)
+        self.assertEqual(r.headers['Content-Type'], 'image/jpeg')
+        self.assertIn('private', r.headers['Cache-Control'])
+
+    def test_range(self):
+        r = requests.get('http://localhost:5000/image/1/content', headers={'Range': 'bytes=0-99'},
+            auth=HTTPBasicAuth('rock_god_9000', 'voodoochild'))
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, self.image_bytes[:100])
+
+    def test_not_modified(self):
+        etag = self.get_request('image/1/content').headers['ETag']
+        r = requests.get('http://localhost:5000/image/1/content', headers={'If-None-Match': etag},
+            auth=HTTPBasicAuth('rock_god_9000', 'voodoochild'))
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b'')
+
+    def test_invalid_auth(self):
+        self.assertEqual(self.get_request('image/1/content', pwd='invalidpwd').status_code, STATUS_UNAUTHORISED)
+        self.assertEqual(self.get_request('image/1/thumbnail', pwd='invalidpwd').status_code, STATUS_UNAUTHORISED)
+
+    def test_deleted_image(self):
+        self.assertEqual(self.get_request('image/7/content').status_code, STATUS_NOT_FOUND)
+        self.assertEqual(self.get_request('image/7/thumbnail').status_code, STATUS_NOT_FOUND)
+
+    def test_thumbnail(self):
+        r = self.get_request('image/2/thumbnail?size=64')
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(r.headers['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(r.content)) as im:
+            self.assertLessEqual(max(im.size), 64)
+        # the second request is served from the cache
+        self.assertEqual(self.get_request('image/2/thumbnail?size=64').content, r.content)
+
+    def test_path_outside_images(self):
+        # '..' can't climb out of static/images, either when registering or when reading
+        r = self.post_request('image', data={'image_path': '../../../../../../etc/passwd'})
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+        r = self.post_request('image', data={'image_path': 'subdir/../../../app.py'})
+        self.assertEqual(r.status_code, STATUS_BAD_REQUEST)
+        self.assertEqual(resolve_image_path('../images/brain_jeff.jpeg')[0], IMAGES_DIR.joinpath('brain_jeff.jpeg'))
+
+        conn = sqlite3.connect(str(Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')))
+        conn.execute("UPDATE Images SET image_path='../../../../../../etc/passwd' WHERE image_id=1")
+        conn.commit()
+        conn.close()
+        self.assertEqual(self.get_request('image/1/content').status_code, STATUS_NOT_FOUND)
+        self.assertEqual(self.get_request('image/1/thumbnail').status_code, STATUS_NOT_FOUND)
+
+    def test_invalid_size(self):
+        self.assertEqual(self.get_request('image/1/thumbnail?size=0').status_code, STATUS_BAD_REQUEST)
+        self.assertEqual(self.get_request('image/1/thumbnail?size=big').status_code, STATUS_BAD_REQUEST)
+        self.assertEqual(self.get_request('image/1/thumbnail?size=100000').status_code, STATUS_BAD_REQUEST)
+
+
+class TestThumbnailCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.images = []
+        for i in range(3):
+            path = os.path.join(self.tmp_dir.name, f'{i}.png')
+            Image.effect_noise((400, 300), 50 + i).save(path)
+            self.images.append(path)
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'thumbnails')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get(self):
+        cache = ThumbnailCache(self.cache_dir)
+        path = cache.get(self.images[0], 100)
+        with Image.open(path) as im:
+            self.assertEqual(im.size, (100, 75))
+        self.assertEqual(cache.get(self.images[0], 100), path)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        size = os.path.getsize(ThumbnailCache(self.cache_dir).get(self.images[0], 200))
+        cache = ThumbnailCache(self.cache_dir, max_bytes=size * 2.5)
+        first = cache.get(self.images[0], 200)
+        time.sleep(0.01)
+        cache.get(self.images[1], 200)
+        time.sleep(0.01)
+        # using the first thumbnail again makes the second the least recently used
+        cache.get(self.images[0], 200)
+        time.sleep(0.01)
+        cache.get(self.images[2], 200)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertTrue(os.path.exists(first))
+
+    def test_invalid_image(self):
+        path = os.path.join(self.tmp_dir.name, 'not_an_image.png')
+        Path(path).write_text('hello')
+        with self.assertRaises(ThumbnailError):
+            ThumbnailCache(self.cache_dir).get(path, 100)
+
+
+class TestAsgiApp(TestApis):
+    def asgi_request(self, method, path, query=b'', body=b'', headers=(), pwd='voodoochild'):
+        # call the ASGI app directly and collect what it sends
+        auth = base64.b64encode(f'rock_god_9000:{pwd}'.encode())
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path, 'query_string': query,
+            'headers': [(b'authorization', b'Basic ' + auth), *headers], 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            app = WSGIMiddleware(flask_app, workers=2)
+            await app(scope, receive, send)
+            app.executor.shutdown()
+        asyncio.run(run())
+        return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_get_image(self):
+        status, _, body = self.asgi_request('GET', '/image/1')
+        self.assertEqual(status, STATUS_OK)
+        self.assertEqual(json.loads(body), {'image_id': 1, 'image_path': 'brain_jeff.jpeg', 'contains_pii': 0})
+
+    def test_invalid_auth(self):
+        status, _, _ = self.asgi_request('GET', '/image/1', pwd='invalidpwd')
+        self.assertEqual(status, STATUS_UNAUTHORISED)
+
+    def test_post_label(self):
+        data = urlencode({'image_id': 1, 'class_id': 2, 'geometry': 'MULTIPOLYGON (((1 1, 2 2, 2 1, 1 1)))'}).encode()
+        status, _, body = self.asgi_request('POST', '/label', body=data,
+            headers=[(b'content-type', b'application/x-www-form-urlencoded'), (b'content-length', str(len(data)).encode())])
+        self.assertEqual(status, STATUS_OK)
+        label_id = json.loads(body)['label_id']
+        self.assertEqual(json.loads(self.get_request(f'label/{label_id}').content)['class_id'], 2)
+
+    def test_query_and_streaming(self):
+        status, headers, body = self.asgi_request('GET', '/image/1/labels', query=b'class_id=4')
+        self.assertEqual(status, STATUS_OK)
+        self.assertEqual([json.loads(line)['label_id'] for line in body.splitlines()], [4])
+
+    def test_range(self):
+        status, _, body = self.asgi_request('GET', '/image/1/content', headers=[(b'range', b'bytes=0-9')])
+        self.assertEqual(status, 206)
+        self.assertEqual(len(body), 10)
+
+
+class TestResponseEtags(TestApis):
+    def conditional_get(self, url, etag):
+        return requests.get(f'http://localhost:5000/{url}', headers={'If-None-Match': etag},
+            auth=HTTPBasicAuth('rock_god_9000', 'voodoochild'))
+
+    def test_not_modified(self):
+        for url in ('image/1', 'label/1', 'label/1?format=geojson'):
+            r = self.get_request(url)
+            self.assertIn('no-cache', r.headers['Cache-Control'])
+            # the second request is served from the cache, with the same etag
+            self.assertEqual(self.get_request(url).headers['ETag'], r.headers['ETag'])
+            r = self.conditional_get(url, r.headers['ETag'])
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.content, b'')
+
+    def test_label_update(self):
+        etag = self.get_request('label/1').headers['ETag']
+        self.put_request('label/1', data={'class_id': 3})
+        r = self.conditional_get('label/1', etag)
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertEqual(json.loads(r.content)['class_id'], 3)
+
+    def test_label_batch(self):
+        self.get_request('label/1')
+        self.post_json_request('labels/batch', [{'method': 'DELETE', 'label_id': 1}])
+        self.assertEqual(self.get_request('label/1').status_code, STATUS_NOT_FOUND)
+
+    def test_image_delete(self):
+        self.get_request('image/1')
+        self.delete_request('image/1')
+        self.assertEqual(self.get_request('image/1').status_code, STATUS_NOT_FOUND)
+
+
+class TestMetrics(TestApis):
+    def metric_value(self, text, sample):
+        for line in text.splitlines():
+            if line.startswith(sample + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0
+
+    def test_metrics(self):
+        sample = 'http_request_duration_seconds_count{route="/image/<int:image_id>",method="GET",status="200"}'
+        before = self.metric_value(self.get_request('metrics').text, sample)
+        self.get_request('image/1')
+        r = self.get_request('metrics')
+        self.assertEqual(r.status_code, STATUS_OK)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        self.assertEqual(self.metric_value(r.text, sample), before + 1)
+        self.assertIn('# TYPE sql_query_duration_seconds histogram', r.text)
+        self.assertIn('sql_query_duration_seconds_count{statement="SELECT"}', r.text)
+        self.assertIn('cache_hit_ratio{cache="credential"}', r.text)
+
+    def test_metrics_needs_login(self):
+        r = requests.get('http://localhost:5000/metrics')
+        self.assertEqual(r.status_code, STATUS_UNAUTHORISED)
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test.', ('kind',), buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.1, 'a')
+        histogram.observe(5, 'a')
+        self.assertEqual(histogram.collect()[2:], [
+            'test_seconds_bucket{kind="a",le="0.1"} 2',
+            'test_seconds_bucket{kind="a",le="1"} 2',
+            'test_seconds_bucket{kind="a",le="+Inf"} 3',
+            'test_seconds_sum{kind="a"} 5.15',
+            'test_seconds_count{kind="a"} 3',
+            ])
+
+    def test_timed_connection(self):
+        conn = sqlite3.connect(':memory:', factory=TimedConnection)
+        before = sql_seconds.count('CREATE'), sql_seconds.count('INSERT'), sql_seconds.count('FETCH')
+        conn.execute('CREATE TABLE t (x INTEGER)')
+        conn.cursor().executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+        self.assertEqual(conn.cursor().execute('SELECT x FROM t').fetchall(), [(1,), (2,)])
+        self.assertEqual((sql_seconds.count('CREATE'), sql_seconds.count('INSERT'), sql_seconds.count('FETCH')),
+            (before[0] + 1, before[1] + 1, before[2] + 1))
+        conn.close()
+
+    def test_slow_request_profiler(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler = SlowRequestProfiler(0.05, tmp_dir)
+            self.assertIsNone(profiler.stop(profiler.start(), 0.01, 'GET /image/<int:image_id>'))
+            path = profiler.stop(profiler.start(), 0.1, 'GET /image/<int:image_id>')
+            self.assertEqual(os.listdir(tmp_dir), [path.name])
+            self.assertIn('GET_image_int_image_id', path.name)
+
+
+class TestResponseCache(TestCase):
+    def test_variants_invalidated_together(self):
+        cache = ResponseCache()
+        etag = cache.put('label', 1, '{"a": 1}', 'wkt')
+        cache.put('label', 1, '{"a": 2}', 'geojson')
+        cache.put('label', 2, '{"b": 1}', 'wkt')
+        self.assertEqual(cache.get('label', 1, 'wkt'), ('{"a": 1}', etag))
+        cache.invalidate('label', [1])
+        self.assertIsNone(cache.get('label', 1, 'wkt'))
+        self.assertIsNone(cache.get('label', 1, 'geojson'))
+        self.assertIsNotNone(cache.get('label', 2, 'wkt'))
+
+    def test_bounds(self):
+        cache = ResponseCache(max_entries=2, max_bytes=10)
+        cache.put('image', 1, '12345')
+        cache.put('image', 2, '12345')
+        cache.get('image', 1)
+        cache.put('image', 3, '12345')
+        # image 2 was the least recently used
+        self.assertIsNone(cache.get('image', 2))
+        self.assertIsNotNone(cache.get('image', 1))
+        cache.put('image', 4, '12345678')
+        self.assertIsNone(cache.get('image', 1))
+        self.assertIsNone(cache.get('image', 3))
+
+    def test_expired(self):
+        cache = ResponseCache(ttl=0)
+        cache.put('image', 1, 'body')
+        self.assertIsNone(cache.get('image', 1))
+
+    def test_sync(self):
+        # writes logged by any connection are picked up, and a new schema drops everything
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE Logs (log_id INTEGER PRIMARY KEY AUTOINCREMENT, object TEXT, image_id INTEGER, label_id INTEGER)')
+        cache = ResponseCache()
+        cache.sync(conn)
+        cache.put('image', 1, 'image 1')
+        cache.put('label', 1, 'label 1')
+        cache.put('label', 2, 'label 2')
+        conn.execute("INSERT INTO Logs (object, image_id, label_id) VALUES ('Label', NULL, 2)")
+        cache.sync(conn)
+        self.assertIsNotNone(cache.get('image', 1))
+        self.assertIsNotNone(cache.get('label', 1))
+        self.assertIsNone(cache.get('label', 2))
+
+        conn.execute('CREATE TABLE Other (a)')
+        cache.sync(conn)
+        self.assertIsNone(cache.get('image', 1))
+
+    def test_stale_put(self):
+        # a response read before an invalidation isn't cached after it
+        cache = ResponseCache()
+        generation = cache.generation
+        cache.invalidate('image', [1])
+        cache.put('image', 1, 'old body', generation=generation)
+        self.assertIsNone(cache.get('image', 1))
+
+
+class TestExport(TestApis):
+    def export(self, since_log_id=None):
+        r = self.get_request('export' if since_log_id is None else f'export?since_log_id={since_log_id}')
+        self.assertEqual(r.status_code, STATUS_OK)
+        return [json.loads(line) for line in r.content.splitlines()], int(r.headers['X-Export-Log-Id'])
+
+    def test_head_releases_connection(self):
+        self.check_unread_bodies_release('/export')
+
+    def test_full_export(self):
+        records, _ = self.export()
+        self.assertEqual([record['image_id'] for record in records], [1, 2, 3, 4, 5])
+        self.assertEqual([label['label_id'] for label in records[0]['labels']], [1, 4])
+        self.assertEqual(records[0]['labels'][1]['class_name'], 'infection')
+        self.assertEqual(records[0]['labels'][1]['labelled_by'], 'noot_noot')
+
+    def test_incremental_export(self):
+        _, log_id = self.export()
+        self.assertEqual(self.export(log_id)[0], [])
+
+        self.delete_request('label/1')
+        self.put_request('label/2', data={'class_id': 3})
+        self.delete_request('image/4')
+        records, next_log_id = self.export(log_id)
+        self.assertGreater(next_log_id, log_id)
+        self.assertEqual([record['image_id'] for record in records], [1, 3, 4])
+        self.assertEqual([label['label_id'] for label in records[0]['labels']], [4])
+        self.assertEqual(records[1]['labels'][0]['class_name'], 'fracture')
+        self.assertEqual(records[2], {'image_id': 4, 'deleted': True})
+        self.assertEqual(self.export(next_log_id)[0], [])
+
+    def test_export_command(self):
+        db_path = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conn = sqlite3.connect(str(db_path))
+            out = os.path.join(tmp_dir, 'export.jsonl')
+            # a small chunk size walks the images over several queries
+            summary = export_dataset(conn, out, chunk_size=2)
+            self.assertEqual(summary['records'], 5)
+            with open(out) as f:
+                self.assertEqual([json.loads(line)['image_id'] for line in f], [1, 2, 3, 4, 5])
+            conn.close()
+
+    def test_export_parquet(self):
+        pq = pytest.importorskip('pyarrow.parquet')
+        db_path = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conn = sqlite3.connect(str(db_path))
+            out = os.path.join(tmp_dir, 'export.parquet')
+            self.assertEqual(export_dataset(conn, out, 'parquet', chunk_size=4)['records'], 5)
+            conn.close()
+            table = pq.read_table(out)
+            self.assertEqual(table.column('image_id').to_pylist(), [1, 2, 3, 4, 5])
+            self.assertEqual([label['class_name'] for label in table.column('labels').to_pylist()[0]], ['tumor', 'infection'])
+
+
+class TestSyntheticData(TestCase):
+    def test_synthetic_db(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'synthetic.sqlite')
+            summary = create_synthetic_db(db_path, 50, 400, n_users=3, seed=1)
+            self.assertEqual(summary['rows']['Labels'], 400)
+            self.assertGreater(summary['rows/sec'], 0)
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute('SELECT count(*) FROM Images').fetchone()[0], 50)
+            self.assertEqual(conn.execute('SELECT count(*) FROM Labels').fetchone()[0], 400)
+            self.assertEqual(conn.execute("SELECT count(*) FROM Logs WHERE method='INSERTION'").fetchone()[0], 450)
+            # written straight into the latest schema, with the wkb, spatial index and revisions
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], LATEST_VERSION)
+            self.assertEqual(conn.execute('SELECT count(*) FROM LabelRevisions').fetchone()[0], 400)
+            self.assertEqual(conn.execute('SELECT count(*) FROM LabelsRtree').fetchone()[0],
+                conn.execute('SELECT count(*) FROM Labels WHERE NOT deleted').fetchone()[0])
+            wkt, wkb = conn.execute('SELECT geometry, geometry_wkb FROM Labels LIMIT 1').fetchone()
+            self.assertTrue(shapely.wkt.loads(wkt).equals(shapely.wkb.loads(wkb)))
+            # labels come after the upload of their image
+            self.assertEqual(conn.execute('''
+                SELECT count(*) FROM Labels
+                JOIN Logs AS label_logs ON label_logs.label_id = labels.label_id
+                JOIN Logs AS image_logs ON image_logs.image_id = labels.image_id
+                WHERE image_logs.modified_at_epoch > label_logs.modified_at_epoch
+                ''').fetchone()[0], 0)
+            self.assertTrue(check_password_hash(
+                conn.execute("SELECT pwd_hash FROM Users WHERE username='annotator_0'").fetchone()[0], 'annotator_0'))
+            geometries = [shapely.wkt.loads(geometry) for (geometry,) in conn.execute('SELECT geometry FROM Labels')]
+            self.assertTrue(all(geom.geom_type == 'MultiPolygon' and geom.is_valid for geom in geometries))
+            # the example user is there, so the db can be used with the api
+            self.assertIsNotNone(conn.execute("SELECT 1 FROM Users WHERE username='rock_god_9000'").fetchone())
+            first = conn.execute('SELECT geometry FROM Labels ORDER BY label_id LIMIT 1').fetchone()
+            conn.close()
+
+            create_synthetic_db(db_path, 50, 400, n_users=3, seed=1)
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute('SELECT geometry FROM Labels ORDER BY label_id LIMIT 1').fetchone(), first)
+            conn.close()
+
+
+class TestPiiEngine(TestCase):
+    def test_scan_batch(self):
+        image_dir = Path(__file__).absolute().parent.joinpath('static', 'images')
+        paths = [str(image_dir.joinpath(name)) for name in ('brain_jeff.jpeg', 'xray_image.jpeg', 'this_doesnt_exist.jpeg')]
+
+        # use a cheap picklable scanner so this doesn't depend on tesseract
+        with PiiEngine(num_workers=2, timeout=10, scanner=os.path.exists) as engine:
+            results = {result.path: result for result in engine.scan(paths)}
+
+        self.assertEqual(set(results), set(paths))
+        self.assertTrue(results[paths[0]].contains_pii)
+        self.assertFalse(results[paths[2]].contains_pii)
+        self.assertTrue(all(result.error is None for result in results.values()))
+
+    def test_check_timeout(self):
+        image_path = str(IMAGES_DIR.joinpath('brain_jeff.jpeg'))
+        with PiiEngine(num_workers=1, timeout=1, scanner=misbehaving_scanner) as engine:
+            start = time.time()
+            with self.assertRaises(PiiScanError):
+                engine.check('hang.jpeg')
+            self.assertLess(time.time() - start, 10)
+            # the hung worker was killed, and a new pool serves the next image
+            self.assertTrue(engine.check(image_path))
+
+    def test_check_crash(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crash_once = os.path.join(tmp_dir, 'crash_once.jpeg')
+            open(crash_once, 'w').close()
+            with PiiEngine(num_workers=1, timeout=10, max_retries=1, scanner=misbehaving_scanner) as engine:
+                # retried once in a new pool
+                self.assertTrue(engine.check(crash_once))
+                with self.assertRaises(PiiScanError):
+                    engine.check('crash_always.jpeg')
+                self.assertFalse(engine.check('this_doesnt_exist.jpeg'))
+
+    def test_check_timeout_spares_others(self):
+        # another thread's image, in flight when the hung one's pool is killed, is resubmitted without using up a retry
+        with PiiEngine(num_workers=2, timeout=2, max_retries=0, scanner=misbehaving_scanner) as engine:
+            engine.check('this_doesnt_exist.jpeg')  # start the pool
+            hung = threading.Thread(target=lambda: self.assertRaises(PiiScanError, engine.check, 'hang.jpeg'))
+            hung.start()
+            time.sleep(1)
+            self.assertFalse(engine.check('slow.jpeg'))
+            hung.join()
+
+    def test_scan_timeout(self):
+        # the hung image is reported, the others finish, including any in flight when the pool was recycled
+        paths = ['hang.jpeg', str(IMAGES_DIR.joinpath('brain_jeff.jpeg')), str(IMAGES_DIR.joinpath('xray_image.jpeg'))]
+        with PiiEngine(num_workers=2, timeout=1, scanner=misbehaving_scanner) as engine:
+            results = {result.path: result for result in engine.scan(paths)}
+        self.assertEqual(set(results), set(paths))
+        self.assertIn('timed out', results['hang.jpeg'].error)
+        self.assertEqual([(results[path].contains_pii, results[path].error) for path in paths[1:]], [(True, None), (True, None)])
+
+    def test_scan_crash(self):
+        # one worker, so a crash only ever takes down the image that caused it
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crash_once = os.path.join(tmp_dir, 'crash_once.jpeg')
+            open(crash_once, 'w').close()
+            paths = ['crash_always.jpeg', crash_once, str(IMAGES_DIR.joinpath('brain_jeff.jpeg'))]
+            with PiiEngine(num_workers=1, timeout=10, max_retries=1, scanner=misbehaving_scanner) as engine:
+                results = {result.path: result for result in engine.scan(paths)}
+        self.assertEqual(results['crash_always.jpeg'].error, 'PII worker crashed')
+        self.assertEqual((results[crash_once].contains_pii, results[crash_once].error), (True, None))
+        self.assertEqual((results[paths[2]].contains_pii, results[paths[2]].error), (True, None))
+
+
+class TestPiiJobQueue(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = Path(self.tmp_dir).joinpath('jobs.sqlite')
+        create_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for(self, conn, query, expected, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = conn.execute(query).fetchall()
+            if result == expected:
+                break
+            time.sleep(0.05)
+        return result
+
+    def test_resume_after_restart(self):
+        # a job no process started, one whose owner stopped renewing its lease, and one whose owner is still scanning it
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("UPDATE Images SET contains_pii=NULL WHERE image_id IN (1, 2, 3)")
+        conn.executemany(
+            "INSERT INTO PiiJobs (image_id, image_path, status, attempts, owner, created_at, updated_at) VALUES (?, ?, ?, 1, ?, ?, ?)",
+            [(1, 'brain_jeff.jpeg', JOB_PENDING, None, '2020-01-01 00:00:00', '2020-01-01 00:00:00'),
+                (2, 'xray_image.jpeg', JOB_RUNNING, 'dead', '2020-01-01 00:00:00', '2020-01-01 00:00:00'),
+                (3, 'xray_image.jpeg', JOB_RUNNING, 'alive', '2020-01-01 00:00:00', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))])
+        conn.commit()
+
+        # starting the queue is enough, nothing is enqueued or notified
+        queue = PiiJobQueue(self.db_path, IMAGES_DIR, num_workers=1, poll_interval=0.05, scanner=lambda path: True, lease_seconds=60)
+        queue.start()
+        try:
+            statuses = self.wait_for(conn, "SELECT status FROM PiiJobs ORDER BY image_id", [(JOB_DONE,), (JOB_DONE,), (JOB_RUNNING,)])
+        finally:
+            queue.stop(timeout=5)
+
+        self.assertEqual(statuses, [(JOB_DONE,), (JOB_DONE,), (JOB_RUNNING,)])
+        self.assertEqual(conn.execute("SELECT contains_pii FROM Images WHERE image_id IN (1, 2, 3)").fetchall(), [(1,), (1,), (None,)])
+        self.assertEqual(conn.execute("SELECT owner FROM PiiJobs WHERE image_id=3").fetchone()[0], 'alive')
+        conn.close()
+
+    def test_lease_renewed(self):
+        # a scan which outlasts the lease is kept by its owner, rather than taken over by another process
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("UPDATE Images SET contains_pii=NULL WHERE image_id=1")
+        conn.execute("INSERT INTO PiiJobs (image_id, image_path, status, attempts, created_at, updated_at) VALUES (1, 'brain_jeff.jpeg', ?, 0, datetime('now'), datetime('now'))",
+            (JOB_PENDING,))
+        conn.commit()
+
+        other_scans = []
+        slow = PiiJobQueue(self.db_path, IMAGES_DIR, num_workers=1, poll_interval=0.05, scanner=lambda path: time.sleep(3) or True, lease_seconds=1)
+        other = PiiJobQueue(self.db_path, IMAGES_DIR, num_workers=1, poll_interval=0.05, scanner=other_scans.append, lease_seconds=1)
+        slow.start()
+        self.wait_for(conn, "SELECT status FROM PiiJobs", [(JOB_RUNNING,)])
+        other.start()
+        try:
+            result = self.wait_for(conn, "SELECT status, attempts FROM PiiJobs", [(JOB_DONE, 1)])
+        finally:
+            slow.stop(timeout=5)
+            other.stop(timeout=5)
+        conn.close()
+        self.assertEqual(result, [(JOB_DONE, 1)])
+        self.assertEqual(other_scans, [])
+
+    def test_scan_is_exported(self):
+        # a verdict written by the queue is a change like any other to an incremental export
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("UPDATE Images SET contains_pii=NULL WHERE image_id=3")
+        conn.execute("INSERT INTO PiiJobs (image_id, image_path, status, attempts, created_at, updated_at) VALUES (3, 'xray_image.jpeg', ?, 0, datetime('now'), datetime('now'))",
+            (JOB_PENDING,))
+        conn.commit()
+        log_id = conn.execute('SELECT max(log_id) FROM Logs').fetchone()[0] or 0
+
+        queue = PiiJobQueue(self.db_path, IMAGES_DIR, num_workers=1, poll_interval=0.05, scanner=lambda path: False)
+        queue.start()
+        try:
+            deadline = time.time() + 10
+            while time.time() < deadline and conn.execute("SELECT contains_pii FROM Images WHERE image_id=3").fetchone()[0] is None:
+                time.sleep(0.05)
+        finally:
+            queue.stop(timeout=5)
+
+        out = io.StringIO()
+        export_dataset(conn, out, since_log_id=log_id)
+        conn.close()
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(record['image_id'], record['contains_pii']) for record in records], [(3, 0)])
+
+    def test_buffered_verdict_log(self):
+        # with a log writer the verdict's log is handed to it after the verdict commits
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("UPDATE Images SET contains_pii=NULL WHERE image_id=1")
+        conn.commit()
+        logs_before = conn.execute('SELECT count(*) FROM Logs').fetchone()[0]
+        writer = mock.Mock()
+        queue = PiiJobQueue(self.db_path, IMAGES_DIR, num_workers=1, poll_interval=0.05, scanner=lambda path: False, log_writer=writer)
+        queue.start()
+        try:
+            queue.enqueue(conn.cursor(), 1, 'brain_jeff.jpeg')
+            conn.commit()
+            queue.notify()
+            self.wait_for(conn, "SELECT status FROM PiiJobs", [(JOB_DONE,)])
+        finally:
+            queue.stop(timeout=5)
+        self.assertEqual(conn.execute('SELECT count(*) FROM Logs').fetchone()[0], logs_before)
+        conn.close()
+        rows = [row for call in writer.write.call_args_list for row in call.args[0]]
+        self.assertEqual([(row[0], row[2], row[3]) for row in rows], [('Image', 'UPDATE', 1)])
+
+    def test_app_starts_queue(self):
+        # the app's queue runs before any image is posted to it
+        import app as app_module
+        previous, database = app_module.pii_queue, flask_app.config['DATABASE']
+        app_module.pii_queue = None
+        flask_app.config['DATABASE'] = str(self.db_path)
+        try:
+            queue = app_module.get_pii_queue()
+            self.assertTrue(queue._threads)
+            queue.stop(timeout=5)
+        finally:
+            app_module.pii_queue = previous
+            flask_app.config['DATABASE'] = database
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        db_path = Path(__file__).absolute().parent.joinpath('image_db', 'test_db.sqlite')
+        self.pool = ConnectionPool(db_path, size=2, timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_reuses_connections(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+
+    def test_rolls_back_on_release(self):
+        conn = self.pool.acquire()
+        conn.execute("UPDATE Images SET deleted=1 WHERE image_id=1")
+        self.pool.release(conn)
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(conn.execute("SELECT deleted FROM Images WHERE image_id=1").fetchone()[0], 0)
+
+    def test_size_limit(self):
+        self.pool.acquire()
+        self.pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire()
+
+    def test_double_release(self):
+        # a second release is ignored, rather than letting two callers share the connection
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+        self.assertIsNot(self.pool.acquire(), conn)
+
+
+class TestCredentialCache(TestCase):
+    def setUp(self):
+        self.cache = CredentialCache(max_entries=2, ttl=60)
+        self.cache.add('rock_god_9000', 'voodoochild', 'hash_1')
+
+    def test_hit(self):
+        self.assertTrue(self.cache.check('rock_god_9000', 'voodoochild', 'hash_1'))
+
+    def test_wrong_password(self):
+        self.assertFalse(self.cache.check('rock_god_9000', 'invalidpwd', 'hash_1'))
+
+    def test_changed_hash(self):
+        # the user's password has been changed since it was cached
+        self.assertFalse(self.cache.check('rock_god_9000', 'voodoochild', 'hash_2'))
+
+    def test_expired(self):
+        cache = CredentialCache(ttl=0)
+        cache.add('rock_god_9000', 'voodoochild', 'hash_1')
+        self.assertFalse(cache.check('rock_god_9000', 'voodoochild', 'hash_1'))
+
+    def test_eviction(self):
+        self.cache.add('marko', 'booksRgood', 'hash_3')
+        self.cache.add('noot_noot', 'i_r_winner', 'hash_4')
+        self.assertFalse(self.cache.check('rock_god_9000', 'voodoochild', 'hash_1'))
+        self.assertTrue(self.cache.check('noot_noot', 'i_r_winner', 'hash_4'))
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+from dicom_scanner import is_dicom, iter_frames
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+class ThumbnailCache:
+    """
+    On-disk cache of jpeg thumbnails, generated the first time each one is asked for.
+
+    A thumbnail is keyed by the image's path, modification time and size, so replacing the
+    image makes a new one. Once the cache holds more than `max_bytes`, the least recently
+    used thumbnails are deleted. Thumbnails are written to a temporary file and renamed into
+    place, so several processes can share the same directory.
+    """
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, quality=85):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def _thumbnail_path(self, image_path, size):
+        stat = os.stat(image_path)
+        key = f'{Path(image_path).absolute()}:{stat.st_mtime_ns}:{stat.st_size}:{size}'
+        return self.cache_dir.joinpath(hashlib.sha1(key.encode()).hexdigest() + '.jpeg')
+
+    def get(self, image_path, size):
+        """The path of the image's thumbnail, no bigger than size x size. Raises ThumbnailError if it can't be made."""
+        thumbnail_path = self._thumbnail_path(image_path, size)
+        try:
+            # mark it as recently used, for eviction
+            os.utime(thumbnail_path)
+            self.hits += 1
+            return thumbnail_path
+        except FileNotFoundError:
+            self.misses += 1
+
+        im = _open_image(image_path, size)
+        im.thumbnail((size, size))
+        if im.mode not in ('L', 'RGB'):
+            im = im.convert('RGB')
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = thumbnail_path.with_name(f'{thumbnail_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        im.save(tmp_path, 'JPEG', quality=self.quality)
+        os.replace(tmp_path, thumbnail_path)
+        self.evict()
+        return thumbnail_path
+
+    def evict(self):
+        # delete the least recently used thumbnails until the cache fits in max_bytes
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.jpeg'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.cache_dir) if self.cache_dir.exists() else ():
+                os.remove(entry.path)
+
+
+def _open_image(image_path, size):
+    from PIL import Image
+
+    if is_dicom(image_path):
+        # the first frame stands for the series
+        try:
+            return next(iter_frames(image_path, [0]))
+        except Exception as e:
+            raise ThumbnailError(f'Could not read DICOM image: {e}')
+    try:
+        im = Image.open(image_path)
+        # lets jpegs be decoded at a fraction of their full size
+        im.draft('RGB', (size, size))
+        im.load()
+        return im
+    except (OSError, ValueError) as e:
+        raise ThumbnailError(f'Could not read image: {e}')